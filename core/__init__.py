@@ -1,8 +1,53 @@
-from .file_controller import FileController
+from .file_controller import (
+    AudioClip,
+    ConversionError,
+    FileController,
+)
+from .session_store import (
+    AbstractSessionStore,
+    MemorySessionStore,
+    RedisSessionStore,
+    SessionStoreError,
+    SQLiteSessionStore,
+)
 from .user_controller import (
+    SessionMiddleware,
     UserController,
     UserState,
 )
-from .db_controller import DatabaseController
-from .recognize_controller import RecognitionController
+from .entry_cache import EntryCache
+from .storage import (
+    AbstractStorage,
+    FirestoreStorage,
+    SQLiteStorage,
+    StorageReplicator,
+)
+from .write_queue import WriteQueue
+from .search_index import SearchIndex
+from .topic_index import TopicIndex
+from .db_controller import (
+    DatabaseController,
+    DatabaseError,
+)
+from .recognize_controller import (
+    RecognitionController,
+    Transcription,
+)
+from .recognition_router import (
+    RecognitionBackendError,
+    RecognitionRouter,
+)
+from .recognition_service import (
+    RecognitionBusyError,
+    RecognitionService,
+    RecognitionTimeoutError,
+)
+from .transcription_cache import TranscriptionCache
+from .outbound_sender import OutboundSender
+from .webhook_server import WebhookServer
+from .worker_pool import (
+    ShardedDispatcher,
+    UpdateWorker,
+    WorkerPool,
+)
 from .response_controller import Responder
@@ -0,0 +1,147 @@
+from typing import Optional
+
+import numpy as np
+
+from core.file_controller import AudioClip
+
+
+class AudioProcessor:
+    # the energy is measured over windows of this many seconds
+    FRAME_DURATION = 0.02
+    # a pause shorter than this is not a place to cut at
+    MIN_PAUSE_DURATION = 0.3
+    # trimming leaves pauses this long between words, so the recognizer still hears them
+    KEPT_PAUSE_DURATION = 0.3
+    # a pause has to be quieter than this many dBFS to be cut at
+    SILENCE_THRESHOLD = -40
+    # segments cut where there's no pause repeat this much of the previous one,
+    # so the word on the cut is heard whole in one of them
+    OVERLAP_DURATION = 0.5
+
+    @classmethod
+    def samples(cls, audio: AudioClip) -> np.ndarray:
+        if audio.encoding != AudioClip.LINEAR16:
+            raise ValueError(f'{audio.encoding} audio has to be decoded to PCM first')
+        samples = np.frombuffer(audio.content, dtype='<i2')
+        if audio.channels > 1:
+            samples = samples[:len(samples) - len(samples) % audio.channels]
+            samples = samples.reshape(-1, audio.channels).mean(axis=1)
+        return samples
+
+    @classmethod
+    def frame_length(cls, audio: AudioClip) -> int:
+        return max(1, int(audio.sample_rate * cls.FRAME_DURATION))
+
+    @classmethod
+    def frame_energy(cls, audio: AudioClip) -> np.ndarray:
+        """
+        Short-time energy of the audio.
+        :param audio: a LINEAR16 clip.
+        :return: the RMS level of every FRAME_DURATION frame in dBFS.
+        """
+        samples = cls.samples(audio)
+        frame_len = cls.frame_length(audio)
+        frames_count = len(samples) // frame_len
+        frames = samples[:frames_count * frame_len].reshape(frames_count, frame_len)
+        rms = np.sqrt(np.mean(np.square(frames, dtype=np.float64), axis=1))
+        return 20 * np.log10(np.maximum(rms / 32768, 1e-10))
+
+    @classmethod
+    def trim_silence(cls, audio: AudioClip, threshold: float) -> AudioClip:
+        """
+        Cut leading and trailing silence and shorten long pauses to KEPT_PAUSE_DURATION.
+        :param audio: a mono LINEAR16 clip.
+        :param threshold: the level in dBFS below which a frame counts as silence.
+        :return: a LINEAR16 clip with voiced frames only.
+        """
+        energy = cls.frame_energy(audio)
+        if not len(energy):
+            # too short to tell speech from silence
+            return audio
+        voiced = energy > threshold
+        # keep half a pause on both sides of every voiced frame
+        padding = int(cls.KEPT_PAUSE_DURATION / cls.FRAME_DURATION / 2)
+        keep = np.convolve(voiced, np.ones(2 * padding + 1), mode='same') > 0
+
+        frame_bytes = cls.frame_length(audio) * audio.channels * audio.sample_width
+        frames = np.frombuffer(
+            audio.content, dtype=np.uint8, count=len(keep) * frame_bytes
+        ).reshape(len(keep), frame_bytes)
+        return AudioClip(
+            content=frames[keep].tobytes(),
+            encoding=audio.encoding,
+            sample_rate=audio.sample_rate,
+            channels=audio.channels,
+            sample_width=audio.sample_width,
+        )
+
+    @classmethod
+    def split_on_silence(
+        cls, audio: AudioClip, max_duration: float, threshold: Optional[float] = None
+    ) -> list:
+        """
+        Split the audio into segments no longer than max_duration, cutting at the quietest pause.
+        :param audio: a LINEAR16 clip.
+        :param max_duration: the longest segment allowed, in seconds.
+        :param threshold: the level in dBFS below which a frame counts as silence,
+        SILENCE_THRESHOLD if None.
+        :return: a list of LINEAR16 clips, in order; where there's no pause to cut at,
+        the next segment starts OVERLAP_DURATION before the end of the previous one.
+        """
+        if audio.duration <= max_duration:
+            return [audio]
+        if threshold is None:
+            threshold = cls.SILENCE_THRESHOLD
+
+        energy = cls.frame_energy(audio)
+        # averaging over a pause's length makes a cut land inside a real pause
+        # instead of a momentary dip between two syllables
+        pause_frames = max(1, int(cls.MIN_PAUSE_DURATION / cls.FRAME_DURATION))
+        smoothed = np.convolve(energy, np.ones(pause_frames) / pause_frames, mode='same')
+
+        max_frames = max(1, int(max_duration / cls.FRAME_DURATION))
+        overlap_frames = min(int(cls.OVERLAP_DURATION / cls.FRAME_DURATION), max_frames // 2)
+        spans, start = [], 0
+        while len(energy) - start > max_frames:
+            end = start + max_frames
+            # a pause in the second half of the window keeps the segments from getting too short,
+            # but any pause is better than cutting through a word
+            cut = cls._find_pause(smoothed, start + max_frames // 2, end, threshold)
+            if cut is None:
+                cut = cls._find_pause(smoothed, start + 1, end, threshold)
+            if cut is None:
+                spans.append((start, end))
+                start = end - overlap_frames
+            else:
+                spans.append((start, cut))
+                start = cut
+        spans.append((start, None))
+
+        frame_bytes = cls.frame_length(audio) * audio.channels * audio.sample_width
+        bounds = [
+            (start * frame_bytes, len(audio.content) if end is None else end * frame_bytes)
+            for start, end in spans
+        ]
+        return [
+            AudioClip(
+                content=audio.content[start:end],
+                encoding=audio.encoding,
+                sample_rate=audio.sample_rate,
+                channels=audio.channels,
+                sample_width=audio.sample_width,
+            )
+            for start, end in bounds
+        ]
+
+    @staticmethod
+    def _find_pause(
+        smoothed: np.ndarray, start: int, end: int, threshold: float
+    ) -> Optional[int]:
+        """
+        :return: the frame where the quietest stretch between start and end is,
+        None if even that one isn't silent.
+        """
+        if start >= end:
+            return None
+        cut = start + int(np.argmin(smoothed[start:end]))
+        return cut if smoothed[cut] < threshold else None
@@ -1,109 +1,237 @@
-import firebase_admin
-from firebase_admin import firestore
-from firebase_admin import exceptions as firebase_exceptions
+import asyncio
+import logging
+import time
+from collections import (
+    defaultdict,
+    deque,
+)
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Optional,
+)
 
+from core.entry_cache import (
+    EntryCache,
+    UserEntries,
+)
+from core.search_index import SearchIndex
+from core.storage import AbstractStorage
+from core.topic_index import TopicIndex
+from core.transcription_cache import TranscriptionCache
 from core.user_controller import Entry
+from core.write_queue import WriteQueue
 from utils import DateFormatter
 
 
+logger = logging.getLogger(__name__)
+
+
+class DatabaseError(Exception):
+    pass
+
+
 class DatabaseController:
     def __init__(
-        self, project_id: str, private_key_id: str, private_key: str, client_email: str,
-        client_id: str, cert_url: str,
+        self, storage: AbstractStorage, cache: Optional[EntryCache] = None,
+        write_queue: Optional[WriteQueue] = None, search_index: Optional[SearchIndex] = None,
+        topic_index: Optional[TopicIndex] = None,
+        transcription_cache: Optional[TranscriptionCache] = None
     ):
-        cred = firebase_admin.credentials.Certificate(
-            cert={
-                'type': 'service_account',
-                'project_id': project_id,
-                'private_key_id': private_key_id,
-                'private_key': private_key.replace('\\n', '\n'),
-                'client_email': client_email,
-                'client_id': client_id,
-                'auth_uri': 'https://accounts.google.com/o/oauth2/auth',
-                'token_uri': 'https://oauth2.googleapis.com/token',
-                'auth_provider_x509_cert_url': 'https://www.googleapis.com/oauth2/v1/certs',
-                'client_x509_cert_url': cert_url
-            }
-        )
-        firebase_admin.initialize_app(cred)
-        self._db = firestore.client()
+        """
+        :param storage: where the entries are kept, see core.storage.
+        :param cache: once a user's entries are loaded, the queries are answered from it;
+        they're loaded in the background after the first query that misses it.
+        :param write_queue: batches the writes made close together into one commit.
+        :param search_index: the full-text index of the entries, needed for search.
+        :param topic_index: the users' topic counts, for suggestions and forgiving topic lookups.
+        :param transcription_cache: the recognizer's cache, the transcript of a deleted entry
+        is dropped from it too.
+        """
+        self._storage = storage
+        self._cache = cache
+        self._write_queue = write_queue
+        self._search_index = search_index
+        self._topic_index = topic_index
+        self._transcription_cache = transcription_cache
+        self._latencies = defaultdict(lambda: deque(maxlen=100))
+        # the users whose entries are being loaded into the cache
+        self._warming = {}
+
+    async def _execute(self, operation: str, request: Awaitable):
+        """
+        Await a storage request, timing it and turning its errors into DatabaseError.
+        :param operation: the name the latency is recorded under.
+        :param request: the storage coroutine.
+        :return: whatever the request returns.
+        """
+        started_at = time.monotonic()
+        try:
+            return await request
+        except self._storage.ERRORS as e:
+            raise DatabaseError(f'{operation} failed: {e}') from e
+        finally:
+            latency = time.monotonic() - started_at
+            self._latencies[operation].append(latency)
+            logger.debug('%s took %.3fs', operation, latency)
 
-    def user_entries_ref(self, user_id: int):
-        return self._db.collection('Users').document(f'{user_id}').collection('Entries')
+    def _cached_entries(self, user_id: int) -> Optional[UserEntries]:
+        """
+        Get all of the user's entries from the cache; on a miss, they're loaded in the background
+        for the next queries, unless they're known not to fit.
+        :param user_id: the user's Telegram ID.
+        :return: the user's entries, or None if they aren't cached, so the query goes to storage.
+        """
+        if self._cache is None:
+            return None
+        entries = self._cache.get(user_id)
+        if entries is None and self._cache.fits(user_id) and user_id not in self._warming:
+            self._warming[user_id] = asyncio.ensure_future(self._warm(user_id))
+        return entries
 
-    def curr_entry_ref(self, user_id: int, date: str):
-        return self.user_entries_ref(user_id).document(date)
+    async def _warm(self, user_id: int) -> None:
+        try:
+            await self._load_all(user_id)
+        except DatabaseError as e:
+            logger.warning('could not load the entries of %s into the cache: %s', user_id, e)
+        finally:
+            del self._warming[user_id]
+
+    async def _load_all(self, user_id: int) -> list:
+        """
+        Read all of the user's entries from storage and cache them if they fit.
+        """
+        writes = self._cache.writes if self._cache is not None else None
+        entries = await self._execute('fetch_all', self._storage.fetch_all(user_id))
+        if self._cache is not None:
+            self._cache.put(user_id, entries, writes)
+        return entries
+
+    def stats(self) -> dict:
+        """
+        :return: the number of calls and the average and max latency of the recent ones,
+        by operation, and the entry cache's stats.
+        """
+        stats = {} if self._cache is None else dict(cache=self._cache.stats())
+        for operation, latencies in list(self._latencies.items()):
+            latencies = list(latencies)
+            stats[operation] = dict(
+                calls=len(latencies),
+                avg_latency=sum(latencies) / len(latencies) if latencies else 0.0,
+                max_latency=max(latencies, default=0.0),
+            )
+        return stats
 
     async def create_entry(self, user_id: int, entry: Entry) -> str:
         """
-        Save an entry to the user's collection of entries in Firestore.
+        Save an entry to the user's collection of entries.
         :param user_id: the user's Telegram ID.
         :param entry: the entry's data: date, timestamp, topic, text.
-        :return: none
+        :return: the entry's ID, which is its date.
         """
         entry = entry.to_dict()
-        try:
-            (
-                self
-                .user_entries_ref(user_id)
-                .document(entry['date'])
-                .set(dict(
-                    timestamp=entry['timestamp'],
-                    topic=entry['topic'],
-                    text=entry['text'],
-                    language=entry['language'],
-                ))
-            )
-        except firebase_exceptions.PermissionDeniedError:
-            print('PERMISSION DENIED')
-        except firebase_exceptions.UnavailableError:
-            print('FIRESTORE UNAVAILABLE')
-        except firebase_exceptions.UnknownError:
-            print('UNKNOWN ERROR')
-        else:
-            return entry['date']
+        data = dict(
+            timestamp=entry['timestamp'],
+            topic=entry['topic'],
+            text=entry['text'],
+            language=entry['language'],
+        )
+        await self._execute(
+            'create_entry',
+            self._storage.create_entry(user_id, entry['date'], data)
+            if self._write_queue is None else
+            self._write_queue.submit(AbstractStorage.CREATE, user_id, entry['date'], data)
+        )
+        if self._cache is not None:
+            self._cache.add(user_id, data)
+        if self._search_index is not None:
+            await self._search_index.add(user_id, entry['date'], data['text'])
+        if self._topic_index is not None:
+            await self._topic_index.add(user_id, data['topic'])
+        return entry['date']
 
     async def delete_entry(self, user_id: int, timestamp: int) -> str:
         """
         Delete the user's entry by its timestamp.
         :param user_id: the user's Telegram ID.
         :param timestamp: the entry's date in timestamp.
-        :return: none
+        :return: the deleted entry's ID, which is its date.
         """
         date = DateFormatter.timestamp_to_date(timestamp)
-        try:
-            (
-                self
-                .curr_entry_ref(user_id, date)
-                .delete()
+        # the topic count and the cached transcript can only be dropped knowing the entry;
+        # it's read by its ID alone if the user's entries aren't cached
+        deleted = []
+        if self._topic_index is not None or self._transcription_cache is not None:
+            entry = self._cache.find(user_id, timestamp) if self._cache is not None else None
+            deleted = (
+                [entry] if entry is not None else
+                await self._execute('fetch_by_date', self._storage.fetch_by_id(user_id, date))
             )
-        except firebase_exceptions.PermissionDeniedError:
-            print('PERMISSION DENIED')
-        except firebase_exceptions.UnavailableError:
-            print('FIRESTORE UNAVAILABLE')
-        except firebase_exceptions.UnknownError:
-            print('UNKNOWN ERROR')
-        else:
-            return DateFormatter.timestamp_to_date(timestamp=timestamp)
+        await self._execute(
+            'delete_entry',
+            self._storage.delete_entry(user_id, date)
+            if self._write_queue is None else
+            self._write_queue.submit(AbstractStorage.DELETE, user_id, date)
+        )
+        if self._cache is not None:
+            self._cache.remove(user_id, timestamp)
+        if self._search_index is not None:
+            await self._search_index.remove(user_id, date)
+        for entry in deleted:
+            if self._topic_index is not None:
+                await self._topic_index.remove(user_id, entry['topic'])
+            if self._transcription_cache is not None:
+                await self._transcription_cache.remove(entry['text'])
+        return date
 
-    async def fetch_all(self, user_id: int) -> dict:
+    async def fetch_all(self, user_id: int) -> list:
         """
         Get the user's entries.
         :param user_id: the user's Telegram ID.
-        :return: a list of DocumentSnapshots (still need to be converted to dicts!)
+        :return: a list of entries as dicts.
         """
-        try:
-            return (
-                self
-                .user_entries_ref(user_id)
-                .get()
+        entries = self._cache.get(user_id) if self._cache is not None else None
+        if entries is not None:
+            return entries.all()
+        return await self._load_all(user_id)
+
+    async def fetch_page(
+        self, user_id: int, after: Optional[int] = None, limit: int = 10
+    ) -> (list, Optional[int]):
+        """
+        Get a page of the user's entries, so a long diary isn't read and sent all at once.
+        :param user_id: the user's Telegram ID.
+        :param after: the cursor returned with the previous page, None for the first one.
+        :param limit: the page size.
+        :return: the entries as dicts, oldest first, and the cursor of the next page,
+        or None if this is the last one.
+        """
+        entries = self._cache.get(user_id) if self._cache is not None else None
+        if entries is not None:
+            page = entries.page(after, limit + 1)
+        else:
+            # one extra entry tells whether there's a next page
+            page = await self._execute(
+                'fetch_page', self._storage.fetch_page(user_id, after, limit + 1)
             )
-        except firebase_exceptions.PermissionDeniedError:
-            print('PERMISSION DENIED')
-        except firebase_exceptions.UnavailableError:
-            print('FIRESTORE UNAVAILABLE')
-        except firebase_exceptions.UnknownError:
-            print('UNKNOWN ERROR')
+        if len(page) > limit:
+            return page[:limit], page[limit - 1]['timestamp']
+        return page, None
+
+    async def iter_entries(self, user_id: int, page_size: int = 100) -> AsyncIterator[dict]:
+        """
+        Go through all of the user's entries a page at a time, so only a page is in memory.
+        :param user_id: the user's Telegram ID.
+        :param page_size: how many entries to fetch at once.
+        :return: the entries as dicts, oldest first.
+        """
+        cursor = None
+        while True:
+            entries, cursor = await self.fetch_page(user_id, after=cursor, limit=page_size)
+            for entry in entries:
+                yield entry
+            if cursor is None:
+                return
 
     async def fetch_by_date(self, user_id: int, date: str, is_exact: bool) -> list:
         """
@@ -111,75 +239,71 @@ class DatabaseController:
         :param user_id: the user's Telegram ID.
         :param date: the date to fetch the entries for.
         :param is_exact: is date the exact datetime; if not, parse all the entries for that day.
-        :return: a list of DocumentSnapshots (still need to be converted to dicts!)
+        :return: a list of entries as dicts.
         """
-        try:
-            if is_exact:
-                # if the exact date is passed, get the entry by its doc ID
-                return (
-                    self
-                    .user_entries_ref(user_id)
-                    .document(date)
-                    .get()
-                )
-            else:
-                return (
-                    self
-                    .user_entries_ref(user_id)
-                    .order_by('timestamp', direction='ASCENDING')
-                    .start_at({'timestamp': DateFormatter.date_to_timestamp(date)})
-                    .end_before({'timestamp': DateFormatter.days_ago_timestamp(-1, date=date)})
-                    .get()
-                )
-        except firebase_exceptions.PermissionDeniedError:
-            print('PERMISSION DENIED')
-        except firebase_exceptions.UnavailableError:
-            print('FIRESTORE UNAVAILABLE')
-        except firebase_exceptions.UnknownError:
-            print('UNKNOWN ERROR')
+        entries = self._cached_entries(user_id)
+        if is_exact:
+            if entries is not None:
+                timestamp = DateFormatter.date_to_timestamp(date)
+                return entries.between(timestamp, timestamp)
+            # if the exact date is passed, get the entry by its ID
+            return await self._execute('fetch_by_date', self._storage.fetch_by_id(user_id, date))
+        else:
+            start = DateFormatter.date_to_timestamp(date)
+            end = DateFormatter.days_ago_timestamp(-1, date=date)
+            if entries is not None:
+                return entries.between(start, end, include_end=False)
+            return await self._execute(
+                'fetch_by_date',
+                self._storage.fetch_between(user_id, start, end, include_end=False)
+            )
 
     async def fetch_by_topic(self, user_id: int, topic: str) -> list:
         """
         Get all the entries by topic param.
         :param user_id: the user's Telegram ID.
         :param topic: the topic to search for.
-        :return: a list of DocumentSnapshots (still need to be converted to dicts!)
+        :return: a list of entries as dicts.
         """
-        try:
-            return (
-                self
-                .user_entries_ref(user_id)
-                .where('topic', '==', topic)
-                .get()
+        topics = [topic]
+        if self._topic_index is not None:
+            await self._index_topics(user_id)
+            # "work", "Work " and, failing those, "workout" all find the entries
+            topics = await self._topic_index.resolve(user_id, topic) or topics
+        entries = self._cached_entries(user_id)
+        if entries is not None:
+            return entries.by_topics(topics)
+        return await self._execute('fetch_by_topic', self._storage.fetch_by_topics(user_id, topics))
+
+    async def _index_topics(self, user_id: int) -> None:
+        # the first lookup counts what's there; from then on the writes keep the counts up to date
+        if not await self._topic_index.is_indexed(user_id):
+            await self._topic_index.build(
+                user_id, [entry['topic'] for entry in await self.fetch_all(user_id)]
             )
-        except firebase_exceptions.PermissionDeniedError:
-            print('PERMISSION DENIED')
-        except firebase_exceptions.UnavailableError:
-            print('FIRESTORE UNAVAILABLE')
-        except firebase_exceptions.UnknownError:
-            print('UNKNOWN ERROR')
+
+    async def frequent_topics(self, user_id: int, limit: int = 6) -> list:
+        """
+        :param user_id: the user's Telegram ID.
+        :param limit: how many topics to return at most.
+        :return: the user's most used topics, most used first.
+        """
+        if self._topic_index is None:
+            return []
+        await self._index_topics(user_id)
+        return await self._topic_index.most_used(user_id, limit)
 
     async def fetch_last_n(self, user_id: int, number: int) -> list:
         """
         Get the user's N last entries.
         :param user_id: the user's Telegram ID.
         :param number: the number of entries to fetch.
-        :return: a list of DocumentSnapshots (still need to be converted to dicts!)
+        :return: a list of entries as dicts.
         """
-        try:
-            return (
-                self
-                .user_entries_ref(user_id)
-                .order_by('timestamp', direction='DESCENDING')
-                .limit(number)
-                .get()
-            )
-        except firebase_exceptions.PermissionDeniedError:
-            print('PERMISSION DENIED')
-        except firebase_exceptions.UnavailableError:
-            print('FIRESTORE UNAVAILABLE')
-        except firebase_exceptions.UnknownError:
-            print('UNKNOWN ERROR')
+        entries = self._cached_entries(user_id)
+        if entries is not None:
+            return entries.last(number)
+        return await self._execute('fetch_last_n', self._storage.fetch_last_n(user_id, number))
 
     async def fetch_between_dates(self, user_id: int, date1: str, date2: str) -> list:
         """
@@ -187,45 +311,76 @@ class DatabaseController:
         :param user_id: the user's Telegram ID.
         :param date1: the first date of the interval.
         :param date2: the second date of the interval.
-        :return: a list of DocumentSnapshots (still need to be converted to dicts!)
+        :return: a list of entries as dicts.
         """
         if DateFormatter.is_equal(date1, date2):
-            await self.fetch_by_date(user_id, date1, is_exact=True)
+            return await self.fetch_by_date(user_id, date1, is_exact=True)
         else:
-            try:
-                return (
-                    self
-                    .user_entries_ref(user_id)
-                    .order_by('timestamp', direction='ASCENDING')
-                    .start_at({'timestamp': DateFormatter.min_timestamp(date1, date2)})
-                    .end_at({'timestamp': DateFormatter.max_timestamp(date1, date2)})
-                    .get()
-                )
-            except firebase_exceptions.PermissionDeniedError:
-                print('PERMISSION DENIED')
-            except firebase_exceptions.UnavailableError:
-                print('FIRESTORE UNAVAILABLE')
-            except firebase_exceptions.UnknownError:
-                print('UNKNOWN ERROR')
+            start = DateFormatter.min_timestamp(date1, date2)
+            end = DateFormatter.max_timestamp(date1, date2)
+            entries = self._cached_entries(user_id)
+            if entries is not None:
+                return entries.between(start, end)
+            return await self._execute(
+                'fetch_between_dates', self._storage.fetch_between(user_id, start, end)
+            )
 
     async def fetch_after_date(self, user_id: int, date: str) -> list:
         """
         Get all the entries after a specific date.
         :param user_id: the user's Telegram ID.
         :param date: the date to fetch after.
-        :return: a list of DocumentSnapshots (still need to be converted to dicts!)
+        :return: a list of entries as dicts.
         """
-        try:
-            return (
-                self
-                .user_entries_ref(user_id)
-                .order_by('timestamp', direction='ASCENDING')
-                .start_after({'timestamp': DateFormatter.date_to_timestamp(date)})
-                .get()
+        start = DateFormatter.date_to_timestamp(date)
+        entries = self._cached_entries(user_id)
+        if entries is not None:
+            return entries.between(start, include_start=False)
+        return await self._execute(
+            'fetch_after_date', self._storage.fetch_between(user_id, start, include_start=False)
+        )
+
+    async def search(self, user_id: int, query: str, limit: int = 10) -> list:
+        """
+        Find the user's entries by the words in them.
+        :param user_id: the user's Telegram ID.
+        :param query: the words to look for.
+        :param limit: how many entries to return at most.
+        :return: a list of entries as dicts, best match first.
+        """
+        if self._search_index is None:
+            return []
+        if not await self._search_index.is_indexed(user_id):
+            # the first search indexes what's there; from then on the writes keep it up to date
+            await self._search_index.build(user_id, {
+                DateFormatter.timestamp_to_date(entry['timestamp']): entry['text']
+                for entry in await self.fetch_all(user_id)
+            })
+        entry_ids = await self._search_index.search(user_id, query, limit)
+        entries = self._cached_entries(user_id)
+        if entries is not None:
+            found = (
+                entries.get(DateFormatter.date_to_timestamp(entry_id)) for entry_id in entry_ids
             )
-        except firebase_exceptions.PermissionDeniedError:
-            print('PERMISSION DENIED')
-        except firebase_exceptions.UnavailableError:
-            print('FIRESTORE UNAVAILABLE')
-        except firebase_exceptions.UnknownError:
-            print('UNKNOWN ERROR')
+            return [entry for entry in found if entry is not None]
+        fetched = await asyncio.gather(*(
+            self._execute('fetch_by_date', self._storage.fetch_by_id(user_id, entry_id))
+            for entry_id in entry_ids
+        ))
+        return [entry for entries in fetched for entry in entries]
+
+    async def flush(self) -> None:
+        """
+        Commit the queued writes; their users are waiting for them, so do it before exiting.
+        """
+        if self._write_queue is not None:
+            await self._write_queue.close()
+
+    def close(self) -> None:
+        for warming in list(self._warming.values()):
+            warming.cancel()
+        self._storage.close()
+        if self._search_index is not None:
+            self._search_index.close()
+        if self._topic_index is not None:
+            self._topic_index.close()
@@ -0,0 +1,190 @@
+import bisect
+from collections import OrderedDict
+from typing import Optional
+
+
+class UserEntries:
+    # a rough per-entry cost of the dict, its keys and the index, on top of the strings
+    ENTRY_OVERHEAD = 512
+
+    def __init__(self, entries: list):
+        """
+        One user's entries, indexed by timestamp.
+        :param entries: the entries as dicts with timestamp, topic, text and language.
+        """
+        self._entries = {entry['timestamp']: entry for entry in entries}
+        self._timestamps = sorted(self._entries)
+        self.size = sum(self.entry_size(entry) for entry in self._entries.values())
+
+    @classmethod
+    def entry_size(cls, entry: dict) -> int:
+        return (
+            cls.ENTRY_OVERHEAD
+            + len(entry.get('text', '').encode())
+            + len(entry.get('topic', '').encode())
+        )
+
+    def __len__(self) -> int:
+        return len(self._timestamps)
+
+    def add(self, entry: dict) -> int:
+        """
+        :param entry: the entry to add or to replace the one with the same timestamp.
+        :return: how many bytes the entries have grown by.
+        """
+        timestamp = entry['timestamp']
+        growth = self.entry_size(entry)
+        if timestamp in self._entries:
+            growth -= self.entry_size(self._entries[timestamp])
+        else:
+            bisect.insort(self._timestamps, timestamp)
+        self._entries[timestamp] = entry
+        self.size += growth
+        return growth
+
+    def remove(self, timestamp: int) -> int:
+        """
+        :param timestamp: the timestamp of the entry to remove.
+        :return: how many bytes the entries have shrunk by.
+        """
+        entry = self._entries.pop(timestamp, None)
+        if entry is None:
+            return 0
+        del self._timestamps[bisect.bisect_left(self._timestamps, timestamp)]
+        freed = self.entry_size(entry)
+        self.size -= freed
+        return freed
+
+    def get(self, timestamp: int) -> Optional[dict]:
+        return self._entries.get(timestamp)
+
+    def all(self) -> list:
+        return [self._entries[timestamp] for timestamp in self._timestamps]
+
+    def between(
+        self, start: Optional[int] = None, end: Optional[int] = None,
+        include_start: bool = True, include_end: bool = True
+    ) -> list:
+        """
+        :param start: the lowest timestamp, unbounded if None.
+        :param end: the highest timestamp, unbounded if None.
+        :param include_start: whether an entry at exactly start is included.
+        :param include_end: whether an entry at exactly end is included.
+        :return: the entries in the range, oldest first.
+        """
+        low = 0 if start is None else (
+            bisect.bisect_left(self._timestamps, start)
+            if include_start else
+            bisect.bisect_right(self._timestamps, start)
+        )
+        high = len(self._timestamps) if end is None else (
+            bisect.bisect_right(self._timestamps, end)
+            if include_end else
+            bisect.bisect_left(self._timestamps, end)
+        )
+        return [self._entries[timestamp] for timestamp in self._timestamps[low:high]]
+
+    def page(self, after: Optional[int], limit: int) -> list:
+        low = 0 if after is None else bisect.bisect_right(self._timestamps, after)
+        return [self._entries[timestamp] for timestamp in self._timestamps[low:low + limit]]
+
+    def last(self, number: int) -> list:
+        if number <= 0:
+            return []
+        return [self._entries[timestamp] for timestamp in self._timestamps[-number:]]
+
+    def by_topics(self, topics: list) -> list:
+        topics = set(topics)
+        return [entry for entry in self.all() if entry['topic'] in topics]
+
+
+class EntryCache:
+    def __init__(self, max_size: int = 16 * 1024 * 1024):
+        """
+        An in-process cache of the users' entries, so repeated queries don't go to Firestore.
+        :param max_size: roughly how many bytes of entries to keep before evicting the LRU users.
+        """
+        self._max_size = max_size
+        self._users = OrderedDict()
+        self._size = 0
+        # the users whose entries don't fit, so they aren't loaded again and again for nothing
+        self._too_large = set()
+        # bumped on every write, so a load that raced with a write doesn't get cached
+        self.writes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int) -> Optional[UserEntries]:
+        entries = self._users.get(user_id)
+        if entries is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._users.move_to_end(user_id)
+        return entries
+
+    def put(self, user_id: int, entries: list, writes: int) -> UserEntries:
+        """
+        Cache all of a user's entries.
+        :param user_id: the user's Telegram ID.
+        :param entries: all of the user's entries as dicts.
+        :param writes: the value of EntryCache.writes before the entries were loaded.
+        :return: the indexed entries, whether they were cached or not.
+        """
+        user_entries = UserEntries(entries)
+        if user_entries.size > self._max_size:
+            self._too_large.add(user_id)
+        elif writes == self.writes:
+            self.invalidate(user_id)
+            self._users[user_id] = user_entries
+            self._size += user_entries.size
+            self._evict()
+        return user_entries
+
+    def fits(self, user_id: int) -> bool:
+        """
+        :return: False if the user's entries have turned out to be too large to cache.
+        """
+        return user_id not in self._too_large
+
+    def add(self, user_id: int, entry: dict) -> None:
+        self.writes += 1
+        entries = self._users.get(user_id)
+        if entries is not None:
+            self._size += entries.add(entry)
+            self._evict()
+
+    def find(self, user_id: int, timestamp: int) -> Optional[dict]:
+        """
+        Look an entry up without loading the user's entries or counting a hit or a miss.
+        :return: the entry, None if it or the user's entries aren't cached.
+        """
+        entries = self._users.get(user_id)
+        return None if entries is None else entries.get(timestamp)
+
+    def remove(self, user_id: int, timestamp: int) -> None:
+        self.writes += 1
+        # fewer entries may fit now
+        self._too_large.discard(user_id)
+        entries = self._users.get(user_id)
+        if entries is not None:
+            self._size -= entries.remove(timestamp)
+
+    def invalidate(self, user_id: int) -> None:
+        entries = self._users.pop(user_id, None)
+        if entries is not None:
+            self._size -= entries.size
+
+    def _evict(self) -> None:
+        while self._size > self._max_size and self._users:
+            _, entries = self._users.popitem(last=False)
+            self._size -= entries.size
+
+    def stats(self) -> dict:
+        return dict(
+            users=len(self._users),
+            size=self._size,
+            too_large=len(self._too_large),
+            hits=self.hits,
+            misses=self.misses,
+        )
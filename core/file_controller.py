@@ -1,24 +1,147 @@
+import asyncio
 import os
-import subprocess
-import time
+from typing import Optional
+
+
+class ConversionError(Exception):
+    pass
+
+
+class AudioClip:
+    LINEAR16 = 'LINEAR16'
+    OGG_OPUS = 'OGG_OPUS'
+
+    def __init__(
+        self,
+        content: bytes, encoding: str, sample_rate: int, channels: int = 1,
+        sample_width: int = 2, duration: Optional[float] = None, file_id: Optional[str] = None
+    ):
+        self.content = content
+        self.encoding = encoding
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self._duration = duration
+        # Telegram's file_unique_id of the voice message this clip came from
+        self.file_id = file_id
+
+    @property
+    def duration(self) -> float:
+        if self._duration is None and self.encoding == AudioClip.LINEAR16:
+            # raw PCM: the duration can be derived from its size
+            return len(self.content) / (self.sample_rate * self.channels * self.sample_width)
+        return self._duration or 0.0
+
+    def __len__(self) -> int:
+        return len(self.content)
 
 
 class FileController:
+    # Telegram voice notes are 48 kHz mono Opus
+    OPUS_SAMPLE_RATE = 48000
+    # speech models work at 16 kHz mono; anything more is just extra bytes to upload
+    PCM_SAMPLE_RATE = 16000
+    PCM_CHANNELS = 1
+
+    _conversion_slots: Optional[asyncio.Semaphore] = None
+
     @classmethod
-    def convert_ogg_to_wav(cls, filename: str) -> str:
-        if not os.path.exists(f'{filename}.wav'):
-            # convert ogg to wav using ffmpeg
-            subprocess.Popen(
-                ['ffmpeg', '-i', f'{filename}.ogg', f'{filename}.wav', '-loglevel', 'quiet']
+    def _slots(cls) -> asyncio.Semaphore:
+        # created lazily so that .env is already loaded and it binds to the running loop
+        if cls._conversion_slots is None:
+            cls._conversion_slots = asyncio.Semaphore(int(os.getenv('FFMPEG_MAX_PROCESSES', 4)))
+        return cls._conversion_slots
+
+    @classmethod
+    def _timeout(cls) -> float:
+        return float(os.getenv('FFMPEG_TIMEOUT', 30))
+
+    @classmethod
+    async def _run_ffmpeg(
+        cls, args: list, stdin: Optional[bytes] = None, timeout: Optional[float] = None
+    ) -> bytes:
+        """
+        Run ffmpeg, feed it stdin and wait for it to exit.
+        :param args: ffmpeg arguments, without the executable itself.
+        :param stdin: the bytes to pipe into ffmpeg.
+        :param timeout: seconds to wait for ffmpeg; defaults to FFMPEG_TIMEOUT.
+        :return: whatever ffmpeg wrote to stdout.
+        """
+        timeout = cls._timeout() if timeout is None else timeout
+        async with cls._slots():
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    'ffmpeg', '-hide_banner', '-loglevel', 'error', *args,
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+            except OSError as e:
+                raise ConversionError(f'unable to start ffmpeg: {e}') from e
+
+            try:
+                stdout, stderr = await asyncio.wait_for(
+                    process.communicate(input=stdin), timeout=timeout
+                )
+            except asyncio.TimeoutError:
+                await cls._kill(process)
+                raise ConversionError(f'ffmpeg timed out after {timeout}s')
+            except asyncio.CancelledError:
+                await cls._kill(process)
+                raise
+
+        if process.returncode != 0:
+            raise ConversionError(
+                f'ffmpeg exited with code {process.returncode}: '
+                f'{stderr.decode(errors="replace").strip()}'
             )
-            # wait before it updates the list of files
-            time.sleep(1.5)
-        return filename
+        return stdout
+
+    @classmethod
+    async def _kill(cls, process: asyncio.subprocess.Process) -> None:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+    @classmethod
+    async def convert_for(
+        cls, audio: AudioClip, encodings: tuple, timeout: Optional[float] = None
+    ) -> AudioClip:
+        """
+        Pass the audio through untouched if the recognizer accepts its encoding, decode otherwise.
+        :param audio: the voice message as it came from Telegram.
+        :param encodings: the encodings the recognizer accepts.
+        :param timeout: seconds to wait for ffmpeg; defaults to FFMPEG_TIMEOUT.
+        :return: a clip in one of the accepted encodings.
+        """
+        if audio.encoding in encodings:
+            return audio
+        return await cls.decode_to_pcm(audio, timeout=timeout)
 
     @classmethod
-    def remove_files(cls, filename: str) -> bool:
-        if os.path.exists(f'{filename}.ogg'):
-            os.remove(f'{filename}.ogg')
-        if os.path.exists(f'{filename}.wav'):
-            os.remove(f'{filename}.wav')
-        return True
+    async def decode_to_pcm(cls, audio: AudioClip, timeout: Optional[float] = None) -> AudioClip:
+        """
+        Decode a voice message to raw PCM, piping it through ffmpeg without touching the disk.
+        :param audio: the voice message as it came from Telegram.
+        :param timeout: seconds to wait for ffmpeg; defaults to FFMPEG_TIMEOUT.
+        :return: a LINEAR16 clip.
+        """
+        if audio.encoding == AudioClip.LINEAR16:
+            return audio
+        pcm = await cls._run_ffmpeg(
+            [
+                '-i', 'pipe:0',
+                '-f', 's16le', '-acodec', 'pcm_s16le',
+                '-ac', f'{cls.PCM_CHANNELS}', '-ar', f'{cls.PCM_SAMPLE_RATE}',
+                'pipe:1',
+            ],
+            stdin=audio.content, timeout=timeout
+        )
+        if not pcm:
+            raise ConversionError('ffmpeg produced no audio')
+        return AudioClip(
+            content=pcm,
+            encoding=AudioClip.LINEAR16,
+            sample_rate=cls.PCM_SAMPLE_RATE,
+            channels=cls.PCM_CHANNELS,
+        )
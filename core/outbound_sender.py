@@ -0,0 +1,226 @@
+import asyncio
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import (
+    Awaitable,
+    BinaryIO,
+    Callable,
+    Optional,
+)
+
+from aiogram import types
+from aiogram.utils.exceptions import RetryAfter
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        """
+        :param rate: tokens added per second.
+        :param capacity: the most tokens it holds, i.e. the longest burst.
+        """
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock: Optional[asyncio.Lock] = None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+    @property
+    def is_full(self) -> bool:
+        self._refill()
+        return self._tokens >= self._capacity
+
+    async def acquire(self) -> None:
+        """
+        Take a token, waiting for one if there's none; the waiters are served in order.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+                self._refill()
+            self._tokens -= 1
+
+
+class OutboundSender:
+    # Telegram's limit on the length of a message's text
+    MAX_MESSAGE_LENGTH = 4096
+    # how many times a message is retried after Telegram asks to slow down
+    MAX_RETRIES = 3
+    # blocks packed into one message are separated by this
+    SEPARATOR = '\n\n'
+    # chat buckets kept around; the idle ones are forgotten first
+    MAX_CHATS = 10000
+
+    TAG_REGEX = re.compile(r'<(/?)([a-zA-Z-]+)[^>]*>')
+    # tags, entities, whitespace and words: a message is never cut inside of any but the last
+    TOKEN_REGEX = re.compile(r'<[^>]*>|&#?\w+;|\s+|[^<&\s]+|.', re.DOTALL)
+
+    def __init__(
+        self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3
+    ):
+        """
+        Sends the bot's replies no faster than Telegram allows and retries the ones it refuses.
+        :param global_rate: messages per second the bot sends at most.
+        :param chat_rate: messages per second one chat gets at most.
+        :param chat_burst: messages one chat can get at once before chat_rate kicks in.
+        """
+        self._global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chat_buckets = OrderedDict()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+            if len(self._chat_buckets) > self.MAX_CHATS:
+                # a full bucket behaves just like a new one, so it's safe to forget
+                for idle_chat_id, idle_bucket in list(self._chat_buckets.items()):
+                    if idle_bucket.is_full and idle_chat_id != chat_id:
+                        del self._chat_buckets[idle_chat_id]
+        self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def reply(
+        self, msg: types.Message, text: str,
+        reply_markup=None, parse_mode: Optional[str] = None
+    ) -> types.Message:
+        """
+        Reply to the message once both the chat and the bot have a token to spend.
+        :param msg: the message to reply to.
+        :param text: the text of the reply.
+        :param reply_markup: the keyboard to attach.
+        :param parse_mode: the parse mode of the text.
+        :return: the sent message.
+        """
+        return await self._send(
+            msg.chat.id,
+            lambda: msg.reply(text, reply_markup=reply_markup, parse_mode=parse_mode)
+        )
+
+    async def reply_document(
+        self, msg: types.Message, file: BinaryIO, filename: str, reply_markup=None
+    ) -> types.Message:
+        """
+        Reply to the message with a file, paced just like the text replies.
+        :param msg: the message to reply to.
+        :param file: the file to upload, read from its beginning.
+        :param filename: the name the user sees.
+        :param reply_markup: the keyboard to attach.
+        :return: the sent message.
+        """
+        def upload() -> Awaitable[types.Message]:
+            # a retry has to upload the whole file again
+            file.seek(0)
+            return msg.reply_document(
+                types.InputFile(file, filename=filename), reply_markup=reply_markup
+            )
+
+        return await self._send(msg.chat.id, upload)
+
+    async def _send(
+        self, chat_id: int, send: Callable[[], Awaitable[types.Message]]
+    ) -> types.Message:
+        for attempt in range(self.MAX_RETRIES + 1):
+            await self._chat_bucket(chat_id).acquire()
+            await self._global_bucket.acquire()
+            try:
+                return await send()
+            except RetryAfter as e:
+                if attempt == self.MAX_RETRIES:
+                    raise
+                logger.warning('flood control in chat %s, retrying in %ss', chat_id, e.timeout)
+                await asyncio.sleep(e.timeout)
+
+    @classmethod
+    def pack(cls, blocks: list, limit: int = MAX_MESSAGE_LENGTH) -> list:
+        """
+        Pack HTML blocks into as few messages as possible.
+        :param blocks: the blocks in order, e.g. formatted entries.
+        :param limit: the longest message allowed.
+        :return: the messages; a block is split only if it doesn't fit into a message by itself.
+        """
+        messages, current = [], ''
+        for block in blocks:
+            for part in cls.split_html(block, limit):
+                if current and len(current) + len(cls.SEPARATOR) + len(part) <= limit:
+                    current += cls.SEPARATOR + part
+                else:
+                    if current:
+                        messages.append(current)
+                    current = part
+        if current:
+            messages.append(current)
+        return messages
+
+    @classmethod
+    def split_html(cls, text: str, limit: int = MAX_MESSAGE_LENGTH) -> list:
+        """
+        Split HTML into parts no longer than limit, closing the tags open at every cut
+        and opening them again in the next part.
+        :param text: Telegram HTML: simple tags, escaped text.
+        :param limit: the longest part allowed.
+        :return: the parts, each valid HTML by itself.
+        """
+        parts = []
+        while len(text) > limit:
+            cut, open_tags = cls._find_cut(text, limit)
+            closing = ''.join(f'</{name}>' for name, _ in reversed(open_tags))
+            opening = ''.join(tag for _, tag in open_tags)
+            parts.append(text[:cut].rstrip() + closing)
+            text = opening + text[cut:].lstrip()
+        parts.append(text)
+        return parts
+
+    @classmethod
+    def _find_cut(cls, text: str, limit: int) -> (int, list):
+        """
+        :return: where to cut the text and the tags open there, as (name, opening tag) pairs.
+        """
+        open_tags, cut, cut_tags, has_text, has_content = [], 0, [], False, False
+        # the end of any word or entity, for when there's no better cut
+        fallback, fallback_tags = 0, []
+        for token in cls.TOKEN_REGEX.finditer(text):
+            closing_length = sum(len(name) + 3 for name, _ in open_tags)
+            if token.start() + closing_length > limit:
+                break
+            value = token.group(0)
+            if value.isspace():
+                if has_text:
+                    cut, cut_tags = token.start(), list(open_tags)
+                has_content = True
+                continue
+            if token.end() + closing_length > limit and not cut and value[0] not in '<&':
+                # a single word longer than the limit has to be cut through
+                if limit - closing_length > token.start():
+                    return limit - closing_length, list(open_tags)
+                break
+            tag = cls.TAG_REGEX.fullmatch(value)
+            if tag is not None:
+                closing, name = tag.group(1), tag.group(2).lower()
+                if not closing:
+                    open_tags.append((name, value))
+                elif open_tags and open_tags[-1][0] == name:
+                    open_tags.pop()
+                closing_length = sum(len(name) + 3 for name, _ in open_tags)
+                if has_content and token.end() + closing_length <= limit:
+                    cut, cut_tags = token.end(), list(open_tags)
+            else:
+                has_text = has_content = True
+                if token.end() + closing_length <= limit:
+                    fallback, fallback_tags = token.end(), list(open_tags)
+        if cut:
+            return cut, cut_tags
+        return (fallback, fallback_tags) if fallback else (limit, [])
@@ -0,0 +1,129 @@
+import logging
+import threading
+import time
+from typing import Optional
+
+from core.recognize_controller import (
+    AbstractSpeechRecognizer,
+    RecognitionController,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+class RecognitionBackendError(Exception):
+    pass
+
+
+class BackendHealth:
+    def __init__(self):
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        # while the circuit is open, the backend gets no jobs until this moment
+        self.open_until: Optional[float] = None
+
+    def is_available(self, now: float) -> bool:
+        return self.open_until is None or now >= self.open_until
+
+    def to_dict(self) -> dict:
+        return dict(
+            latency=self.latency,
+            error_rate=self.error_rate,
+            consecutive_failures=self.consecutive_failures,
+            open=self.open_until is not None and time.monotonic() < self.open_until,
+        )
+
+
+class RecognitionRouter:
+    def __init__(
+        self, backends: tuple = ('s2t', 'gapi'), alpha: float = 0.2,
+        failure_threshold: int = 3, cooldown: float = 60
+    ):
+        """
+        Sends recognition jobs to the healthiest and fastest backend.
+        :param backends: recognition types in the order of preference.
+        :param alpha: the weight of the newest sample in the latency and error rate EWMAs.
+        :param failure_threshold: consecutive failures that open a backend's circuit.
+        :param cooldown: seconds an open circuit waits before it lets jobs through again.
+        """
+        self._backends = backends
+        self._alpha = alpha
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+        self._health = {backend: BackendHealth() for backend in backends}
+        self._lock = threading.Lock()
+
+    def _score(self, backend: str) -> float:
+        health = self._health[backend]
+        if health.latency is None:
+            # never measured: worth a try
+            return 0.0
+        # the expected time until a successful transcription
+        return health.latency / max(1 - health.error_rate, 0.05)
+
+    def candidates(self, exclude: tuple = ()) -> list:
+        """
+        :param exclude: the backends not to consider.
+        :return: the backends to try, best first; open circuits only if nothing else is left.
+        """
+        now = time.monotonic()
+        backends = [b for b in self._backends if b not in exclude]
+        with self._lock:
+            available = [b for b in backends if self._health[b].is_available(now)]
+            if not available:
+                # everything is failing, so try whatever is going to recover first
+                return sorted(backends, key=lambda b: self._health[b].open_until)
+            return sorted(available, key=self._score)
+
+    def recognizer(self, exclude: tuple = ()) -> AbstractSpeechRecognizer:
+        """
+        Pick the recognizer for a new job; backends that can't even be set up are skipped.
+        :param exclude: the backends not to consider, e.g. the ones that have just failed.
+        :return: the recognizer of the best available backend.
+        """
+        for backend in self.candidates(exclude):
+            try:
+                return RecognitionController.strategy(recognition_type=backend)
+            except RecognitionController.recognizer_class(backend).BACKEND_ERRORS as e:
+                logger.warning('unable to set up %s: %s', backend, e)
+                self.record_failure(backend, permanent=True)
+        raise RecognitionBackendError('no recognition backend is available')
+
+    def record_success(self, backend: str, latency: float) -> None:
+        with self._lock:
+            health = self._health[backend]
+            health.latency = (
+                latency if health.latency is None else
+                self._alpha * latency + (1 - self._alpha) * health.latency
+            )
+            health.error_rate = (1 - self._alpha) * health.error_rate
+            health.consecutive_failures = 0
+            health.open_until = None
+
+    def record_failure(
+        self, backend: str, latency: Optional[float] = None, permanent: bool = False
+    ) -> None:
+        """
+        :param backend: the recognition type that failed.
+        :param latency: how long it took to fail, if it failed on a request.
+        :param permanent: a configuration or permission problem that won't go away on a retry.
+        """
+        with self._lock:
+            health = self._health[backend]
+            if latency is not None and health.latency is not None:
+                health.latency = self._alpha * latency + (1 - self._alpha) * health.latency
+            health.error_rate = self._alpha + (1 - self._alpha) * health.error_rate
+            health.consecutive_failures += 1
+            if permanent or health.consecutive_failures >= self._failure_threshold:
+                if health.open_until is None or time.monotonic() >= health.open_until:
+                    logger.warning(
+                        'opening the circuit of %s for %ss after %d failures',
+                        backend, self._cooldown, health.consecutive_failures
+                    )
+                health.open_until = time.monotonic() + self._cooldown
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {backend: health.to_dict() for backend, health in self._health.items()}
@@ -0,0 +1,341 @@
+import asyncio
+import contextlib
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from core.audio_processor import AudioProcessor
+from core.file_controller import (
+    AudioClip,
+    FileController,
+)
+from core.recognition_router import (
+    RecognitionBackendError,
+    RecognitionRouter,
+)
+from core.recognize_controller import (
+    AbstractLongRunningRecognizer,
+    AbstractSpeechRecognizer,
+    Transcription,
+)
+from core.transcription_cache import TranscriptionCache
+
+
+logger = logging.getLogger(__name__)
+
+
+class RecognitionBusyError(Exception):
+    pass
+
+
+class RecognitionTimeoutError(Exception):
+    pass
+
+
+class Admission:
+    def __init__(self):
+        """
+        A message's place in the recognition queue: it's taken once for all of the message's jobs
+        and only given back once the last of them is done.
+        """
+        self.jobs = 0
+        self.closed = False
+
+
+class RecognitionService:
+    # seconds between the checks of a long-running recognition
+    POLL_INTERVAL = 2
+
+    def __init__(
+        self, max_workers: int = 4, max_queue: int = 16, timeout: float = 60,
+        segment_duration: Optional[float] = None, vad_threshold: Optional[float] = None,
+        cache: Optional[TranscriptionCache] = None, router: Optional[RecognitionRouter] = None
+    ):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='recognition'
+        )
+        self._max_workers = max_workers
+        self._max_queue = max_queue
+        self._timeout = timeout
+        # long messages are split at pauses into segments of at most this many seconds
+        self._segment_duration = segment_duration
+        # frames quieter than this many dBFS are trimmed before upload; None keeps the audio as is
+        self._vad_threshold = vad_threshold
+        self._cache = cache
+        # gets to know how fast and reliable every backend is
+        self._router = router
+
+        self._lock = threading.Lock()
+        # the messages let in, each with as many jobs as it needs
+        self._admitted = 0
+        self._in_flight = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._wait_times = deque(maxlen=100)
+
+    @property
+    def queue_depth(self) -> int:
+        return max(0, self._in_flight - self._max_workers)
+
+    def stats(self) -> dict:
+        wait_times = list(self._wait_times)
+        return dict(
+            admitted=self._admitted,
+            in_flight=self._in_flight,
+            queue_depth=self.queue_depth,
+            rejected=self._rejected,
+            timed_out=self._timed_out,
+            avg_wait=sum(wait_times) / len(wait_times) if wait_times else 0.0,
+            max_wait=max(wait_times, default=0.0),
+        )
+
+    @contextlib.contextmanager
+    def admit(self):
+        """
+        Let a message into the queue, or refuse it when the queue is full.
+        :return: the admission to run the message's jobs with.
+        """
+        with self._lock:
+            if self._admitted >= self._max_workers + self._max_queue:
+                self._rejected += 1
+                raise RecognitionBusyError(f'{self._admitted} recognition jobs in flight')
+            self._admitted += 1
+        admission = Admission()
+        try:
+            yield admission
+        finally:
+            self._release(admission)
+
+    def _release(self, admission: Admission, job_done: bool = False) -> None:
+        with self._lock:
+            if job_done:
+                admission.jobs -= 1
+                self._in_flight -= 1
+            else:
+                admission.closed = True
+            if admission.closed and not admission.jobs:
+                self._admitted -= 1
+
+    async def run(
+        self, func, *args, timeout: Optional[float] = None,
+        admission: Optional[Admission] = None
+    ):
+        """
+        Run a blocking call in the pool.
+        :param func: the blocking function.
+        :param args: its arguments.
+        :param timeout: the job's deadline in seconds, including the time spent in the queue;
+        defaults to the service's timeout.
+        :param admission: the admission of the message the job is part of; without one,
+        the job has to be let in by itself.
+        :return: whatever func returns.
+        """
+        if admission is None:
+            with self.admit() as admission:
+                return await self.run(func, *args, timeout=timeout, admission=admission)
+
+        timeout = timeout or self._timeout
+        with self._lock:
+            admission.jobs += 1
+            self._in_flight += 1
+
+        enqueued_at = time.monotonic()
+
+        def job():
+            waited = time.monotonic() - enqueued_at
+            self._wait_times.append(waited)
+            logger.debug(
+                'recognition job started after %.3fs, queue depth %d', waited, self.queue_depth
+            )
+            return func(*args)
+
+        future = self._executor.submit(job)
+        future.add_done_callback(lambda _: self._release(admission, job_done=True))
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout=timeout)
+        except asyncio.TimeoutError:
+            # a job that hasn't started yet is dropped; a running one can't be interrupted,
+            # but its message keeps its place until it finishes, so the pool can't be oversubscribed
+            future.cancel()
+            self._timed_out += 1
+            raise RecognitionTimeoutError(f'recognition took longer than {timeout}s')
+
+    async def transcribe(
+        self, recognizer: AbstractSpeechRecognizer, audio: AudioClip, language: str = None
+    ) -> Transcription:
+        """
+        Convert the voice message as needed and recognize it, segment by segment if it's long.
+        :param recognizer: the recognizer to use.
+        :param audio: the voice message as it came from Telegram.
+        :param language: the language of the message, if the recognizer needs one.
+        :return: the transcription of the whole message.
+        """
+        if self._cache is None:
+            return await self._transcribe(recognizer, audio, language)
+
+        content_hash = TranscriptionCache.hash(audio.content)
+        transcription = await self._cache.get(content_hash, file_unique_id=audio.file_id)
+        if transcription is None:
+            transcription = await self._transcribe(recognizer, audio, language)
+            if transcription.text:
+                await self._cache.put(content_hash, transcription, file_unique_id=audio.file_id)
+        else:
+            logger.debug('transcription of %s served from the cache', audio.file_id)
+        return transcription
+
+    async def _transcribe(
+        self, recognizer: AbstractSpeechRecognizer, audio: AudioClip, language: str = None
+    ) -> Transcription:
+        # the message is let in once, so its segments can't crowd the others out of the queue
+        with self.admit() as admission:
+            return await self._transcribe_admitted(recognizer, audio, language, admission)
+
+    async def _transcribe_admitted(
+        self, recognizer: AbstractSpeechRecognizer, audio: AudioClip, language: Optional[str],
+        admission: Admission
+    ) -> Transcription:
+        if self._vad_threshold is not None:
+            audio = await self.preprocess(audio)
+            if not len(audio):
+                return Transcription()
+
+        if not self._segment_duration or audio.duration <= self._segment_duration:
+            audio = await FileController.convert_for(audio, recognizer.SUPPORTED_ENCODINGS)
+            return await self.recognize(recognizer, audio, language, admission=admission)
+
+        audio = await FileController.decode_to_pcm(audio)
+        segments = await asyncio.get_running_loop().run_in_executor(
+            None, AudioProcessor.split_on_silence, audio, self._segment_duration,
+            self._vad_threshold
+        )
+        logger.debug('recognizing %d segments of a %.1fs message', len(segments), audio.duration)
+        jobs = [
+            asyncio.ensure_future(
+                self.recognize(recognizer, segment, language, admission=admission)
+            )
+            for segment in segments
+        ]
+        try:
+            return Transcription.join(await asyncio.gather(*jobs))
+        except BaseException:
+            # one failed segment fails the whole message, so the rest is wasted work
+            for job in jobs:
+                job.cancel()
+            raise
+
+    async def preprocess(self, audio: AudioClip) -> AudioClip:
+        """
+        Decode the audio to 16 kHz mono PCM and trim the silence out of it.
+        :param audio: the voice message as it came from Telegram.
+        :return: a LINEAR16 clip without the dead air.
+        """
+        original_size, original_duration = len(audio), audio.duration
+        audio = await FileController.decode_to_pcm(audio)
+        decoded_size = len(audio)
+        audio = await asyncio.get_running_loop().run_in_executor(
+            None, AudioProcessor.trim_silence, audio, self._vad_threshold
+        )
+        logger.info(
+            'trimmed %.1fs of silence from a %.1fs message, %d of %d PCM bytes saved '
+            '(%d bytes as received)',
+            original_duration - audio.duration, original_duration,
+            decoded_size - len(audio), decoded_size, original_size,
+        )
+        return audio
+
+    async def recognize(
+        self, recognizer: AbstractSpeechRecognizer, audio: AudioClip, language: str = None,
+        timeout: Optional[float] = None, admission: Optional[Admission] = None
+    ) -> Transcription:
+        if admission is None:
+            with self.admit() as admission:
+                return await self.recognize(
+                    recognizer, audio, language, timeout=timeout, admission=admission
+                )
+
+        # long messages can't be transcribed within the default deadline
+        timeout = timeout or max(self._timeout, audio.duration)
+        started_at = time.monotonic()
+        try:
+            if recognizer.is_long_running(audio):
+                transcription = await self._recognize_long_running(
+                    recognizer, audio, timeout, admission
+                )
+            elif language is None:
+                transcription = await self.run(
+                    recognizer.recognize, audio, timeout=timeout, admission=admission
+                )
+            else:
+                transcription = await self.run(
+                    recognizer.recognize, audio, language, timeout=timeout, admission=admission
+                )
+        except RecognitionTimeoutError:
+            self._record_failure(recognizer, started_at)
+            raise
+        except recognizer.BACKEND_ERRORS as e:
+            self._record_failure(
+                recognizer, started_at, permanent=isinstance(e, recognizer.CONFIGURATION_ERRORS)
+            )
+            raise RecognitionBackendError(f'{recognizer.NAME} failed: {e}') from e
+
+        if self._router is not None:
+            self._router.record_success(recognizer.NAME, time.monotonic() - started_at)
+        return transcription
+
+    def _record_failure(
+        self, recognizer: AbstractSpeechRecognizer, started_at: float, permanent: bool = False
+    ) -> None:
+        if self._router is not None:
+            self._router.record_failure(
+                recognizer.NAME, time.monotonic() - started_at, permanent=permanent
+            )
+
+    async def _recognize_long_running(
+        self, recognizer: AbstractLongRunningRecognizer, audio: AudioClip, timeout: float,
+        admission: Admission
+    ) -> Transcription:
+        """
+        Start a long-running recognition and poll it without holding a worker in between.
+        :param recognizer: the recognizer that supports long-running operations.
+        :param audio: the audio to recognize.
+        :param timeout: the deadline for the whole operation in seconds.
+        :param admission: the admission of the message, which every job of the operation shares.
+        :return: whatever the recognizer parses out of the operation's response.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        operation = await self.run(
+            recognizer.start_long_running, audio, timeout=timeout, admission=admission
+        )
+        try:
+            # every check is a job like any other, so it waits for a worker and counts against
+            # the deadline
+            while not await self.run(
+                operation.done, timeout=max(deadline - loop.time(), 0.1), admission=admission
+            ):
+                if loop.time() + self.POLL_INTERVAL > deadline:
+                    self._timed_out += 1
+                    raise RecognitionTimeoutError(f'recognition took longer than {timeout}s')
+                await asyncio.sleep(self.POLL_INTERVAL)
+        except BaseException:
+            # nobody is going to read the result, so the backend may as well stop working on it
+            loop.run_in_executor(None, self._cancel_operation, operation)
+            raise
+        return recognizer.parse_response(
+            await self.run(operation.result, timeout=timeout, admission=admission)
+        )
+
+    @staticmethod
+    def _cancel_operation(operation) -> None:
+        try:
+            operation.cancel()
+        except Exception as e:
+            logger.warning('could not cancel a long-running recognition: %s', e)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        if self._cache is not None:
+            self._cache.close()
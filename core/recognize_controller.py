@@ -1,51 +1,258 @@
+import asyncio
+import datetime
 import os
-import wave
+import threading
 from abc import (
     ABC,
     abstractmethod,
 )
+from concurrent.futures import ThreadPoolExecutor
 
+import google.api_core.exceptions as google_api_exc
+import google.auth.exceptions as google_auth_exc
+import google.auth.transport.requests
 import speech_recognition as speech_recognition_google_api
 from google.cloud import speech_v1p1beta1 as speech_recognition_s2t_api
+from google.oauth2 import service_account
+
+from core.file_controller import AudioClip
+
+
+class Transcription:
+    def __init__(self, text: str = '', languages: dict = None, confidence: float = 0.0):
+        self.text = text
+        # how many recognized phrases came in each language
+        self.languages = languages or {}
+        self.confidence = confidence
+
+    @property
+    def language(self) -> str:
+        return max(self.languages, key=self.languages.get) if self.languages else ''
+
+    @classmethod
+    def join(cls, parts: list) -> 'Transcription':
+        """
+        Stitch the transcriptions of consecutive segments together.
+        :param parts: the segments' transcriptions, in order.
+        :return: a single transcription with the language tallies summed up.
+        """
+        languages = {}
+        for part in parts:
+            for language, count in part.languages.items():
+                languages[language] = languages.get(language, 0) + count
+        total_len = sum(len(part.text) for part in parts)
+        return cls(
+            text=' '.join(part.text for part in parts if part.text),
+            languages=languages,
+            # longer segments weigh more
+            confidence=(
+                sum(part.confidence * len(part.text) for part in parts) / total_len
+                if total_len else 0.0
+            ),
+        )
 
 
 class AbstractSpeechRecognizer(ABC):
+    NAME = ''
+    SUPPORTED_ENCODINGS = (AudioClip.LINEAR16,)
+    # errors that mean the backend failed, as opposed to a problem with the audio
+    BACKEND_ERRORS = ()
+    # backend errors that won't go away on a retry
+    CONFIGURATION_ERRORS = ()
+
     @abstractmethod
-    def recognize(self, file_path: str, language: str = None):
+    def recognize(self, audio: AudioClip, language: str = None) -> Transcription:
+        pass
+
+    def is_long_running(self, audio: AudioClip) -> bool:
+        return False
+
+    def refresh_credentials(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class AbstractLongRunningRecognizer(AbstractSpeechRecognizer):
+    # for the backends that can take the audio now and give the transcription later
+
+    @abstractmethod
+    def is_long_running(self, audio: AudioClip) -> bool:
+        pass
+
+    @abstractmethod
+    def start_long_running(self, audio: AudioClip):
+        """
+        :param audio: the audio to recognize.
+        :return: the operation to poll, with done(), result() and cancel().
+        """
+
+    @abstractmethod
+    def parse_response(self, response) -> Transcription:
         pass
 
 
 class RecognitionController:
+    # recognizers are expensive to build (credentials, gRPC channel), so they live per process
+    _recognizers = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def strategy(cls, recognition_type) -> AbstractSpeechRecognizer:
+        recognizer = cls._recognizers.get(recognition_type)
+        if recognizer is None:
+            with cls._lock:
+                recognizer = cls._recognizers.get(recognition_type)
+                if recognizer is None:
+                    recognizer = cls._create(recognition_type)
+                    cls._recognizers[recognition_type] = recognizer
+        return recognizer
+
     @staticmethod
-    def strategy(recognition_type) -> AbstractSpeechRecognizer:
+    def recognizer_class(recognition_type) -> type:
         if recognition_type == 'gapi':
-            return GoogleApiRecognizer()
+            return GoogleApiRecognizer
         elif recognition_type == 's2t':
-            return SpeechToTextApiRecognitionController()
+            return SpeechToTextApiRecognitionController
+
+    @classmethod
+    def _create(cls, recognition_type) -> AbstractSpeechRecognizer:
+        return cls.recognizer_class(recognition_type)()
+
+    @classmethod
+    async def keep_credentials_fresh(cls, interval: float = 60) -> None:
+        """
+        Refresh the recognizers' credentials before they expire, so it never happens mid-request.
+        :param interval: seconds between the checks.
+        :return: none, runs until cancelled.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            for recognizer in list(cls._recognizers.values()):
+                try:
+                    await loop.run_in_executor(None, recognizer.refresh_credentials)
+                except google_auth_exc.GoogleAuthError:
+                    # the channel will retry on its own with the next request
+                    pass
+            await asyncio.sleep(interval)
+
+    @classmethod
+    def shutdown(cls) -> None:
+        with cls._lock:
+            for recognizer in cls._recognizers.values():
+                recognizer.close()
+            cls._recognizers.clear()
+
+
+class SharedFlacAudioData(speech_recognition_google_api.AudioData):
+    # recognize_google encodes the audio to FLAC on every call; with several languages
+    # recognizing the same audio, it only has to be done once
+    def __init__(self, frame_data: bytes, sample_rate: int, sample_width: int):
+        super().__init__(frame_data, sample_rate, sample_width)
+        self._flac = {}
+        self._flac_lock = threading.Lock()
+
+    def get_flac_data(self, convert_rate=None, convert_width=None) -> bytes:
+        with self._flac_lock:
+            key = (convert_rate, convert_width)
+            if key not in self._flac:
+                self._flac[key] = super().get_flac_data(convert_rate, convert_width)
+            return self._flac[key]
 
 
 class GoogleApiRecognizer(AbstractSpeechRecognizer):
+    NAME = 'gapi'
+    BACKEND_ERRORS = (speech_recognition_google_api.RequestError,)
+    # without a language given, the audio is recognized in all of these and the best one wins
+    LANGUAGES = ('en-US', 'uk-UA')
+
     def __init__(self):
         self.api_ref = speech_recognition_google_api
         self.client = self.api_ref.Recognizer()
+        # the requests are just HTTP calls, so every language gets a thread of its own
+        self._languages_executor = ThreadPoolExecutor(thread_name_prefix='gapi-language')
 
-    def recognize(self, file_path: str, language: str = 'en-US') -> str:
-        if os.path.isfile(file_path):
-            with self.api_ref.AudioFile(file_path) as src:
-                audio_data = self.client.record(src)
+    def recognize(self, audio: AudioClip, language: str = None) -> Transcription:
+        if audio.encoding in self.SUPPORTED_ENCODINGS:
+            audio_data = SharedFlacAudioData(audio.content, audio.sample_rate, audio.sample_width)
+            if language is not None:
+                return self._recognize(audio_data, language)
+
+            futures = [
+                self._languages_executor.submit(self._recognize, audio_data, language)
+                for language in self.LANGUAGES
+            ]
+            transcriptions, errors = [], []
+            for future in futures:
                 try:
-                    transcript = self.client.recognize_google(audio_data, language=language)
-                except speech_recognition_google_api.UnknownValueError:
-                    transcript = ''
-            return transcript
+                    transcriptions.append(future.result())
+                except self.BACKEND_ERRORS as e:
+                    errors.append(e)
+            if not transcriptions:
+                raise errors[0]
+            return max(transcriptions, key=lambda t: (bool(t.text), t.confidence))
         else:
-            raise Exception('SERVER ERROR')
+            raise ValueError(f'{audio.encoding} audio is not supported by {type(self).__name__}')
+
+    def _recognize(self, audio_data: SharedFlacAudioData, language: str) -> Transcription:
+        result = self.client.recognize_google(audio_data, language=language, show_all=True)
+        # an empty list comes back when nothing was recognized
+        alternatives = result.get('alternative', []) if isinstance(result, dict) else []
+        if not alternatives:
+            return Transcription(languages={language: 1})
+        best = max(alternatives, key=lambda alternative: alternative.get('confidence', 0.0))
+        return Transcription(
+            text=best.get('transcript', ''),
+            languages={language: 1},
+            confidence=best.get('confidence', 0.0),
+        )
+
+    def close(self) -> None:
+        self._languages_executor.shutdown(wait=False, cancel_futures=True)
+
 
+class SpeechToTextApiRecognitionController(AbstractLongRunningRecognizer):
+    NAME = 's2t'
+    BACKEND_ERRORS = (google_api_exc.GoogleAPICallError, google_auth_exc.GoogleAuthError)
+    CONFIGURATION_ERRORS = (
+        google_api_exc.PermissionDenied,
+        google_api_exc.Unauthenticated,
+        google_auth_exc.GoogleAuthError,
+    )
+    # Telegram voice notes are OGG/Opus already, so they can be uploaded as they are
+    SUPPORTED_ENCODINGS = (AudioClip.OGG_OPUS, AudioClip.LINEAR16)
+
+    # synchronous recognize only takes up to a minute of audio, streaming up to five;
+    # anything longer goes through long_running_recognize. RecognitionService splits messages
+    # into 50 s segments by default, so these two are only used with the splitting turned off
+    SYNC_MAX_DURATION = 60
+    STREAMING_MAX_DURATION = 300
+    # how much audio goes into a single streaming request
+    CHUNK_SIZE = 32 * 1024
+
+    SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
+    # refresh the access token when it has less than this left
+    REFRESH_MARGIN = datetime.timedelta(minutes=5)
 
-class SpeechToTextApiRecognitionController(AbstractSpeechRecognizer):
     def __init__(self):
         self.api_ref = speech_recognition_s2t_api
-        self.client = self.api_ref.SpeechClient.from_service_account_info({
+        try:
+            self.credentials = self._credentials()
+        except ValueError as e:
+            # a missing or mangled key is a configuration problem like any other auth error
+            raise google_auth_exc.DefaultCredentialsError(f'invalid service account: {e}') from e
+        # the channel is built from the scoped credentials directly, so refreshing them here
+        # is what the channel sees on its next request
+        transport_cls = self.api_ref.SpeechClient.get_transport_class('grpc')
+        self.client = self.api_ref.SpeechClient(
+            transport=transport_cls(
+                channel=transport_cls.create_channel(credentials=self.credentials)
+            )
+        )
+
+    def _credentials(self) -> service_account.Credentials:
+        return service_account.Credentials.from_service_account_info({
             'type': 'service_account',
             'project_id': os.getenv('FIREBASE_PROJECT_ID'),
             'private_key_id': os.getenv('FIREBASE_PRIVATE_KEY_ID'),
@@ -56,41 +263,87 @@ class SpeechToTextApiRecognitionController(AbstractSpeechRecognizer):
             'token_uri': 'https://oauth2.googleapis.com/token',
             'auth_provider_x509_cert_url': 'https://www.googleapis.com/oauth2/v1/certs',
             'client_x509_cert_url': os.getenv('FIREBASE_CLIENT_X509_CERT_URL')
-        })
-
-    def recognize(self, file_path: str, language: str = None) -> tuple[str, str]:
-        if os.path.isfile(file_path):
-            with open(file_path, 'rb') as f:
-                content = f.read()
-
-            response = self.client.recognize(
-                config=self.api_ref.RecognitionConfig(
-                    audio_channel_count=self.get_channels(file_path),
-                    enable_automatic_punctuation=True,
-                    language_code='en-US',
-                    alternative_language_codes=['uk-UA']
-                ),
-                audio=self.api_ref.RecognitionAudio(content=content)
-            )
-            transcript = ''
-
-            languages = {'en-US': 0, 'uk-UA': 0}
-            for i, result in enumerate(response.results):
-                # language_code comes in lowercase (en-us, uk-ua),
-                # so we need to convert the last part of it to uppercase
-                lan_code = result.language_code[:3] + result.language_code[3:].upper()
-                languages[lan_code] += 1
-                alternative = result.alternatives[0]
-                transcript += f'{alternative.transcript}.'
-            return self.get_used_language(languages), transcript
+        }, scopes=self.SCOPES)
+
+    def refresh_credentials(self) -> None:
+        expiry = self.credentials.expiry
+        if (
+            not self.credentials.valid
+            or expiry is None
+            or expiry - datetime.datetime.utcnow() < self.REFRESH_MARGIN
+        ):
+            self.credentials.refresh(google.auth.transport.requests.Request())
+
+    def close(self) -> None:
+        self.client.transport.grpc_channel.close()
+
+    def recognize(self, audio: AudioClip, language: str = None) -> Transcription:
+        if audio.encoding not in self.SUPPORTED_ENCODINGS:
+            raise ValueError(f'{audio.encoding} audio is not supported by {type(self).__name__}')
+
+        if audio.duration <= self.SYNC_MAX_DURATION:
+            results = self.client.recognize(
+                config=self._config(audio),
+                audio=self.api_ref.RecognitionAudio(content=audio.content)
+            ).results
+        elif not self.is_long_running(audio):
+            results = self._streaming_recognize(audio)
         else:
-            raise Exception('SERVER ERROR')
+            # RecognitionService polls these without holding a worker, this is the blocking way
+            results = self.start_long_running(audio).result(timeout=audio.duration * 2).results
+        return self.parse_results(results)
 
-    @classmethod
-    def get_used_language(cls, languages: dict) -> str:
-        return max(languages, key=languages.get)
+    def _config(self, audio: AudioClip):
+        return self.api_ref.RecognitionConfig(
+            encoding=self.api_ref.RecognitionConfig.AudioEncoding[audio.encoding],
+            sample_rate_hertz=audio.sample_rate,
+            audio_channel_count=audio.channels,
+            enable_automatic_punctuation=True,
+            language_code='en-US',
+            alternative_language_codes=['uk-UA']
+        )
 
-    @classmethod
-    def get_channels(cls, file_path: str) -> int:
-        with wave.open(file_path, 'rb') as wave_file:
-            return wave_file.getnchannels()
+    def _streaming_recognize(self, audio: AudioClip) -> list:
+        def chunks():
+            content = memoryview(audio.content)
+            for offset in range(0, len(content), self.CHUNK_SIZE):
+                yield self.api_ref.StreamingRecognizeRequest(
+                    audio_content=bytes(content[offset:offset + self.CHUNK_SIZE])
+                )
+
+        responses = self.client.streaming_recognize(
+            config=self.api_ref.StreamingRecognitionConfig(config=self._config(audio)),
+            requests=chunks(),
+        )
+        return [result for response in responses for result in response.results]
+
+    def is_long_running(self, audio: AudioClip) -> bool:
+        return audio.duration > self.STREAMING_MAX_DURATION
+
+    def start_long_running(self, audio: AudioClip):
+        return self.client.long_running_recognize(
+            config=self._config(audio),
+            audio=self.api_ref.RecognitionAudio(content=audio.content)
+        )
+
+    def parse_response(self, response) -> Transcription:
+        return self.parse_results(response.results)
+
+    def parse_results(self, results) -> Transcription:
+        transcript = ''
+        confidences = []
+
+        languages = {'en-US': 0, 'uk-UA': 0}
+        for result in results:
+            # language_code comes in lowercase (en-us, uk-ua),
+            # so we need to convert the last part of it to uppercase
+            lan_code = result.language_code[:3] + result.language_code[3:].upper()
+            languages[lan_code] += 1
+            alternative = result.alternatives[0]
+            transcript += f'{alternative.transcript}.'
+            confidences.append(alternative.confidence)
+        return Transcription(
+            text=transcript,
+            languages=languages,
+            confidence=sum(confidences) / len(confidences) if confidences else 0.0,
+        )
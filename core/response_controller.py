@@ -1,11 +1,21 @@
-from typing import Optional
+from typing import (
+    BinaryIO,
+    Optional,
+)
 
 from aiogram import types
 
-from utils import Keyboards
+from core.outbound_sender import OutboundSender
+from utils import (
+    Keyboards,
+    MessageTypes,
+)
 
 
 class Responder:
+    # paces every reply; main replaces it with one configured from the environment
+    sender = OutboundSender()
+
     class Types:
         GET_ALL_ENTRIES_BY_DATE = dict(
             message='Send me a date in format: <b>YYYY-mm-dd HH:MM:SS</b> or just '
@@ -22,26 +32,27 @@ class Responder:
         GET_LAST_N_ENTRIES = dict(
             message='Send me a number of entries you want to get.',
         )
-        GET_ALL_ENTRIES_BY_TOPIC = dict(
-            message='Send me a topic name to search for.',
-            kb=Keyboards.FREQUENTLY_USED_TOPICS,
-        )
-        CHOOSE_TOPIC_FOR_NEW_ENTRY = dict(
-            message='Please select the topic for this entry.',
-            kb=Keyboards.FREQUENTLY_USED_TOPICS,
-        )
-        CHOOSE_LANGUAGE_FOR_NEW_ENTRY = dict(
-            message='Now select the language of your voice message.',
-            kb=Keyboards.GET_LANGUAGES,
+        SEARCH_ENTRIES = dict(
+            message='Send me the words to search your entries for.',
         )
         ERROR = dict(
             message='An error has occurred. Please try again later.',
             kb=Keyboards.GET_ENTRIES,
         )
+        BUSY = dict(
+            message='I am busy with other voice messages right now. '
+                    'Please send yours again in a minute.',
+            kb=Keyboards.GET_ENTRIES,
+        )
         TEXT_NOT_RECOGNIZED = dict(
             message='Unable to process your voice message. Try re-recording it.',
             kb=Keyboards.GET_ENTRIES,
         )
+        EXPORT_FORMATS = dict(
+            message='Send <b>/export jsonl</b>, <b>/export md</b> or <b>/export zip</b>.',
+            kb=Keyboards.GET_ENTRIES,
+            html=True,
+        )
         ENTRIES_NOT_FOUND = dict(
             message='No entries found!',
             kb=Keyboards.GET_ENTRIES,
@@ -62,6 +73,20 @@ class Responder:
                 html=True,
             )
 
+        @classmethod
+        def GET_ALL_ENTRIES_BY_TOPIC(cls, topics: list) -> dict:   # NOSONAR
+            return dict(
+                message='Send me a topic name to search for.',
+                kb=Keyboards.TOPICS(topics),
+            )
+
+        @classmethod
+        def CHOOSE_TOPIC_FOR_NEW_ENTRY(cls, topics: list) -> dict:   # NOSONAR
+            return dict(
+                message='Please select the topic for this entry.',
+                kb=Keyboards.TOPICS(topics),
+            )
+
         @classmethod
         def REMOVE_ENTRY_SUCCESS(cls, entry_id: str) -> dict:   # NOSONAR
             return dict(
@@ -78,6 +103,13 @@ class Responder:
                 html=True,
             )
 
+        @classmethod
+        def MORE_ENTRIES(cls, cursor: int) -> dict:   # NOSONAR
+            return dict(
+                message='There are more entries.',
+                kb=Keyboards.MORE_ENTRIES(f'{MessageTypes.Callbacks.MORE_ENTRIES}{cursor}'),
+            )
+
         @classmethod
         def PRINT_ENTRY(cls, entry: str) -> dict:   # NOSONAR
             return dict(
@@ -99,4 +131,8 @@ class Responder:
     @classmethod
     async def respond(cls, msg: types.Message, content: dict):
         message, keyboard, parse_mode = cls.__get_content(content)
-        await msg.reply(message, reply_markup=keyboard, parse_mode=parse_mode)
+        await cls.sender.reply(msg, message, reply_markup=keyboard, parse_mode=parse_mode)
+
+    @classmethod
+    async def respond_with_file(cls, msg: types.Message, file: BinaryIO, filename: str):
+        await cls.sender.reply_document(msg, file, filename, reply_markup=Keyboards.GET_ENTRIES)
@@ -0,0 +1,225 @@
+import math
+import re
+from collections import Counter
+from typing import Optional
+
+from core.sqlite_base import SQLiteDatabase
+
+
+class Tokenizer:
+    # a word, including the apostrophes inside Ukrainian words like "м'ясо" and English "don't"
+    WORD_REGEX = re.compile(r"[^\W_]+(?:['’ʼ][^\W_]+)*")
+    APOSTROPHES_REGEX = re.compile(r"['’ʼ]")
+    STOP_WORDS = frozenset((
+        'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if', 'in', 'into', 'is',
+        'it', 'of', 'on', 'or', 'so', 'that', 'the', 'then', 'there', 'this', 'to', 'was', 'with',
+        'а', 'але', 'б', 'би', 'в', 'во', 'від', 'до', 'же', 'з', 'за', 'і', 'із', 'й', 'на', 'не',
+        'ні', 'по', 'про', 'та', 'те', 'ти', 'то', 'у', 'це', 'що', 'як', 'я',
+    ))
+    # light stemming, so "meetings" finds "meeting" and "зустрічі" finds "зустріч":
+    # English plurals the way the S-stemmer does it, i.e. (suffix, its replacement, the endings
+    # it's left alone after), and Ukrainian endings longest first;
+    # a stem never gets shorter than MIN_STEM_LENGTH
+    ENGLISH_SUFFIXES = (
+        ('ies', 'y', ('eies', 'aies')),
+        ('es', 'e', ('aes', 'ees', 'oes')),
+        ('s', '', ('us', 'ss')),
+    )
+    # the words ending in "s" that aren't plurals, e.g. "news" isn't "new"
+    ENGLISH_WHOLE_WORDS = frozenset((
+        'always', 'does', 'goes', 'lens', 'news', 'perhaps', 'series', 'species', 'this', 'thus',
+    ))
+    UKRAINIAN_SUFFIXES = (
+        'ами', 'ями', 'ові', 'еві', 'ого', 'ому', 'ими', 'их', 'ій', 'ою', 'ею', 'ом', 'ем',
+        'ах', 'ях', 'ів', 'ий', 'а', 'я', 'у', 'ю', 'і', 'и', 'е', 'о', 'ь',
+    )
+    MIN_STEM_LENGTH = 3
+    CYRILLIC_REGEX = re.compile(r'[а-яіїєґ]')
+
+    @classmethod
+    def stem(cls, word: str) -> str:
+        if cls.CYRILLIC_REGEX.search(word):
+            for suffix in cls.UKRAINIAN_SUFFIXES:
+                if word.endswith(suffix) and len(word) - len(suffix) >= cls.MIN_STEM_LENGTH:
+                    return word[:-len(suffix)]
+            return word
+        if word in cls.ENGLISH_WHOLE_WORDS:
+            return word
+        for suffix, replacement, exceptions in cls.ENGLISH_SUFFIXES:
+            if word.endswith(suffix):
+                stem = word[:-len(suffix)] + replacement
+                if not word.endswith(exceptions) and len(stem) >= cls.MIN_STEM_LENGTH:
+                    return stem
+        return word
+
+    @classmethod
+    def tokens(cls, text: str) -> list:
+        """
+        Split English or Ukrainian text into search terms.
+        :param text: the text to tokenize.
+        :return: the stemmed terms, stop words left out, in order.
+        """
+        words = (
+            cls.APOSTROPHES_REGEX.sub('', word)
+            for word in cls.WORD_REGEX.findall(text.lower())
+        )
+        return [cls.stem(word) for word in words if word not in cls.STOP_WORDS]
+
+
+class SearchIndex(SQLiteDatabase):
+    # BM25 parameters: term frequency saturation and length normalization
+    K1 = 1.2
+    B = 0.75
+    # bumped whenever Tokenizer starts producing different terms, so the old ones are rebuilt
+    VERSION = 3
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            documents INTEGER NOT NULL,
+            total_length INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS documents (
+            user_id INTEGER NOT NULL,
+            entry_id TEXT NOT NULL,
+            length INTEGER NOT NULL,
+            PRIMARY KEY (user_id, entry_id)
+        );
+        CREATE TABLE IF NOT EXISTS postings (
+            user_id INTEGER NOT NULL,
+            term TEXT NOT NULL,
+            entry_id TEXT NOT NULL,
+            frequency INTEGER NOT NULL,
+            PRIMARY KEY (user_id, term, entry_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS postings_user_id_entry_id
+            ON postings (user_id, entry_id);
+    '''
+    THREAD_NAME = 'sqlite-search'
+
+    def __init__(self, path: str):
+        """
+        An inverted index of the entries' text, to find entries by the words in them.
+        :param path: the SQLite database file.
+        """
+        super().__init__(path)
+        if self._db.execute('PRAGMA user_version').fetchone()[0] != self.VERSION:
+            # the users are indexed again the next time they search
+            with self._db:
+                self._db.execute('BEGIN')
+                for table in ('users', 'documents', 'postings'):
+                    self._db.execute(f'DELETE FROM {table}')
+                self._db.execute(f'PRAGMA user_version = {self.VERSION}')
+
+    async def is_indexed(self, user_id: int) -> bool:
+        return await self._run(self._is_indexed, user_id)
+
+    async def build(self, user_id: int, entries: dict) -> None:
+        """
+        Index all of the user's entries from scratch.
+        :param user_id: the user's Telegram ID.
+        :param entries: the texts of all of the user's entries by their IDs.
+        """
+        await self._run(self._build, user_id, entries)
+
+    async def add(self, user_id: int, entry_id: str, text: str) -> None:
+        """
+        Index a new or changed entry; users who haven't been indexed yet are left to build.
+        """
+        await self._run(self._update, user_id, entry_id, text)
+
+    async def remove(self, user_id: int, entry_id: str) -> None:
+        await self._run(self._update, user_id, entry_id, None)
+
+    async def search(self, user_id: int, query: str, limit: int = 10) -> list:
+        """
+        Rank the user's entries against the query with BM25.
+        :param user_id: the user's Telegram ID.
+        :param query: the words to look for.
+        :param limit: how many entries to return at most.
+        :return: the IDs of the best matching entries, best first.
+        """
+        terms = set(Tokenizer.tokens(query))
+        if not terms:
+            return []
+        return await self._run(self._search, user_id, terms, limit)
+
+    def _is_indexed(self, user_id: int) -> bool:
+        return self._db.execute(
+            'SELECT 1 FROM users WHERE user_id = ?', (user_id,)
+        ).fetchone() is not None
+
+    def _build(self, user_id: int, entries: dict) -> None:
+        with self._db:
+            self._db.execute('BEGIN')
+            self._db.execute('DELETE FROM postings WHERE user_id = ?', (user_id,))
+            self._db.execute('DELETE FROM documents WHERE user_id = ?', (user_id,))
+            self._db.execute(
+                'INSERT OR REPLACE INTO users VALUES (?, 0, 0)', (user_id,)
+            )
+            for entry_id, text in entries.items():
+                self._add(user_id, entry_id, text)
+
+    def _update(self, user_id: int, entry_id: str, text: Optional[str]) -> None:
+        with self._db:
+            self._db.execute('BEGIN')
+            self._remove(user_id, entry_id)
+            if text is not None and self._is_indexed(user_id):
+                self._add(user_id, entry_id, text)
+
+    def _add(self, user_id: int, entry_id: str, text: str) -> None:
+        terms = Counter(Tokenizer.tokens(text))
+        length = sum(terms.values())
+        self._db.execute('INSERT INTO documents VALUES (?, ?, ?)', (user_id, entry_id, length))
+        self._db.executemany(
+            'INSERT INTO postings VALUES (?, ?, ?, ?)',
+            ((user_id, term, entry_id, frequency) for term, frequency in terms.items())
+        )
+        self._db.execute(
+            'UPDATE users SET documents = documents + 1, total_length = total_length + ? '
+            'WHERE user_id = ?',
+            (length, user_id)
+        )
+
+    def _remove(self, user_id: int, entry_id: str) -> None:
+        row = self._db.execute(
+            'SELECT length FROM documents WHERE user_id = ? AND entry_id = ?', (user_id, entry_id)
+        ).fetchone()
+        if row is None:
+            return
+        self._db.execute(
+            'DELETE FROM postings WHERE user_id = ? AND entry_id = ?', (user_id, entry_id)
+        )
+        self._db.execute(
+            'DELETE FROM documents WHERE user_id = ? AND entry_id = ?', (user_id, entry_id)
+        )
+        self._db.execute(
+            'UPDATE users SET documents = documents - 1, total_length = total_length - ? '
+            'WHERE user_id = ?',
+            (row[0], user_id)
+        )
+
+    def _search(self, user_id: int, terms: set, limit: int) -> list:
+        user = self._db.execute(
+            'SELECT documents, total_length FROM users WHERE user_id = ?', (user_id,)
+        ).fetchone()
+        if user is None or not user[0]:
+            return []
+        documents, total_length = user
+        average_length = total_length / documents or 1
+
+        scores = Counter()
+        for term in terms:
+            postings = self._db.execute(
+                'SELECT p.entry_id, p.frequency, d.length FROM postings p '
+                'JOIN documents d ON d.user_id = p.user_id AND d.entry_id = p.entry_id '
+                'WHERE p.user_id = ? AND p.term = ?',
+                (user_id, term)
+            ).fetchall()
+            if not postings:
+                continue
+            idf = math.log(1 + (documents - len(postings) + 0.5) / (len(postings) + 0.5))
+            for entry_id, frequency, length in postings:
+                scores[entry_id] += idf * frequency * (self.K1 + 1) / (
+                    frequency + self.K1 * (1 - self.B + self.B * length / average_length)
+                )
+        return [entry_id for entry_id, _ in scores.most_common(limit)]
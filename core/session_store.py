@@ -0,0 +1,250 @@
+import asyncio
+import sqlite3
+import time
+from abc import (
+    ABC,
+    abstractmethod,
+)
+from typing import Optional
+
+from core.sqlite_base import SQLiteDatabase
+
+
+class SessionStoreError(Exception):
+    pass
+
+
+class AbstractSessionStore(ABC):
+    NAME = None
+    # what the store raises when it's unavailable
+    ERRORS = ()
+
+    @abstractmethod
+    async def load(self, user_ids: list) -> dict:
+        """
+        :param user_ids: the users' Telegram IDs.
+        :return: the serialized sessions by user ID; the users without one are left out.
+        """
+
+    @abstractmethod
+    async def save(self, sessions: dict) -> None:
+        """
+        :param sessions: the serialized sessions by user ID; None deletes the user's session.
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class MemorySessionStore(AbstractSessionStore):
+    NAME = 'memory'
+
+    def __init__(self):
+        """
+        Sessions in this process, lost on restart; the default for a single bot process.
+        """
+        self._sessions = {}
+
+    async def load(self, user_ids: list) -> dict:
+        return {
+            user_id: self._sessions[user_id] for user_id in user_ids if user_id in self._sessions
+        }
+
+    async def save(self, sessions: dict) -> None:
+        for user_id, session in sessions.items():
+            if session is None:
+                self._sessions.pop(user_id, None)
+            else:
+                self._sessions[user_id] = session
+
+
+class SQLiteSessionStore(SQLiteDatabase, AbstractSessionStore):
+    NAME = 'sqlite'
+    ERRORS = (sqlite3.Error,)
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS sessions (
+            user_id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL,
+            updated_at REAL NOT NULL
+        );
+    '''
+    THREAD_NAME = 'sqlite-sessions'
+
+    def __init__(self, path: str):
+        """
+        Sessions in a local SQLite database, so they survive restarts of a single host.
+        :param path: the SQLite database file.
+        """
+        super().__init__(path)
+
+    def _load(self, user_ids: list) -> dict:
+        return dict(self._db.execute(
+            f'SELECT user_id, data FROM sessions '
+            f'WHERE user_id IN ({", ".join("?" * len(user_ids))})',
+            user_ids
+        ))
+
+    def _save(self, sessions: dict) -> None:
+        now = time.time()
+        with self._db:
+            self._db.execute('BEGIN')
+            self._db.executemany(
+                'DELETE FROM sessions WHERE user_id = ?',
+                ((user_id,) for user_id, session in sessions.items() if session is None)
+            )
+            self._db.executemany(
+                'INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)',
+                (
+                    (user_id, session, now)
+                    for user_id, session in sessions.items() if session is not None
+                )
+            )
+
+    async def load(self, user_ids: list) -> dict:
+        return await self._run(self._load, list(user_ids)) if user_ids else {}
+
+    async def save(self, sessions: dict) -> None:
+        if sessions:
+            await self._run(self._save, sessions)
+
+
+class RedisSessionStore(AbstractSessionStore):
+    NAME = 'redis'
+    ERRORS = (SessionStoreError, OSError, asyncio.IncompleteReadError)
+
+    def __init__(
+        self, host: str = 'localhost', port: int = 6379, db: int = 0,
+        password: Optional[str] = None, prefix: str = 'voice-diary:session:',
+        ttl: Optional[int] = None
+    ):
+        """
+        Sessions in Redis, or anything that speaks its protocol, shared by all the bot's replicas.
+        :param host: the server's host.
+        :param port: the server's port.
+        :param db: the database number.
+        :param password: the password, None if the server has none.
+        :param prefix: what the keys of the sessions start with.
+        :param ttl: seconds an untouched session is kept, None to keep it forever.
+        """
+        self._host = host
+        self._port = port
+        self._db = db
+        self._password = password
+        self._prefix = prefix
+        self._ttl = ttl
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        # one connection, one pipeline at a time, so the replies come back in order
+        self._lock: Optional[asyncio.Lock] = None
+
+    def _key(self, user_id: int) -> bytes:
+        return f'{self._prefix}{user_id}'.encode()
+
+    @staticmethod
+    def encode(*args) -> bytes:
+        """
+        :return: the command as a RESP array of bulk strings.
+        """
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    async def _read_reply(self):
+        line = await self._reader.readuntil(b'\r\n')
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode()
+        if kind == b'-':
+            raise SessionStoreError(payload.decode())
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length == -1:
+                return None
+            return (await self._reader.readexactly(length + 2))[:-2]
+        if kind == b'*':
+            length = int(payload)
+            if length == -1:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+        raise SessionStoreError(f'unexpected reply: {line!r}')
+
+    async def _connect(self) -> None:
+        self._reader, self._writer = await asyncio.open_connection(self._host, self._port)
+        setup = []
+        if self._password is not None:
+            setup.append(('AUTH', self._password))
+        if self._db:
+            setup.append(('SELECT', self._db))
+        if setup:
+            try:
+                await self._pipeline(setup)
+            except BaseException:
+                # a connection that isn't logged in or is on the wrong database is no good
+                self.close()
+                raise
+
+    async def _pipeline(self, commands: list) -> list:
+        self._writer.write(b''.join(self.encode(*command) for command in commands))
+        await self._writer.drain()
+        replies, error = [], None
+        for _ in commands:
+            # every reply is read even after an error, so the next pipeline starts in sync
+            try:
+                replies.append(await self._read_reply())
+            except SessionStoreError as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return replies
+
+    async def _execute(self, commands: list) -> list:
+        """
+        Send the commands in one round-trip, reconnecting once if the connection was lost.
+        :return: the replies, in order.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._writer is None:
+                        await self._connect()
+                    return await self._pipeline(commands)
+                except (OSError, asyncio.IncompleteReadError):
+                    self.close()
+                    if attempt:
+                        raise
+                except asyncio.CancelledError:
+                    # the replies still on the way would be read as the next pipeline's
+                    self.close()
+                    raise
+
+    async def load(self, user_ids: list) -> dict:
+        if not user_ids:
+            return {}
+        user_ids = list(user_ids)
+        sessions, = await self._execute([('MGET', *map(self._key, user_ids))])
+        return {
+            user_id: session
+            for user_id, session in zip(user_ids, sessions) if session is not None
+        }
+
+    async def save(self, sessions: dict) -> None:
+        commands = [
+            ('DEL', self._key(user_id)) if session is None else
+            ('SET', self._key(user_id), session)
+            + (('EX', self._ttl) if self._ttl else ())
+            for user_id, session in sessions.items()
+        ]
+        if commands:
+            await self._execute(commands)
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
@@ -0,0 +1,34 @@
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SQLiteDatabase:
+    # the tables and indexes, created when they're missing
+    SCHEMA = ''
+    THREAD_NAME = 'sqlite'
+
+    def __init__(self, path: str):
+        """
+        A local SQLite database that is only used from a thread of its own: one thread owns
+        the connection, so the queries never block the event loop and never run concurrently.
+        :param path: the SQLite database file.
+        """
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=self.THREAD_NAME)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.executescript(f'''
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            {self.SCHEMA}
+        ''')
+
+    async def _run(self, func, *args):
+        """
+        Run a method that uses the connection in the database's thread.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def close(self) -> None:
+        # whatever is still queued runs first
+        self._executor.shutdown(wait=True)
+        self._db.close()
@@ -0,0 +1,598 @@
+import asyncio
+import json
+import logging
+import sqlite3
+from abc import (
+    ABC,
+    abstractmethod,
+)
+from collections import Counter
+from typing import Optional
+
+import firebase_admin
+import google.api_core.exceptions as google_api_exc
+import google.auth.exceptions as google_auth_exc
+from google.cloud import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+
+from core.sqlite_base import SQLiteDatabase
+from utils import DateFormatter
+
+
+logger = logging.getLogger(__name__)
+
+
+class PartialWriteError(Exception):
+    def __init__(self, error: Exception, committed: set):
+        """
+        Some of the writes given to apply_writes were committed before one of its commits failed.
+        :param error: what the failed commit raised.
+        :param committed: the indices of the writes that were committed.
+        """
+        super().__init__(f'{len(committed)} writes were committed before: {error}')
+        self.error = error
+        self.committed = committed
+
+
+class AbstractStorage(ABC):
+    NAME = ''
+    # errors that mean the storage failed, as opposed to a bug
+    ERRORS = ()
+    # write operations, see apply_writes
+    CREATE = 'create'
+    DELETE = 'delete'
+
+    @abstractmethod
+    async def create_entry(self, user_id: int, entry_id: str, data: dict) -> None:
+        pass
+
+    @abstractmethod
+    async def delete_entry(self, user_id: int, entry_id: str) -> None:
+        pass
+
+    async def apply_writes(self, writes: list) -> None:
+        """
+        Apply several writes at once; storages that can commit them together override this.
+        :param writes: (operation, user_id, entry_id, data) tuples, in order; data is None
+        for a delete.
+        :return: none; raises PartialWriteError if a part of the writes was committed
+        before the rest failed.
+        """
+        for index, (operation, user_id, entry_id, data) in enumerate(writes):
+            try:
+                if operation == self.DELETE:
+                    await self.delete_entry(user_id, entry_id)
+                else:
+                    await self.create_entry(user_id, entry_id, data)
+            except self.ERRORS as e:
+                if index:
+                    raise PartialWriteError(e, set(range(index))) from e
+                raise
+
+    @abstractmethod
+    async def fetch_all(self, user_id: int) -> list:
+        pass
+
+    @abstractmethod
+    async def fetch_by_id(self, user_id: int, entry_id: str) -> list:
+        pass
+
+    @abstractmethod
+    async def fetch_between(
+        self, user_id: int, start: Optional[int] = None, end: Optional[int] = None,
+        include_start: bool = True, include_end: bool = True
+    ) -> list:
+        pass
+
+    @abstractmethod
+    async def fetch_page(self, user_id: int, after: Optional[int], limit: int) -> list:
+        """
+        :param user_id: the user's Telegram ID.
+        :param after: the timestamp of the last entry of the previous page, None for the first one.
+        :param limit: the page size.
+        :return: the entries that follow the cursor, oldest first.
+        """
+        pass
+
+    @abstractmethod
+    async def fetch_by_topics(self, user_id: int, topics: list) -> list:
+        pass
+
+    @abstractmethod
+    async def fetch_last_n(self, user_id: int, number: int) -> list:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class FirestoreStorage(AbstractStorage):
+    NAME = 'firestore'
+    ERRORS = (google_api_exc.GoogleAPIError, google_auth_exc.GoogleAuthError)
+    # the most writes Firestore accepts in one commit
+    MAX_BATCH_WRITES = 500
+    # the most values an "in" filter accepts
+    MAX_IN_VALUES = 10
+    # the field of the user's document that says their day documents have all of the entries
+    ROLLUPS_BUILT_FIELD = 'day_rollups_built'
+
+    def __init__(
+        self, project_id: str, private_key_id: str, private_key: str, client_email: str,
+        client_id: str, cert_url: str, day_rollups: bool = False,
+    ):
+        """
+        :param day_rollups: also keep one document per user per day with all of its entries,
+        so date range queries read a document per day instead of one per entry; the existing
+        entries are rolled up the first time the user queries them.
+        """
+        cred = firebase_admin.credentials.Certificate(
+            cert={
+                'type': 'service_account',
+                'project_id': project_id,
+                'private_key_id': private_key_id,
+                'private_key': private_key.replace('\\n', '\n'),
+                'client_email': client_email,
+                'client_id': client_id,
+                'auth_uri': 'https://accounts.google.com/o/oauth2/auth',
+                'token_uri': 'https://oauth2.googleapis.com/token',
+                'auth_provider_x509_cert_url': 'https://www.googleapis.com/oauth2/v1/certs',
+                'client_x509_cert_url': cert_url
+            }
+        )
+        # the async client awaits the network instead of blocking the event loop,
+        # so the queries of different users overlap
+        self._db = firestore.AsyncClient(project=project_id, credentials=cred.get_credential())
+        self._day_rollups = day_rollups
+        # the users whose day documents are known to be complete, and the builds in progress
+        self._rollups_built = set()
+        self._rollup_builds = {}
+        # bumped as every write starts and ends, so a build that raced with one isn't trusted
+        self._user_writes = Counter()
+
+    def user_ref(self, user_id: int):
+        return self._db.collection('Users').document(f'{user_id}')
+
+    def user_entries_ref(self, user_id: int):
+        return self.user_ref(user_id).collection('Entries')
+
+    def user_days_ref(self, user_id: int):
+        return self.user_ref(user_id).collection('Days')
+
+    def _day_ref(self, user_id: int, timestamp: int):
+        return self.user_days_ref(user_id).document(DateFormatter.timestamp_to_day(timestamp))
+
+    async def build_rollups(self, user_id: int) -> bool:
+        """
+        Rebuild the user's day documents from the entries, e.g. after day_rollups is turned on,
+        and mark them complete.
+        :param user_id: the user's Telegram ID.
+        :return: False if a write to the user's entries raced with the build, so the day documents
+        can't be trusted and aren't marked complete.
+        """
+        writes = self._user_writes[user_id]
+        days = {}
+        for entry in await self.fetch_all(user_id):
+            day = DateFormatter.timestamp_to_day(entry['timestamp'])
+            days.setdefault(day, {})[f'{entry["timestamp"]}'] = entry
+        # the days left over from an earlier build whose entries are all gone
+        stale = [ref async for ref in self.user_days_ref(user_id).list_documents()]
+        await self._commit([
+            *((ref, None, False) for ref in stale if ref.id not in days),
+            *(
+                (self.user_days_ref(user_id).document(day), dict(entries=entries), False)
+                for day, entries in days.items()
+            ),
+        ])
+        if self._user_writes[user_id] != writes:
+            # the build may have overwritten the write's records; the next query builds again
+            return False
+        await self.user_ref(user_id).set({self.ROLLUPS_BUILT_FIELD: True}, merge=True)
+        self._rollups_built.add(user_id)
+        return True
+
+    async def _has_rollups(self, user_id: int) -> bool:
+        """
+        :param user_id: the user's Telegram ID.
+        :return: whether the user's day documents have all of the entries; they're built
+        in the background if they don't, and the queries read the entries until then.
+        """
+        if user_id in self._rollups_built:
+            return True
+        if user_id in self._rollup_builds:
+            return False
+        user = (await self.user_ref(user_id).get()).to_dict() or {}
+        if user.get(self.ROLLUPS_BUILT_FIELD):
+            self._rollups_built.add(user_id)
+            return True
+        if user_id not in self._rollup_builds:
+            self._rollup_builds[user_id] = asyncio.ensure_future(self._build_rollups(user_id))
+        return False
+
+    async def _build_rollups(self, user_id: int) -> None:
+        try:
+            if await self.build_rollups(user_id):
+                logger.info('built the day documents of %s', user_id)
+        except self.ERRORS as e:
+            logger.warning('could not build the day documents of %s: %s', user_id, e)
+        finally:
+            del self._rollup_builds[user_id]
+
+    async def _forget_rollups(self, user_id: int) -> None:
+        # the day documents disagree with the entries, so they're built again on the next query
+        self._rollups_built.discard(user_id)
+        try:
+            await self.user_ref(user_id).set(
+                {self.ROLLUPS_BUILT_FIELD: firestore.DELETE_FIELD}, merge=True
+            )
+        except self.ERRORS as e:
+            logger.error('the day documents of %s are out of date: %s', user_id, e)
+
+    async def _commit(self, mutations: list) -> None:
+        """
+        Commit the mutations in as few batches as Firestore allows.
+        :param mutations: (document reference, data, merge) tuples; None for the data deletes.
+        :return: none
+        """
+        for first in range(0, len(mutations), self.MAX_BATCH_WRITES):
+            batch = self._db.batch()
+            for ref, data, merge in mutations[first:first + self.MAX_BATCH_WRITES]:
+                if data is None:
+                    batch.delete(ref)
+                else:
+                    batch.set(ref, data, merge=merge)
+            await batch.commit()
+
+    @staticmethod
+    def _to_dicts(snapshots) -> list:
+        if not isinstance(snapshots, list):
+            snapshots = [snapshots]
+        return [snapshot.to_dict() for snapshot in snapshots if snapshot.exists]
+
+    async def create_entry(self, user_id: int, entry_id: str, data: dict) -> None:
+        await self.apply_writes([(self.CREATE, user_id, entry_id, data)])
+
+    async def delete_entry(self, user_id: int, entry_id: str) -> None:
+        await self.apply_writes([(self.DELETE, user_id, entry_id, None)])
+
+    async def apply_writes(self, writes: list) -> None:
+        # only the last write to an entry matters, and all the writes to a day are merged
+        # into one, so a burst of entries costs as few document writes as possible
+        entries, days = {}, {}
+        # the writes each entry's document stands for, to tell which of them are committed
+        indices = {}
+        for index, (operation, user_id, entry_id, data) in enumerate(writes):
+            indices.setdefault((user_id, entry_id), []).append(index)
+            day = None
+            if self._day_rollups:
+                timestamp = (
+                    DateFormatter.date_to_timestamp(entry_id) if data is None else data['timestamp']
+                )
+                day = DateFormatter.timestamp_to_day(timestamp)
+                records = days.setdefault((user_id, day), {})
+                records[f'{timestamp}'] = firestore.DELETE_FIELD if data is None else data
+            entries[(user_id, entry_id)] = (day, data)
+
+        # an entry goes into the same batch as its day, and a batch commits atomically,
+        # so they can't disagree; unlike a transaction, a batch doesn't have to read the day first
+        groups = {}
+        for (user_id, entry_id), (day, data) in entries.items():
+            groups.setdefault((user_id, day or entry_id), []).append((
+                (self.user_entries_ref(user_id).document(entry_id), data, False),
+                indices[(user_id, entry_id)],
+            ))
+        for (user_id, day), records in days.items():
+            groups[(user_id, day)].append((
+                (self.user_days_ref(user_id).document(day), dict(entries=records), True), [],
+            ))
+        chunks = []
+        for (user_id, _), group in groups.items():
+            if chunks and len(chunks[-1][1]) + len(group) <= self.MAX_BATCH_WRITES:
+                chunks[-1][0].add(user_id)
+                chunks[-1][1].extend(group)
+            else:
+                chunks.append(({user_id}, group))
+
+        users = {user_id for _, user_id, _, _ in writes}
+        for user_id in users:
+            self._user_writes[user_id] += 1
+        committed = set()
+        try:
+            for chunk_users, chunk in chunks:
+                # only a day with more writes than a batch takes is split into several
+                for first in range(0, len(chunk), self.MAX_BATCH_WRITES):
+                    part = chunk[first:first + self.MAX_BATCH_WRITES]
+                    try:
+                        await self._commit([mutation for mutation, _ in part])
+                    except self.ERRORS as e:
+                        if self._day_rollups and first:
+                            # the rest of the day is already in
+                            for user_id in chunk_users:
+                                await self._forget_rollups(user_id)
+                        if committed:
+                            raise PartialWriteError(e, committed) from e
+                        raise
+                    committed.update(index for _, part_indices in part for index in part_indices)
+        finally:
+            for user_id in users:
+                self._user_writes[user_id] += 1
+
+    async def fetch_all(self, user_id: int) -> list:
+        return self._to_dicts(await self.user_entries_ref(user_id).get())
+
+    async def fetch_by_id(self, user_id: int, entry_id: str) -> list:
+        return self._to_dicts(await self.user_entries_ref(user_id).document(entry_id).get())
+
+    async def fetch_between(
+        self, user_id: int, start: Optional[int] = None, end: Optional[int] = None,
+        include_start: bool = True, include_end: bool = True
+    ) -> list:
+        if self._day_rollups and await self._has_rollups(user_id):
+            return await self._fetch_days_between(user_id, start, end, include_start, include_end)
+
+        query = self.user_entries_ref(user_id).order_by('timestamp', direction='ASCENDING')
+        if start is not None:
+            query = (
+                query.start_at({'timestamp': start})
+                if include_start else
+                query.start_after({'timestamp': start})
+            )
+        if end is not None:
+            query = (
+                query.end_at({'timestamp': end})
+                if include_end else
+                query.end_before({'timestamp': end})
+            )
+        return self._to_dicts(await query.get())
+
+    async def _fetch_days_between(
+        self, user_id: int, start: Optional[int], end: Optional[int],
+        include_start: bool, include_end: bool
+    ) -> list:
+        query = self.user_days_ref(user_id)
+        if start is not None:
+            query = query.where(FieldPath.document_id(), '>=', self._day_ref(user_id, start))
+        if end is not None:
+            query = query.where(FieldPath.document_id(), '<=', self._day_ref(user_id, end))
+        entries = []
+        async for day in query.stream():
+            for entry in day.to_dict().get('entries', {}).values():
+                if self._is_in_range(entry['timestamp'], start, end, include_start, include_end):
+                    entries.append(entry)
+        return sorted(entries, key=lambda entry: entry['timestamp'])
+
+    @staticmethod
+    def _is_in_range(
+        timestamp: int, start: Optional[int], end: Optional[int],
+        include_start: bool, include_end: bool
+    ) -> bool:
+        if start is not None and (timestamp < start or timestamp == start and not include_start):
+            return False
+        return end is None or timestamp < end or timestamp == end and include_end
+
+    async def fetch_page(self, user_id: int, after: Optional[int], limit: int) -> list:
+        query = self.user_entries_ref(user_id).order_by('timestamp', direction='ASCENDING')
+        if after is not None:
+            query = query.start_after({'timestamp': after})
+        # streamed, so only the page itself is ever read and held
+        return [snapshot.to_dict() async for snapshot in query.limit(limit).stream()]
+
+    async def fetch_by_topics(self, user_id: int, topics: list) -> list:
+        # an "in" filter takes MAX_IN_VALUES values at most
+        chunks = await asyncio.gather(*(
+            self.user_entries_ref(user_id)
+            .where('topic', 'in', topics[first:first + self.MAX_IN_VALUES])
+            .get()
+            for first in range(0, len(topics), self.MAX_IN_VALUES)
+        ))
+        return [entry for chunk in chunks for entry in self._to_dicts(chunk)]
+
+    async def fetch_last_n(self, user_id: int, number: int) -> list:
+        return self._to_dicts(
+            await (
+                self
+                .user_entries_ref(user_id)
+                .order_by('timestamp', direction='DESCENDING')
+                .limit(number)
+                .get()
+            )
+        )
+
+
+class SQLiteStorage(SQLiteDatabase, AbstractStorage):
+    NAME = 'sqlite'
+    ERRORS = (sqlite3.Error,)
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS entries (
+            user_id INTEGER NOT NULL,
+            entry_id TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
+            topic TEXT NOT NULL,
+            text TEXT NOT NULL,
+            language TEXT NOT NULL,
+            PRIMARY KEY (user_id, entry_id)
+        );
+        CREATE INDEX IF NOT EXISTS entries_user_id_timestamp
+            ON entries (user_id, timestamp);
+        CREATE INDEX IF NOT EXISTS entries_user_id_topic
+            ON entries (user_id, topic);
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            operation TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            entry_id TEXT NOT NULL,
+            data TEXT
+        );
+    '''
+    THREAD_NAME = 'sqlite'
+
+    def __init__(self, path: str, replicate: bool = False):
+        """
+        Entries in a local SQLite database, so the bot runs without network round-trips.
+        :param path: the SQLite database file.
+        :param replicate: whether to log every write to the outbox for StorageReplicator.
+        """
+        self._replicate = replicate
+        super().__init__(path)
+        self._db.row_factory = sqlite3.Row
+
+    def _query(self, sql: str, params: tuple) -> list:
+        return [
+            dict(timestamp=row[0], topic=row[1], text=row[2], language=row[3])
+            for row in self._db.execute(
+                f'SELECT timestamp, topic, text, language FROM entries {sql}', params
+            )
+        ]
+
+    def _write(self, writes: list) -> None:
+        # all the writes go in one transaction, so a burst costs a single fsync
+        with self._db:
+            self._db.execute('BEGIN')
+            for operation, user_id, entry_id, data in writes:
+                if data is None:
+                    self._db.execute(
+                        'DELETE FROM entries WHERE user_id = ? AND entry_id = ?',
+                        (user_id, entry_id)
+                    )
+                else:
+                    self._db.execute(
+                        'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                        (
+                            user_id, entry_id, data['timestamp'], data['topic'],
+                            data['text'], data['language'],
+                        )
+                    )
+                if self._replicate:
+                    # logged in the same transaction, so no write is lost on the way to Firestore
+                    self._db.execute(
+                        'INSERT INTO outbox (operation, user_id, entry_id, data) '
+                        'VALUES (?, ?, ?, ?)',
+                        (
+                            operation, user_id, entry_id,
+                            None if data is None else json.dumps(data, ensure_ascii=False),
+                        )
+                    )
+
+    async def create_entry(self, user_id: int, entry_id: str, data: dict) -> None:
+        await self._run(self._write, [(self.CREATE, user_id, entry_id, data)])
+
+    async def delete_entry(self, user_id: int, entry_id: str) -> None:
+        await self._run(self._write, [(self.DELETE, user_id, entry_id, None)])
+
+    async def apply_writes(self, writes: list) -> None:
+        await self._run(self._write, writes)
+
+    async def fetch_all(self, user_id: int) -> list:
+        return await self._run(
+            self._query, 'WHERE user_id = ? ORDER BY timestamp', (user_id,)
+        )
+
+    async def fetch_by_id(self, user_id: int, entry_id: str) -> list:
+        return await self._run(
+            self._query, 'WHERE user_id = ? AND entry_id = ?', (user_id, entry_id)
+        )
+
+    async def fetch_between(
+        self, user_id: int, start: Optional[int] = None, end: Optional[int] = None,
+        include_start: bool = True, include_end: bool = True
+    ) -> list:
+        conditions, params = ['user_id = ?'], [user_id]
+        if start is not None:
+            conditions.append('timestamp >= ?' if include_start else 'timestamp > ?')
+            params.append(start)
+        if end is not None:
+            conditions.append('timestamp <= ?' if include_end else 'timestamp < ?')
+            params.append(end)
+        return await self._run(
+            self._query, f'WHERE {" AND ".join(conditions)} ORDER BY timestamp', tuple(params)
+        )
+
+    async def fetch_page(self, user_id: int, after: Optional[int], limit: int) -> list:
+        if after is None:
+            return await self._run(
+                self._query, 'WHERE user_id = ? ORDER BY timestamp LIMIT ?', (user_id, limit)
+            )
+        return await self._run(
+            self._query, 'WHERE user_id = ? AND timestamp > ? ORDER BY timestamp LIMIT ?',
+            (user_id, after, limit)
+        )
+
+    async def fetch_by_topics(self, user_id: int, topics: list) -> list:
+        return await self._run(
+            self._query,
+            f'WHERE user_id = ? AND topic IN ({", ".join("?" * len(topics))}) ORDER BY timestamp',
+            (user_id, *topics)
+        )
+
+    async def fetch_last_n(self, user_id: int, number: int) -> list:
+        return await self._run(
+            self._query, 'WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?', (user_id, number)
+        )
+
+    def _pending_writes(self, limit: int) -> list:
+        return [
+            (
+                row['id'], row['operation'], row['user_id'], row['entry_id'],
+                None if row['data'] is None else json.loads(row['data']),
+            )
+            for row in self._db.execute(
+                'SELECT id, operation, user_id, entry_id, data FROM outbox ORDER BY id LIMIT ?',
+                (limit,)
+            )
+        ]
+
+    async def pending_writes(self, limit: int = 100) -> list:
+        """
+        :param limit: how many writes to return at most.
+        :return: the oldest writes not replicated yet as (id, operation, user_id, entry_id, data).
+        """
+        return await self._run(self._pending_writes, limit)
+
+    def _mark_replicated(self, last_id: int) -> None:
+        self._db.execute('DELETE FROM outbox WHERE id <= ?', (last_id,))
+
+    async def mark_replicated(self, last_id: int) -> None:
+        await self._run(self._mark_replicated, last_id)
+
+
+class StorageReplicator:
+    def __init__(self, source: SQLiteStorage, target: AbstractStorage, interval: float = 5):
+        """
+        Pushes the writes made to the local storage to another one, e.g. Firestore, in order.
+        :param source: the local storage, logging its writes to the outbox.
+        :param target: the storage to replicate to.
+        :param interval: seconds between the pushes.
+        """
+        self._source = source
+        self._target = target
+        self._interval = interval
+
+    async def flush(self) -> int:
+        """
+        Push everything in the outbox, stopping at the first batch the target refuses.
+        :return: the number of writes replicated.
+        """
+        replicated = 0
+        while True:
+            writes = await self._source.pending_writes()
+            if not writes:
+                return replicated
+            try:
+                await self._target.apply_writes([write[1:] for write in writes])
+            except (PartialWriteError, *self._target.ERRORS) as e:
+                # the writes only set and delete whole entries, so the ones already in
+                # can be applied again
+                logger.warning('replication to %s failed, will retry: %s', self._target.NAME, e)
+                return replicated
+            await self._source.mark_replicated(writes[-1][0])
+            replicated += len(writes)
+
+    async def run(self) -> None:
+        """
+        Replicate the writes every interval.
+        :return: none, runs until cancelled.
+        """
+        while True:
+            replicated = await self.flush()
+            if replicated:
+                logger.debug('replicated %d writes to %s', replicated, self._target.NAME)
+            await asyncio.sleep(self._interval)
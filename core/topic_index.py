@@ -0,0 +1,141 @@
+from collections import Counter
+
+from core.sqlite_base import SQLiteDatabase
+
+
+class TopicIndex(SQLiteDatabase):
+    # the topic of the entries saved without one; the keyboards always offer it anyway
+    NO_TOPIC = 'None'
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS topics (
+            user_id INTEGER NOT NULL,
+            topic TEXT NOT NULL,
+            normalized TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, topic)
+        );
+        CREATE INDEX IF NOT EXISTS topics_user_id_normalized
+            ON topics (user_id, normalized);
+    '''
+    THREAD_NAME = 'sqlite-topics'
+
+    def __init__(self, path: str):
+        """
+        How often every user uses every topic, so topics can be suggested and looked up
+        without scanning the entries.
+        :param path: the SQLite database file.
+        """
+        super().__init__(path)
+
+    @staticmethod
+    def normalize(topic: str) -> str:
+        # "Work ", "work" and "WORK" are the same topic
+        return ' '.join(topic.casefold().split())
+
+    async def is_indexed(self, user_id: int) -> bool:
+        return await self._run(self._is_indexed, user_id)
+
+    async def build(self, user_id: int, topics: list) -> None:
+        """
+        Count all of the user's topics from scratch.
+        :param user_id: the user's Telegram ID.
+        :param topics: the topics of all of the user's entries.
+        """
+        await self._run(self._build, user_id, topics)
+
+    async def add(self, user_id: int, topic: str) -> None:
+        """
+        Count a new entry's topic; users who haven't been indexed yet are left to build.
+        """
+        await self._run(self._add, user_id, topic)
+
+    async def remove(self, user_id: int, topic: str) -> None:
+        await self._run(self._remove, user_id, topic)
+
+    async def most_used(self, user_id: int, limit: int = 6) -> list:
+        """
+        :param user_id: the user's Telegram ID.
+        :param limit: how many topics to return at most.
+        :return: the user's most used topics, each in its most used spelling, NO_TOPIC left out.
+        """
+        return await self._run(self._most_used, user_id, limit)
+
+    async def resolve(self, user_id: int, query: str) -> list:
+        """
+        Find the topics the user means, ignoring case and extra spaces.
+        :param user_id: the user's Telegram ID.
+        :param query: the topic or the beginning of it.
+        :return: every spelling of the matching topic, or of all the topics that start with
+        the query if none matches exactly.
+        """
+        return await self._run(self._resolve, user_id, self.normalize(query))
+
+    def _is_indexed(self, user_id: int) -> bool:
+        return self._db.execute(
+            'SELECT 1 FROM users WHERE user_id = ?', (user_id,)
+        ).fetchone() is not None
+
+    def _build(self, user_id: int, topics: list) -> None:
+        with self._db:
+            self._db.execute('BEGIN')
+            self._db.execute('DELETE FROM topics WHERE user_id = ?', (user_id,))
+            self._db.execute('INSERT OR REPLACE INTO users VALUES (?)', (user_id,))
+            self._db.executemany(
+                'INSERT INTO topics VALUES (?, ?, ?, ?)',
+                (
+                    (user_id, topic, self.normalize(topic), count)
+                    for topic, count in Counter(topics).items()
+                )
+            )
+
+    def _add(self, user_id: int, topic: str) -> None:
+        with self._db:
+            self._db.execute('BEGIN')
+            if self._is_indexed(user_id):
+                self._db.execute(
+                    'INSERT INTO topics VALUES (?, ?, ?, 1) '
+                    'ON CONFLICT (user_id, topic) DO UPDATE SET count = count + 1',
+                    (user_id, topic, self.normalize(topic))
+                )
+
+    def _remove(self, user_id: int, topic: str) -> None:
+        with self._db:
+            self._db.execute('BEGIN')
+            self._db.execute(
+                'UPDATE topics SET count = count - 1 WHERE user_id = ? AND topic = ?',
+                (user_id, topic)
+            )
+            self._db.execute(
+                'DELETE FROM topics WHERE user_id = ? AND topic = ? AND count <= 0',
+                (user_id, topic)
+            )
+
+    def _most_used(self, user_id: int, limit: int) -> list:
+        rows = self._db.execute(
+            'SELECT topic, normalized, count FROM topics WHERE user_id = ? AND normalized != ? '
+            'ORDER BY count DESC, topic',
+            (user_id, self.normalize(self.NO_TOPIC))
+        ).fetchall()
+        totals, spellings = Counter(), {}
+        for topic, normalized, count in rows:
+            totals[normalized] += count
+            # rows come most used first, so the first spelling of a topic is the most used one
+            spellings.setdefault(normalized, topic)
+        return [spellings[normalized] for normalized, _ in totals.most_common(limit)]
+
+    def _resolve(self, user_id: int, normalized: str) -> list:
+        topics = self._db.execute(
+            'SELECT topic FROM topics WHERE user_id = ? AND normalized = ?',
+            (user_id, normalized)
+        ).fetchall()
+        if not topics:
+            # the range instead of LIKE, so the index is used and % or _ aren't wildcards
+            topics = self._db.execute(
+                'SELECT topic FROM topics WHERE user_id = ? '
+                'AND normalized >= ? AND normalized < ?',
+                (user_id, normalized, f'{normalized}\U0010ffff')
+            ).fetchall()
+        return [topic for topic, in topics]
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import re
+import sqlite3
+import time
+from typing import Optional
+
+from core.recognize_controller import Transcription
+from core.sqlite_base import SQLiteDatabase
+
+
+class TranscriptionCache(SQLiteDatabase):
+    # the entries keep the transcript with its punctuation fixed up, so only the words are compared
+    NON_WORD_REGEX = re.compile(r'[\W_]+')
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS transcriptions (
+            content_hash TEXT PRIMARY KEY,
+            file_unique_id TEXT,
+            text TEXT NOT NULL,
+            text_hash TEXT NOT NULL,
+            languages TEXT NOT NULL,
+            confidence REAL NOT NULL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            accessed_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS transcriptions_file_unique_id
+            ON transcriptions (file_unique_id);
+        CREATE INDEX IF NOT EXISTS transcriptions_text_hash
+            ON transcriptions (text_hash);
+        CREATE INDEX IF NOT EXISTS transcriptions_created_at
+            ON transcriptions (created_at);
+        CREATE INDEX IF NOT EXISTS transcriptions_accessed_at
+            ON transcriptions (accessed_at);
+    '''
+    THREAD_NAME = 'sqlite-transcriptions'
+
+    def __init__(self, path: str, max_size: int = 50 * 1024 * 1024, ttl: float = 30 * 86400):
+        """
+        An on-disk cache of transcriptions, so the same audio is never recognized twice.
+        :param path: the SQLite database file.
+        :param max_size: how many bytes of transcriptions to keep before evicting the LRU ones.
+        :param ttl: seconds a transcription stays valid.
+        """
+        super().__init__(path)
+        self._max_size = max_size
+        self._ttl = ttl
+        # kept up to date by every write, so the eviction doesn't have to sum the table up
+        self._size = self._total_size()
+
+    @staticmethod
+    def hash(content: bytes) -> str:
+        return hashlib.sha256(content).hexdigest()
+
+    @classmethod
+    def text_hash(cls, text: str) -> str:
+        return cls.hash(cls.NON_WORD_REGEX.sub(' ', text).strip().lower().encode())
+
+    def _total_size(self) -> int:
+        return self._db.execute('SELECT COALESCE(SUM(size), 0) FROM transcriptions').fetchone()[0]
+
+    async def get(
+        self, content_hash: str, file_unique_id: Optional[str] = None
+    ) -> Optional[Transcription]:
+        """
+        Look a transcription up by the Telegram file first, then by the audio itself.
+        :param content_hash: the hash of the audio, see TranscriptionCache.hash.
+        :param file_unique_id: Telegram's file_unique_id of the voice message.
+        :return: the cached transcription or None.
+        """
+        return await self._run(self._get, content_hash, file_unique_id)
+
+    async def put(
+        self, content_hash: str, transcription: Transcription, file_unique_id: Optional[str] = None
+    ) -> None:
+        await self._run(self._put, content_hash, transcription, file_unique_id)
+
+    async def remove(self, text: str) -> None:
+        """
+        Forget the transcriptions of an entry, e.g. once the user deletes it.
+        :param text: the entry's text.
+        """
+        await self._run(self._remove, self.text_hash(text))
+
+    def _get(self, content_hash: str, file_unique_id: Optional[str]) -> Optional[Transcription]:
+        now = time.time()
+        row = self._db.execute(
+            'SELECT content_hash, text, languages, confidence FROM transcriptions '
+            'WHERE (file_unique_id = ? OR content_hash = ?) AND created_at > ? '
+            'ORDER BY file_unique_id = ? DESC LIMIT 1',
+            (file_unique_id, content_hash, now - self._ttl, file_unique_id)
+        ).fetchone()
+        if row is None:
+            return None
+        self._db.execute(
+            'UPDATE transcriptions SET accessed_at = ? WHERE content_hash = ?', (now, row[0])
+        )
+        return Transcription(text=row[1], languages=json.loads(row[2]), confidence=row[3])
+
+    def _put(
+        self, content_hash: str, transcription: Transcription, file_unique_id: Optional[str]
+    ) -> None:
+        languages = json.dumps(transcription.languages, separators=(',', ':'))
+        size = len(transcription.text.encode()) + len(languages)
+        now = time.time()
+        try:
+            self._write(content_hash, transcription, file_unique_id, languages, size, now)
+        except sqlite3.Error:
+            # the transaction was rolled back, and the size with it
+            self._size = self._total_size()
+            raise
+
+    def _write(
+        self, content_hash: str, transcription: Transcription, file_unique_id: Optional[str],
+        languages: str, size: int, now: float
+    ) -> None:
+        with self._db:
+            self._db.execute('BEGIN')
+            replaced = self._db.execute(
+                'SELECT size FROM transcriptions WHERE content_hash = ?', (content_hash,)
+            ).fetchone()
+            self._db.execute(
+                'INSERT OR REPLACE INTO transcriptions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    content_hash, file_unique_id, transcription.text,
+                    self.text_hash(transcription.text), languages, transcription.confidence,
+                    size, now, now,
+                )
+            )
+            self._size += size - (replaced[0] if replaced else 0)
+            self._evict(now)
+
+    def _remove(self, text_hash: str) -> None:
+        self._delete('DELETE FROM transcriptions WHERE text_hash = ? RETURNING size', (text_hash,))
+
+    def _delete(self, sql: str, params: tuple) -> None:
+        self._size -= sum(size for size, in self._db.execute(sql, params).fetchall())
+
+    def _evict(self, now: float) -> None:
+        self._delete(
+            'DELETE FROM transcriptions WHERE created_at <= ? RETURNING size', (now - self._ttl,)
+        )
+        if self._size <= self._max_size:
+            return
+        # drop the least recently used rows until the rest fits
+        self._delete('''
+            DELETE FROM transcriptions WHERE content_hash IN (
+                SELECT content_hash FROM (
+                    SELECT content_hash, SUM(size) OVER (
+                        ORDER BY accessed_at, content_hash ROWS UNBOUNDED PRECEDING
+                    ) - size AS freed_before
+                    FROM transcriptions
+                ) WHERE freed_before < ?
+            ) RETURNING size
+        ''', (self._size - self._max_size,))
@@ -1,14 +1,43 @@
+import asyncio
+import json
+import logging
+import time
+from collections import Counter
 from enum import Enum
 from typing import Optional
 
-from core import FileController
+from aiogram import types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from core import AudioClip
+from core.session_store import (
+    AbstractSessionStore,
+    MemorySessionStore,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+def update_user_id(update: types.Update) -> Optional[int]:
+    """
+    :return: the Telegram ID of the user who caused the update, None if there's none.
+    """
+    for event in (
+        update.message, update.edited_message, update.callback_query, update.inline_query,
+        update.chosen_inline_result, update.shipping_query, update.pre_checkout_query,
+        update.my_chat_member, update.chat_member,
+    ):
+        if event is not None and event.from_user is not None:
+            return event.from_user.id
+    if update.poll_answer is not None:
+        return update.poll_answer.user.id
+    return None
 
 
 class UserState(Enum):
     IDLE = 'IDLE'
     AUDIO_INPUT_TOPIC = 'AUD_INP_TP'
-    AUDIO_AUTO_LANGUAGE = 'AUD_AUT_LN'
-    AUDIO_INPUT_LANGUAGE = 'AUD_INP_LN'
     AUDIO_PROCESSING = 'AUD_PR'
     GET_ALL = 'GET_ALL'
     GET_LAST_N = 'GET_LAST_N'
@@ -16,13 +45,12 @@ class UserState(Enum):
     GET_ALL_BETWEEN = 'GET_ALL_BW'
     GET_ALL_AFTER = 'GET_ALL_AF'
     GET_BY_TOPIC = 'GET_ALL_TP'
+    SEARCH = 'SEARCH'
 
     @staticmethod
     def AUDIO_STATES():   # NOSONAR
         return [
             UserState.AUDIO_INPUT_TOPIC,
-            UserState.AUDIO_INPUT_LANGUAGE,
-            UserState.AUDIO_AUTO_LANGUAGE,
             UserState.AUDIO_PROCESSING
         ]
 
@@ -55,6 +83,14 @@ class User:
         self._id = user_id
         self._state = state
         self._current_entry = current_entry
+        self._voice_message = None
+        # Telegram's file_id, file_unique_id and duration of the voice message, to download it
+        # again if the session is restored where its recognition isn't running
+        self._voice = None
+        self._recognition_job = None
+        self._recognition_expiry = None
+        # the wall-clock time the pending entry is dropped at, which outlives the process
+        self._expires_at = None
 
     def set_state(self, state: UserState) -> None:
         self._state = state
@@ -87,19 +123,109 @@ class User:
         else:
             self._current_entry = Entry(topic, text, date, timestamp, language)
 
+    def choose_topic(self, topic: str):
+        # the entry is cached with a placeholder topic, so the one the user picks replaces it
+        if self._current_entry:
+            self._current_entry.topic = topic
+        else:
+            self._current_entry = Entry(topic=topic)
+
+    @property
+    def voice_message(self) -> Optional[AudioClip]:
+        return self._voice_message
+
     @property
-    def voice_message_filename(self) -> str:
-        return f'{self._id}_{self._current_entry.timestamp}'
+    def voice(self) -> Optional[tuple]:
+        return self._voice
+
+    def cache_voice_message(self, audio: AudioClip, file_id: str):
+        self._voice_message = audio
+        self._voice = (file_id, audio.file_id, audio.duration)
+
+    @property
+    def recognition_job(self) -> Optional[asyncio.Task]:
+        return self._recognition_job
+
+    def start_recognition(self, job: asyncio.Task, ttl: float):
+        self._recognition_job = job
+        # the user may never pick a topic, so the job must not hang around forever
+        self._recognition_expiry = asyncio.get_running_loop().call_later(
+            ttl, self._expire_recognition, job
+        )
+        self._expires_at = time.time() + ttl
+
+    def _expire_recognition(self, job: asyncio.Task):
+        if self._recognition_job is job and self.is_state(UserState.AUDIO_INPUT_TOPIC):
+            self.clear_cache()
+
+    def _cancel_recognition(self):
+        if self._recognition_expiry:
+            self._recognition_expiry.cancel()
+        if self._recognition_job:
+            if not self._recognition_job.done():
+                self._recognition_job.cancel()
+            elif not self._recognition_job.cancelled():
+                # mark a failure nobody awaited as retrieved, it's been dealt with
+                self._recognition_job.exception()
+        self._recognition_job = None
+        self._recognition_expiry = None
 
     def clear_cache(self):
-        FileController.remove_files(filename=self.voice_message_filename)
+        self._cancel_recognition()
+        self._voice_message = None
+        self._voice = None
         self._current_entry = None
+        self._expires_at = None
         self.set_state(UserState.IDLE)
 
+    def dump(self) -> bytes:
+        """
+        :return: the user's session: everything but the voice message and its recognition,
+        which only live in this process.
+        """
+        entry = self._current_entry
+        return json.dumps(
+            [
+                self._state.value if self._state else None,
+                [entry.topic, entry.text, entry.date, entry.timestamp, entry.language]
+                if entry else None,
+                self._voice,
+                self._expires_at,
+            ],
+            ensure_ascii=False, separators=(',', ':')
+        ).encode()
+
+    def restore(self, session: bytes) -> None:
+        """
+        Take the state from a session saved by dump, here or in another process.
+        """
+        state, entry, voice, expires_at = json.loads(session)
+        voice = tuple(voice) if voice else None
+        if voice is None or self._voice is None or self._voice[1] != voice[1]:
+            # the recognition running here is of a voice message the session no longer has
+            self._cancel_recognition()
+            self._voice_message = None
+        self._state = UserState(state) if state else None
+        self._current_entry = Entry(*entry) if entry else None
+        self._voice = voice
+        self._expires_at = expires_at
+        if self.is_state_in(UserState.AUDIO_STATES()) and expires_at and expires_at < time.time():
+            # the entry expired while no process was keeping an eye on it
+            self.clear_cache()
+
 
 class UserController:
-    def __init__(self, users: dict):
-        self.users = users
+    def __init__(self, store: Optional[AbstractSessionStore] = None):
+        """
+        The users this process is talking to, with their sessions kept in the store.
+        :param store: where the sessions are kept between updates, in this process by default.
+        """
+        self.users = {}
+        self._store = store if store is not None else MemorySessionStore()
+        # the sessions as the store has them, so unchanged ones aren't written again
+        self._stored = {}
+        # the updates of every user being handled in this process right now
+        self._updates = Counter()
 
     def user(self, uid) -> Optional[User]:
         return self.users.get(uid, None)
@@ -112,3 +238,71 @@ class UserController:
             self.users[uid] = User(user_id=uid, state=UserState.IDLE)
         else:
             self.user(uid).set_state(UserState.IDLE)
+
+    async def begin_update(self, uid: int) -> None:
+        """
+        Load the user's session before an update is handled.
+        """
+        self._updates[uid] += 1
+        if self._updates[uid] > 1:
+            # another update of the user is in progress here, so this process is up to date
+            return
+        try:
+            session = (await self._store.load([uid])).get(uid)
+        except self._store.ERRORS as e:
+            logger.warning('failed to load the session of %s: %s', uid, e)
+            return
+        if session is None:
+            return
+        if self.user(uid) is None:
+            self.users[uid] = User(user_id=uid, state=None)
+        self.user(uid).restore(session)
+        self._stored[uid] = session
+
+    async def end_update(self, uid: int) -> None:
+        """
+        Save the user's session after an update is handled.
+        """
+        try:
+            await self.save(uid)
+        finally:
+            self._updates[uid] -= 1
+            if not self._updates[uid]:
+                del self._updates[uid]
+
+    async def save(self, uid: int) -> None:
+        user = self.user(uid)
+        if user is None:
+            return
+        session = user.dump()
+        if self._stored.get(uid) == session:
+            return
+        try:
+            await self._store.save({uid: session})
+        except self._store.ERRORS as e:
+            logger.warning('failed to save the session of %s: %s', uid, e)
+        else:
+            self._stored[uid] = session
+
+    def close(self) -> None:
+        self._store.close()
+
+
+class SessionMiddleware(BaseMiddleware):
+    def __init__(self, user_controller: UserController):
+        """
+        Loads the session of the user behind every update before the handlers run,
+        and saves it after them: one read and at most one write per update.
+        """
+        super().__init__()
+        self._user_controller = user_controller
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        uid = update_user_id(update)
+        if uid is not None:
+            await self._user_controller.begin_update(uid)
+
+    async def on_post_process_update(self, update: types.Update, results: list, data: dict):
+        uid = update_user_id(update)
+        if uid is not None:
+            await self._user_controller.end_update(uid)
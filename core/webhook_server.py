@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import signal
+from typing import (
+    Callable,
+    Optional,
+)
+
+from aiogram import types
+from aiogram.dispatcher import Dispatcher
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiohttp import web
+
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookServer:
+    HEALTH_PATH = '/health'
+    # the signals that start a graceful shutdown, as they do in aiohttp
+    SHUTDOWN_SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+    def __init__(
+        self, path: str = '/webhook', max_concurrent_updates: int = 32,
+        drain_timeout: float = 30, stats: Optional[Callable[[], dict]] = None
+    ):
+        """
+        The aiohttp app the webhook runs on: limits how many updates are handled at once,
+        reports its health to the load balancer and lets the updates in progress finish
+        before the bot shuts down.
+        :param path: the path Telegram posts the updates to.
+        :param max_concurrent_updates: updates handled at once; the others wait for their turn.
+        :param drain_timeout: seconds the shutdown waits for the updates in progress.
+        :param stats: more stats for the health endpoint, e.g. WorkerPool.stats.
+        """
+        self._path = path
+        self._max_concurrent_updates = max_concurrent_updates
+        self._drain_timeout = drain_timeout
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._idle: Optional[asyncio.Event] = None
+        # the tasks aiogram handles the updates in; they outlive their requests after 55 s
+        self._in_flight = set()
+        self._handled = 0
+        self._draining = False
+        self._shutdown: Optional[asyncio.Task] = None
+        self.stats = stats
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._in_flight)
+
+    def create_app(self) -> web.Application:
+        """
+        :return: the app to pass to aiogram's set_webhook, which adds the webhook route itself.
+        """
+        app = web.Application(middlewares=[self._refuse_when_draining])
+        app.router.add_get(self.HEALTH_PATH, self._health)
+        return app
+
+    def setup(self, dispatcher: Dispatcher) -> None:
+        """
+        Count and limit the updates the dispatcher handles, from start to finish.
+        """
+        dispatcher.middleware.setup(UpdateTrackingMiddleware(self))
+
+    @web.middleware
+    async def _refuse_when_draining(
+        self, request: web.Request, handler
+    ) -> web.StreamResponse:
+        if request.path == self._path and self._draining:
+            # Telegram delivers the update again later, to this replica or another one
+            raise web.HTTPServiceUnavailable()
+        return await handler(request)
+
+    async def track(self, task: asyncio.Task) -> None:
+        """
+        Wait for a turn to handle an update, then count it in until its task is done.
+        :param task: the task the update is handled in.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrent_updates)
+            self._idle = asyncio.Event()
+        self._in_flight.add(task)
+        self._idle.clear()
+        try:
+            await self._semaphore.acquire()
+        except BaseException:
+            self._untrack(task, acquired=False)
+            raise
+        # a done callback, so an update is let go however its handlers and middlewares end
+        task.add_done_callback(self._untrack)
+
+    def _untrack(self, task: asyncio.Task, acquired: bool = True) -> None:
+        if acquired:
+            self._semaphore.release()
+            self._handled += 1
+        self._in_flight.discard(task)
+        if not self._in_flight:
+            self._idle.set()
+
+    async def _health(self, request: web.Request) -> web.Response:
+        health = dict(
+            status='draining' if self._draining else 'ok',
+            in_flight=self.in_flight,
+            max_concurrent_updates=self._max_concurrent_updates,
+            handled=self._handled,
+        )
+        if self.stats is not None:
+            health.update(self.stats())
+        return web.json_response(
+            health,
+            # the load balancer stops sending traffic to a replica that is going away
+            status=503 if self._draining else 200,
+        )
+
+    def handle_signals(self) -> None:
+        """
+        Drain on SIGINT and SIGTERM while the server still answers, and only then let aiohttp
+        shut down; call it once the app has started, so it replaces aiohttp's own handlers.
+        """
+        loop = asyncio.get_running_loop()
+        for signum in self.SHUTDOWN_SIGNALS:
+            loop.add_signal_handler(signum, self._on_signal)
+
+    def _on_signal(self) -> None:
+        if self._shutdown is None:
+            self._shutdown = asyncio.ensure_future(self._drain_and_exit())
+
+    async def _drain_and_exit(self) -> None:
+        await self.drain()
+        # what aiohttp's own handler raises; it stops the sites, then runs on_shutdown
+        raise web.GracefulExit()
+
+    async def drain(self) -> None:
+        """
+        Refuse new updates and wait for the ones in progress, e.g. on SIGTERM.
+        """
+        self._draining = True
+        if not self._in_flight:
+            return
+        logger.info('waiting for %d updates in progress', self.in_flight)
+        try:
+            await asyncio.wait_for(self._idle.wait(), self._drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning('shutting down with %d updates still in progress', self.in_flight)
+
+
+class UpdateTrackingMiddleware(BaseMiddleware):
+    def __init__(self, server: WebhookServer):
+        """
+        Hands every update's task to the webhook server, which holds it until the task is done.
+        """
+        super().__init__()
+        self._server = server
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        # aiogram handles every webhook update in a task of its own
+        await self._server.track(asyncio.current_task())
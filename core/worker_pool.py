@@ -0,0 +1,230 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import time
+from collections import deque
+from typing import (
+    Callable,
+    Optional,
+)
+
+from aiogram import types
+from aiogram.bot import Bot
+from aiogram.dispatcher import Dispatcher
+
+from core.user_controller import update_user_id
+
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateWorker:
+    def __init__(
+        self, index: int, updates: multiprocessing.Queue, metrics: multiprocessing.Queue,
+        metrics_interval: float = 10, stats: Optional[Callable[[], dict]] = None
+    ):
+        """
+        Handles the updates the supervisor sends to one worker process.
+        :param index: the worker's number.
+        :param updates: the updates as dicts; None tells the worker to stop.
+        :param metrics: where the worker reports its metrics to the supervisor.
+        :param metrics_interval: seconds between the reports.
+        :param stats: more stats to report, e.g. DatabaseController.stats.
+        """
+        self._index = index
+        self._updates = updates
+        self._metrics = metrics
+        self._metrics_interval = metrics_interval
+        self._stats = stats
+        self._handled = 0
+        self._errors = 0
+        self._in_flight = set()
+        self._latencies = deque(maxlen=100)
+
+    async def run(self, dispatcher: Dispatcher) -> None:
+        """
+        Handle the updates until the supervisor says to stop, then wait for the ones in progress.
+        :param dispatcher: the dispatcher with the bot's handlers.
+        """
+        loop = asyncio.get_running_loop()
+        reporter = asyncio.create_task(self._report())
+        try:
+            while True:
+                # the queue blocks, so it's read in a thread
+                data = await loop.run_in_executor(None, self._updates.get)
+                if data is None:
+                    break
+                task = asyncio.create_task(self._process(dispatcher, types.Update(**data)))
+                self._in_flight.add(task)
+                task.add_done_callback(self._in_flight.discard)
+            if self._in_flight:
+                await asyncio.gather(*self._in_flight, return_exceptions=True)
+        finally:
+            reporter.cancel()
+            self._put_metrics()
+
+    async def _process(self, dispatcher: Dispatcher, update: types.Update) -> None:
+        start = time.monotonic()
+        try:
+            # the way polling and the webhook pass updates in, so the middlewares run too
+            await dispatcher.updates_handler.notify(update)
+            self._handled += 1
+        except Exception as e:
+            self._errors += 1
+            logger.exception(
+                'worker %d failed to handle update %s: %s', self._index, update.update_id, e
+            )
+        finally:
+            self._latencies.append(time.monotonic() - start)
+
+    async def _report(self) -> None:
+        while True:
+            await asyncio.sleep(self._metrics_interval)
+            self._put_metrics()
+
+    def _put_metrics(self) -> None:
+        latencies = list(self._latencies)
+        metrics = dict(
+            worker=self._index,
+            pid=os.getpid(),
+            handled=self._handled,
+            errors=self._errors,
+            in_flight=len(self._in_flight),
+            avg_latency=sum(latencies) / len(latencies) if latencies else 0.0,
+            max_latency=max(latencies, default=0.0),
+        )
+        if self._stats is not None:
+            metrics['stats'] = self._stats()
+        try:
+            self._metrics.put_nowait(metrics)
+        except queue.Full:
+            pass
+
+
+class WorkerPool:
+    def __init__(
+        self, workers: int, target: Callable, max_queue: int = 1000,
+        stop_timeout: float = 60
+    ):
+        """
+        Runs the bot's handlers in several processes; every update of a user goes to the same one,
+        so the user's state lives in one process.
+        :param workers: the number of worker processes.
+        :param target: a module-level function the workers run with their index, updates queue
+        and metrics queue, e.g. one that runs UpdateWorker.run.
+        :param max_queue: updates waiting for one worker before the supervisor waits too.
+        :param stop_timeout: seconds a worker gets to finish its updates before it's killed.
+        """
+        self._workers = workers
+        self._target = target
+        self._max_queue = max_queue
+        self._stop_timeout = stop_timeout
+        # spawn, so every worker creates its own event loop, Firestore and speech clients
+        self._context = multiprocessing.get_context('spawn')
+        self._queues = [self._context.Queue(max_queue) for _ in range(workers)]
+        self._metrics_queue = self._context.Queue()
+        self._processes = [None] * workers
+        self._metrics = {}
+        self._dispatched = [0] * workers
+        self._stopping = False
+
+    def start(self) -> None:
+        for index in range(self._workers):
+            self._start_worker(index)
+
+    def _start_worker(self, index: int) -> None:
+        process = self._context.Process(
+            target=self._target,
+            args=(index, self._queues[index], self._metrics_queue),
+            name=f'worker-{index}',
+        )
+        process.start()
+        self._processes[index] = process
+        logger.info('started worker %d, pid %d', index, process.pid)
+
+    def worker_index(self, update: types.Update) -> int:
+        user_id = update_user_id(update)
+        # Python's hash() of an int is stable across processes, unlike that of a str
+        return hash(user_id if user_id is not None else update.update_id) % self._workers
+
+    async def dispatch(self, update: types.Update) -> None:
+        """
+        Send the update to the worker that owns its user.
+        """
+        index = self.worker_index(update)
+        data = update.to_python()
+        try:
+            self._queues[index].put_nowait(data)
+        except queue.Full:
+            # the worker is behind, so the supervisor slows down instead of dropping updates
+            await asyncio.get_running_loop().run_in_executor(None, self._queues[index].put, data)
+        self._dispatched[index] += 1
+
+    async def watch(self) -> None:
+        """
+        Collect the workers' metrics and restart the workers that died, until stop.
+        """
+        loop = asyncio.get_running_loop()
+        while not self._stopping:
+            try:
+                metrics = await loop.run_in_executor(None, self._metrics_queue.get, True, 1)
+            except queue.Empty:
+                metrics = None
+            if metrics is not None:
+                self._metrics[metrics['worker']] = metrics
+                logger.info('worker metrics: %s', metrics)
+            for index, process in enumerate(self._processes):
+                if not self._stopping and process is not None and not process.is_alive():
+                    logger.warning(
+                        'worker %d exited with %s, restarting it', index, process.exitcode
+                    )
+                    self._start_worker(index)
+
+    def stats(self) -> dict:
+        """
+        :return: every worker's last reported metrics and the updates sent to it so far.
+        """
+        return dict(
+            workers=[
+                dict(self._metrics.get(index, dict(worker=index)), dispatched=dispatched)
+                for index, dispatched in enumerate(self._dispatched)
+            ]
+        )
+
+    async def stop(self) -> None:
+        """
+        Let the workers finish the updates they have, then stop them.
+        """
+        self._stopping = True
+        loop = asyncio.get_running_loop()
+        for updates in self._queues:
+            await loop.run_in_executor(None, updates.put, None)
+        for index, process in enumerate(self._processes):
+            if process is None:
+                continue
+            await loop.run_in_executor(None, process.join, self._stop_timeout)
+            if process.is_alive():
+                logger.warning('worker %d did not stop in time, killing it', index)
+                process.kill()
+        # the workers' last reports, sent as they stopped
+        while True:
+            try:
+                metrics = self._metrics_queue.get_nowait()
+            except queue.Empty:
+                break
+            self._metrics[metrics['worker']] = metrics
+
+
+class ShardedDispatcher(Dispatcher):
+    def __init__(self, bot: Bot, pool: WorkerPool):
+        """
+        Receives the updates like any dispatcher, by polling or on the webhook, but only passes
+        them to the worker processes, where the handlers are.
+        """
+        super().__init__(bot)
+        self._pool = pool
+
+    async def process_update(self, update: types.Update):
+        await self._pool.dispatch(update)
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from typing import Optional
+
+from core.storage import (
+    AbstractStorage,
+    PartialWriteError,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+class WriteQueue:
+    def __init__(self, storage: AbstractStorage, max_batch: int = 500, window: float = 0.05):
+        """
+        Collects the writes that arrive close together and commits them to the storage at once.
+        :param storage: the storage to write to.
+        :param max_batch: a batch this big is committed without waiting for the window to end.
+        :param window: seconds the first write of a batch waits for others to join it.
+        """
+        self._storage = storage
+        self._max_batch = max_batch
+        self._window = window
+        self._pending = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # one commit at a time, so the writes reach the storage in the order they were made
+        self._commit_lock: Optional[asyncio.Lock] = None
+        self._flushes = set()
+
+    async def submit(
+        self, operation: str, user_id: int, entry_id: str, data: Optional[dict] = None
+    ) -> None:
+        """
+        Queue a write and wait until the batch it's in is committed.
+        :param operation: AbstractStorage.CREATE or AbstractStorage.DELETE.
+        :param user_id: the user's Telegram ID.
+        :param entry_id: the entry's ID.
+        :param data: the entry's data, None for a delete.
+        :return: none, raises whatever the storage raised for the part of the batch
+        the write is in.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append(((operation, user_id, entry_id, data), future))
+        if len(self._pending) >= self._max_batch:
+            self._schedule_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._window, self._schedule_flush)
+        # the caller giving up doesn't take the write out of the batch
+        await asyncio.shield(future)
+
+    def _schedule_flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        flush = asyncio.ensure_future(self.flush())
+        self._flushes.add(flush)
+        flush.add_done_callback(self._flushes.discard)
+
+    async def flush(self) -> None:
+        """
+        Commit everything queued so far, max_batch writes per commit.
+        :return: none; the errors go to the writers waiting for them.
+        """
+        if self._commit_lock is None:
+            self._commit_lock = asyncio.Lock()
+        async with self._commit_lock:
+            while self._pending:
+                batch, self._pending = (
+                    self._pending[:self._max_batch], self._pending[self._max_batch:]
+                )
+                error, committed = None, range(len(batch))
+                try:
+                    await self._storage.apply_writes([write for write, _ in batch])
+                except PartialWriteError as e:
+                    # the storage commits a batch in parts, and the ones before the failure are in
+                    error, committed = e.error, e.committed
+                except Exception as e:
+                    error, committed = e, ()
+                if error is None:
+                    logger.debug('committed a batch of %d writes', len(batch))
+                else:
+                    logger.warning(
+                        '%d of a batch of %d writes failed: %s',
+                        len(batch) - len(committed), len(batch), error
+                    )
+                for index, (_, future) in enumerate(batch):
+                    if future.done():
+                        continue
+                    if index in committed:
+                        future.set_result(None)
+                    else:
+                        future.set_exception(error)
+
+    async def close(self) -> None:
+        """
+        Commit whatever is still queued, e.g. on shutdown.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self.flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
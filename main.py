@@ -1,27 +1,57 @@
+import asyncio
+import io
+import logging
 import os
-from collections import defaultdict
+import signal
 
 from dotenv import load_dotenv
 from functools import wraps
 
-import google.api_core.exceptions as google_api_exc
-import google.auth.exceptions as google_auth_exc
-
 from aiogram import types
 from aiogram.bot import Bot
 from aiogram.dispatcher import Dispatcher
 from aiogram.utils import executor
+from aiogram.utils.exceptions import TelegramAPIError
+from aiohttp import ClientError
 
 from core import (
+    AudioClip,
+    ConversionError,
     Responder,
     FileController,
     UserState,
     UserController,
+    AbstractSessionStore,
+    MemorySessionStore,
+    RedisSessionStore,
+    SessionMiddleware,
+    SQLiteSessionStore,
     DatabaseController,
+    DatabaseError,
+    EntryCache,
+    FirestoreStorage,
+    OutboundSender,
+    SQLiteStorage,
+    StorageReplicator,
+    RecognitionBackendError,
+    RecognitionBusyError,
     RecognitionController,
+    RecognitionRouter,
+    RecognitionService,
+    RecognitionTimeoutError,
+    SearchIndex,
+    TopicIndex,
+    Transcription,
+    TranscriptionCache,
+    ShardedDispatcher,
+    UpdateWorker,
+    WebhookServer,
+    WorkerPool,
+    WriteQueue,
 )
 from utils import (
     DateFormatter,
+    EntryExporter,
     EntryFormatter,
     MessageTypes,
 )
@@ -29,20 +59,160 @@ from utils import (
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 bot = Bot(token=os.getenv('TOKEN'))
 dp = Dispatcher(bot)
 
-db_controller = DatabaseController(
-    project_id=os.environ.get('FIREBASE_PROJECT_ID'),
-    private_key_id=os.environ.get('FIREBASE_PRIVATE_KEY_ID'),
-    private_key=os.environ.get('FIREBASE_PRIVATE_KEY'),
-    client_email=os.environ.get('FIREBASE_CLIENT_EMAIL'),
-    client_id=os.environ.get('FIREBASE_CLIENT_ID'),
-    cert_url=os.environ.get('FIREBASE_CLIENT_X509_CERT_URL')
-)
+# bytes of users' entries kept in memory to answer queries without Firestore, 0 disables it
+ENTRY_CACHE_MAX_SIZE = int(os.getenv('ENTRY_CACHE_MAX_SIZE', 16 * 1024 * 1024))
+
+# how many entries "Get all the entries" sends before asking whether to show more
+ENTRIES_PAGE_SIZE = int(os.getenv('ENTRIES_PAGE_SIZE', 10))
+
+# the public URL Telegram posts the updates to, e.g. https://diary.example.com behind a load
+# balancer; the bot polls for updates when it's not set
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_MAX_CONCURRENT_UPDATES = int(os.getenv('WEBHOOK_MAX_CONCURRENT_UPDATES', 32))
+
+webhook_server = WebhookServer(
+    path=WEBHOOK_PATH,
+    max_concurrent_updates=WEBHOOK_MAX_CONCURRENT_UPDATES,
+    drain_timeout=float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', 30)),
+) if WEBHOOK_URL else None
+
+# worker processes that handle the updates, each user's always in the same one, and seconds
+# between their metrics reports; 0 handles everything in this process
+WORKERS = int(os.getenv('WORKERS', 0))
+WORKER_METRICS_INTERVAL = float(os.getenv('WORKER_METRICS_INTERVAL', 10))
+
+# where the entries are kept: firestore, or sqlite to run without the network
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'firestore')
+# seconds between pushing the writes made to SQLite to Firestore, 0 disables it
+STORAGE_REPLICATION_INTERVAL = float(os.getenv('STORAGE_REPLICATION_INTERVAL', 0))
+
+
+def create_firestore_storage() -> FirestoreStorage:
+    return FirestoreStorage(
+        project_id=os.environ.get('FIREBASE_PROJECT_ID'),
+        private_key_id=os.environ.get('FIREBASE_PRIVATE_KEY_ID'),
+        private_key=os.environ.get('FIREBASE_PRIVATE_KEY'),
+        client_email=os.environ.get('FIREBASE_CLIENT_EMAIL'),
+        client_id=os.environ.get('FIREBASE_CLIENT_ID'),
+        cert_url=os.environ.get('FIREBASE_CLIENT_X509_CERT_URL'),
+        day_rollups=bool(int(os.getenv('FIRESTORE_DAY_ROLLUPS', 0))),
+    )
+
+
+# seconds a write waits for others to be committed together with it, 0 commits every write alone
+WRITE_BATCH_WINDOW = float(os.getenv('WRITE_BATCH_WINDOW', 0.05))
+
+# how many of the user's most used topics the topic keyboards offer
+FREQUENT_TOPICS = int(os.getenv('FREQUENT_TOPICS', 6))
+
+# how many entries a search sends, best match first
+SEARCH_RESULTS = int(os.getenv('SEARCH_RESULTS', 10))
+
+# the format of an export when /export doesn't name one, and how many entries it reads at once
+EXPORT_FORMAT = os.getenv('EXPORT_FORMAT', EntryExporter.ZIP)
+EXPORT_PAGE_SIZE = int(os.getenv('EXPORT_PAGE_SIZE', 500))
+
+# seconds a voice message waits for its topic before it's dropped
+PENDING_ENTRY_TTL = float(os.getenv('PENDING_ENTRY_TTL', 600))
+
+# where the users' sessions are kept between updates: memory, sqlite to survive restarts,
+# or redis to share them between replicas
+SESSION_STORE = os.getenv('SESSION_STORE', 'memory')
+
+
+def create_session_store() -> AbstractSessionStore:
+    if SESSION_STORE == 'sqlite':
+        return SQLiteSessionStore(path=os.getenv('SESSION_SQLITE_PATH', 'sessions.sqlite3'))
+    if SESSION_STORE == 'redis':
+        return RedisSessionStore(
+            host=os.getenv('REDIS_HOST', 'localhost'),
+            port=int(os.getenv('REDIS_PORT', 6379)),
+            db=int(os.getenv('REDIS_DB', 0)),
+            password=os.getenv('REDIS_PASSWORD') or None,
+            ttl=int(os.getenv('SESSION_TTL', 0)) or None,
+        )
+    return MemorySessionStore()
 
-USER_DATA = defaultdict(defaultdict)
-user_controller = UserController(USER_DATA)
+
+def create_services():
+    """
+    Build what the handlers use; only the processes that run the handlers need it,
+    so a supervisor of worker processes doesn't.
+    """
+    global storage, storage_replicator, db_controller, recognition_router, recognition_service
+    global user_controller
+
+    if STORAGE_BACKEND == SQLiteStorage.NAME:
+        storage = SQLiteStorage(
+            path=os.getenv('SQLITE_PATH', 'diary.sqlite3'),
+            replicate=bool(STORAGE_REPLICATION_INTERVAL),
+        )
+        storage_replicator = StorageReplicator(
+            source=storage, target=create_firestore_storage(),
+            interval=STORAGE_REPLICATION_INTERVAL,
+        ) if STORAGE_REPLICATION_INTERVAL else None
+    else:
+        storage = create_firestore_storage()
+        storage_replicator = None
+
+    transcription_cache = TranscriptionCache(
+        path=os.getenv('TRANSCRIPTION_CACHE_PATH'),
+        max_size=int(os.getenv('TRANSCRIPTION_CACHE_MAX_SIZE', 50 * 1024 * 1024)),
+        ttl=float(os.getenv('TRANSCRIPTION_CACHE_TTL', 30 * 86400)),
+    ) if os.getenv('TRANSCRIPTION_CACHE_PATH') else None
+
+    db_controller = DatabaseController(
+        storage=storage,
+        cache=EntryCache(max_size=ENTRY_CACHE_MAX_SIZE) if ENTRY_CACHE_MAX_SIZE else None,
+        write_queue=(
+            WriteQueue(storage, window=WRITE_BATCH_WINDOW) if WRITE_BATCH_WINDOW else None
+        ),
+        search_index=SearchIndex(path=os.getenv('SEARCH_INDEX_PATH', 'search.sqlite3')),
+        topic_index=TopicIndex(path=os.getenv('TOPIC_INDEX_PATH', 'topics.sqlite3')),
+        transcription_cache=transcription_cache,
+    )
+
+    Responder.sender = OutboundSender(
+        # Telegram's limit is for the whole bot, so every worker process gets its share of it
+        global_rate=float(os.getenv('OUTBOUND_GLOBAL_RATE', 30)) / max(WORKERS, 1),
+        chat_rate=float(os.getenv('OUTBOUND_CHAT_RATE', 1)),
+        chat_burst=float(os.getenv('OUTBOUND_CHAT_BURST', 3)),
+    )
+
+    recognition_router = RecognitionRouter(
+        failure_threshold=int(os.getenv('RECOGNITION_FAILURE_THRESHOLD', 3)),
+        cooldown=float(os.getenv('RECOGNITION_COOLDOWN', 60)),
+    )
+
+    recognition_service = RecognitionService(
+        max_workers=int(os.getenv('RECOGNITION_WORKERS', 4)),
+        max_queue=int(os.getenv('RECOGNITION_QUEUE_SIZE', 16)),
+        timeout=float(os.getenv('RECOGNITION_TIMEOUT', 60)),
+        segment_duration=float(os.getenv('RECOGNITION_SEGMENT_DURATION', 50)),
+        vad_threshold=float(os.getenv('VAD_THRESHOLD')) if os.getenv('VAD_THRESHOLD') else None,
+        cache=transcription_cache,
+        router=recognition_router,
+    )
+
+    user_controller = UserController(create_session_store())
+    dp.middleware.setup(SessionMiddleware(user_controller))
+
+
+def service_stats() -> dict:
+    """
+    :return: what the monitoring sees of this process, on /health or in the worker metrics.
+    """
+    return dict(
+        database=db_controller.stats(),
+        recognition=recognition_service.stats(),
+        recognition_backends=recognition_router.stats(),
+    )
 
 
 def use_state(func):
@@ -68,11 +238,25 @@ async def process_start_command(uid: int, msg: types.Message):
 async def process_get_all(uid: int, msg: types.Message):
     if not user_controller.user(uid).is_state_in(UserState.AUDIO_STATES()):
         user_controller.user(uid).set_state(UserState.GET_ALL)
+        await print_entries_page(uid, msg)
+        user_controller.user(uid).set_state(UserState.IDLE)
 
-        entries = EntryFormatter.process_fetched(await db_controller.fetch_all(uid))
-        await print_entries(msg, entries)
 
-        user_controller.user(uid).set_state(UserState.IDLE)
+@dp.callback_query_handler(text_startswith=MessageTypes.Callbacks.MORE_ENTRIES)
+@use_state
+async def process_more_entries(uid: int, call: types.CallbackQuery):
+    # the button has done its job, so it can't be pressed twice
+    await call.message.edit_reply_markup()
+    await call.answer()
+    cursor = int(call.data[len(MessageTypes.Callbacks.MORE_ENTRIES):])
+    await print_entries_page(uid, call.message, after=cursor)
+
+
+async def print_entries_page(uid: int, msg: types.Message, after: int = None):
+    entries, cursor = await db_controller.fetch_page(uid, after=after, limit=ENTRIES_PAGE_SIZE)
+    await print_entries(msg, entries)
+    if cursor is not None:
+        await Responder.respond(msg, content=Responder.Types.MORE_ENTRIES(cursor))
 
 
 @dp.message_handler(text=MessageTypes.GetEntriesKeyboardChoices.GET_ALL_ENTRIES_BY_DATE)
@@ -178,7 +362,48 @@ async def process_number_of_entries_to_get_input(uid: int, msg: types.Message):
 async def process_get_by_topic_command(uid: int, msg: types.Message):
     if not user_controller.user(uid).is_state_in(UserState.AUDIO_STATES()):
         user_controller.user(uid).set_state(UserState.GET_BY_TOPIC)
-        await Responder.respond(msg, content=Responder.Types.GET_ALL_ENTRIES_BY_TOPIC)
+        topics = await db_controller.frequent_topics(uid, limit=FREQUENT_TOPICS)
+        await Responder.respond(msg, content=Responder.Types.GET_ALL_ENTRIES_BY_TOPIC(topics))
+
+
+@dp.message_handler(commands=MessageTypes.Commands.SEARCH)
+@dp.message_handler(text=MessageTypes.GetEntriesKeyboardChoices.SEARCH_ENTRIES)
+@use_state
+async def process_search_command(uid: int, msg: types.Message):
+    if not user_controller.user(uid).is_state_in(UserState.AUDIO_STATES()):
+        if msg.is_command() and msg.get_args():
+            # /search dentist
+            await print_search_results(uid, msg, query=msg.get_args())
+        else:
+            user_controller.user(uid).set_state(UserState.SEARCH)
+            await Responder.respond(msg, content=Responder.Types.SEARCH_ENTRIES)
+
+
+async def print_search_results(uid: int, msg: types.Message, query: str):
+    entries = await db_controller.search(uid, query, limit=SEARCH_RESULTS)
+    await print_entries(msg, entries)
+    user_controller.user(uid).set_state(UserState.IDLE)
+
+
+@dp.message_handler(commands=MessageTypes.Commands.EXPORT)
+@dp.message_handler(text=MessageTypes.GetEntriesKeyboardChoices.EXPORT_ENTRIES)
+@use_state
+async def process_export_command(uid: int, msg: types.Message):
+    if user_controller.user(uid).is_state_in(UserState.AUDIO_STATES()):
+        return
+    export_format = (msg.get_args() if msg.is_command() else None) or EXPORT_FORMAT
+    if export_format not in EntryExporter.FORMATS:
+        await Responder.respond(msg, content=Responder.Types.EXPORT_FORMATS)
+        return
+    # one document instead of a message per entry
+    file, count = await EntryExporter.export(
+        db_controller.iter_entries(uid, page_size=EXPORT_PAGE_SIZE), export_format
+    )
+    with file:
+        if count:
+            await Responder.respond_with_file(msg, file, EntryExporter.filename(export_format))
+        else:
+            await Responder.respond(msg, content=Responder.Types.ENTRIES_NOT_FOUND)
 
 
 @dp.message_handler(regexp=MessageTypes.RegularExpressions.MATCH_ANY_TEXT)
@@ -193,17 +418,16 @@ async def process_get_text_input(uid: int, msg: types.Message):
         await print_entries(msg, entries)
         user_controller.user(uid).set_state(UserState.IDLE)
 
+    elif user_controller.user(uid).is_state(UserState.SEARCH):
+        await print_search_results(uid, msg, query=msg.text)
+
     elif user_controller.user(uid).is_state(UserState.AUDIO_INPUT_TOPIC):
-        user_controller.user(uid).cache_entry_data(topic=msg.text)
-        # try auto-detecting the language with Speech-To-Text
-        user_controller.user(uid).set_state(UserState.AUDIO_AUTO_LANGUAGE)
-        await convert_voice_message_using_s2t(uid, msg)
-
-    elif user_controller.user(uid).is_state(UserState.AUDIO_INPUT_LANGUAGE):
-        # buttons also contain flag emojis, so we need to remove them from msg.text
-        user_controller.user(uid).cache_entry_data(language=msg.text[3:])
+        if user_controller.user(uid).recognition_job is None:
+            if not await resume_voice_recognition(uid, msg):
+                return
+        user_controller.user(uid).choose_topic(msg.text)
         user_controller.user(uid).set_state(UserState.AUDIO_PROCESSING)
-        await convert_voice_message_using_gapi(uid, msg)
+        await save_voice_message(uid, msg)
 
     elif user_controller.user(uid).is_state(UserState.IDLE) and delete_command:
         timestamp = int(delete_command.group(1))
@@ -221,48 +445,73 @@ async def process_voice_message(uid: int, msg: types.Message):
             date=datestamp, timestamp=timestamp, topic='None'
         )
 
-        voice_message = await bot.get_file(msg.voice.file_id)
-        await bot.download_file(voice_message.file_path, f'{msg.chat.id}_{timestamp}.ogg')
+        audio = await download_voice_message(
+            msg.voice.file_id, msg.voice.file_unique_id, msg.voice.duration
+        )
+        user_controller.user(uid).cache_voice_message(audio, file_id=msg.voice.file_id)
+        # the topic is only needed to save the entry, so recognition starts right away
+        start_voice_recognition(uid, audio)
 
         user_controller.user(uid).set_state(UserState.AUDIO_INPUT_TOPIC)
-        await Responder.respond(msg, content=Responder.Types.CHOOSE_TOPIC_FOR_NEW_ENTRY)
+        topics = await db_controller.frequent_topics(uid, limit=FREQUENT_TOPICS)
+        await Responder.respond(msg, content=Responder.Types.CHOOSE_TOPIC_FOR_NEW_ENTRY(topics))
 
 
-async def convert_voice_message_using_s2t(uid: int, msg: types.Message):
-    try:
-        filename = FileController.convert_ogg_to_wav(
-            filename=user_controller.user(uid).voice_message_filename
-        )
-        speech_recognizer = RecognitionController.strategy(recognition_type='s2t')
-        language, text = speech_recognizer.recognize(f'{filename}.wav')
+async def download_voice_message(file_id: str, file_unique_id: str, duration: float) -> AudioClip:
+    voice_message = await bot.get_file(file_id)
+    buffer = await bot.download_file(voice_message.file_path, destination=io.BytesIO())
+    return AudioClip(
+        content=buffer.getvalue(),
+        encoding=AudioClip.OGG_OPUS,
+        # Telegram doesn't report the layout; its voice notes are 48 kHz mono Opus
+        sample_rate=FileController.OPUS_SAMPLE_RATE,
+        channels=FileController.PCM_CHANNELS,
+        duration=duration,
+        file_id=file_unique_id,
+    )
 
-        user_controller.user(uid).cache_entry_data(
-            language=language, text=EntryFormatter.process_text(text)
-        )
-    except (google_api_exc.PermissionDenied, google_auth_exc.MalformedError):
-        # switching to Google Speech API
-        user_controller.user(uid).set_state(UserState.AUDIO_INPUT_LANGUAGE)
-        await Responder.respond(msg, content=Responder.Types.CHOOSE_LANGUAGE_FOR_NEW_ENTRY)
-    else:
-        if len(text):
-            eid = await db_controller.create_entry(uid, user_controller.user(uid).current_entry)
-            await Responder.respond(msg, content=Responder.Types.CREATE_ENTRY_SUCCESS(eid))
-        else:
-            await Responder.respond(msg, content=Responder.Types.TEXT_NOT_RECOGNIZED)
+
+def start_voice_recognition(uid: int, audio: AudioClip):
+    user_controller.user(uid).start_recognition(
+        asyncio.create_task(recognize_voice_message(audio)), ttl=PENDING_ENTRY_TTL
+    )
+
+
+async def resume_voice_recognition(uid: int, msg: types.Message) -> bool:
+    # the session came from before a restart or from another replica, without the recording
+    file_id, file_unique_id, duration = user_controller.user(uid).voice
+    try:
+        audio = await download_voice_message(file_id, file_unique_id, duration)
+    except (TelegramAPIError, ClientError, asyncio.TimeoutError):
+        await Responder.respond(msg, content=Responder.Types.ERROR)
         user_controller.user(uid).clear_cache()
+        return False
+    user_controller.user(uid).cache_voice_message(audio, file_id=file_id)
+    start_voice_recognition(uid, audio)
+    return True
 
 
-async def convert_voice_message_using_gapi(uid: int, msg: types.Message):
+async def recognize_voice_message(audio: AudioClip) -> Transcription:
+    speech_recognizer = recognition_router.recognizer()
     try:
-        filename = FileController.convert_ogg_to_wav(
-            filename=user_controller.user(uid).voice_message_filename
-        )
-        speech_recognizer = RecognitionController.strategy(recognition_type='gapi')
-        selected_language = user_controller.user(uid).current_entry.language
-        text = speech_recognizer.recognize(f'{filename}.wav', selected_language)
+        return await recognition_service.transcribe(speech_recognizer, audio)
+    except RecognitionBackendError:
+        # the next best backend gets a go right away instead of the user retrying
+        fallback_recognizer = recognition_router.recognizer(exclude=(speech_recognizer.NAME,))
+        return await recognition_service.transcribe(fallback_recognizer, audio)
+
+
+async def save_voice_message(uid: int, msg: types.Message):
+    try:
+        transcription = await user_controller.user(uid).recognition_job
+        text = transcription.text
 
-        user_controller.user(uid).cache_entry_data(text=EntryFormatter.process_text(text))
-    except (FileNotFoundError, PermissionError):
+        user_controller.user(uid).cache_entry_data(
+            language=transcription.language, text=EntryFormatter.process_text(text)
+        )
+    except RecognitionBusyError:
+        await Responder.respond(msg, content=Responder.Types.BUSY)
+    except (ConversionError, RecognitionBackendError, RecognitionTimeoutError):
         await Responder.respond(msg, content=Responder.Types.ERROR)
     else:
         if len(text):
@@ -276,12 +525,134 @@ async def convert_voice_message_using_gapi(uid: int, msg: types.Message):
 
 async def print_entries(msg: types.Message, entries: list):
     if len(entries):
-        for entry in entries:
-            formatted = EntryFormatter.format_entry(entry=entry)
-            await Responder.respond(msg, content=Responder.Types.PRINT_ENTRY(formatted))
+        # as many entries per message as fit, instead of a message per entry
+        formatted = [EntryFormatter.format_entry(entry=entry) for entry in entries]
+        for message in OutboundSender.pack(formatted):
+            await Responder.respond(msg, content=Responder.Types.PRINT_ENTRY(message))
     else:
         await Responder.respond(msg, content=Responder.Types.ENTRIES_NOT_FOUND)
 
 
+@dp.errors_handler(exception=DatabaseError)
+async def process_database_error(update: types.Update, exception: DatabaseError):
+    logger.error('%s', exception)
+    if update.callback_query is not None:
+        uid, msg = update.callback_query.from_user.id, update.callback_query.message
+    elif update.message is not None:
+        uid, msg = update.message.from_user.id, update.message
+    else:
+        return True
+    user_controller.user(uid).clear_cache()
+    user_controller.user(uid).set_state(UserState.IDLE)
+    await Responder.respond(msg, content=Responder.Types.ERROR)
+    return True
+
+
+async def on_startup(dispatcher: Dispatcher):
+    dispatcher['credentials_refresher'] = asyncio.create_task(
+        RecognitionController.keep_credentials_fresh()
+    )
+    # with several workers, one of them is enough to push the outbox
+    if storage_replicator is not None and dispatcher.get('worker_index', 0) == 0:
+        dispatcher['storage_replicator'] = asyncio.create_task(storage_replicator.run())
+
+
+async def on_shutdown(dispatcher: Dispatcher):
+    dispatcher['credentials_refresher'].cancel()
+    recognition_service.shutdown()
+    RecognitionController.shutdown()
+    if 'storage_replicator' in dispatcher:
+        dispatcher['storage_replicator'].cancel()
+    await db_controller.flush()
+    if storage_replicator is not None:
+        # whatever is left in the outbox goes out now or with the next start
+        await storage_replicator.flush()
+    db_controller.close()
+    user_controller.close()
+
+
+async def set_webhook(dispatcher: Dispatcher):
+    await dispatcher.bot.set_webhook(
+        f'{WEBHOOK_URL}{WEBHOOK_PATH}',
+        # Telegram allows 1 to 100 connections; more would only wait for the semaphore
+        max_connections=max(1, min(WEBHOOK_MAX_CONCURRENT_UPDATES, 100)),
+    )
+
+
+async def handle_shutdown_signals(dispatcher: Dispatcher):
+    if webhook_server is not None:
+        # the webhook is drained while the health endpoint can still tell the load balancer so
+        webhook_server.handle_signals()
+    else:
+        # polling shuts down gracefully on SystemExit, which SIGTERM doesn't raise by itself
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop_polling)
+
+
+def stop_polling():
+    raise SystemExit()
+
+
+async def drain_webhook(dispatcher: Dispatcher):
+    # the updates in progress still need the services the other callbacks close
+    await webhook_server.drain()
+
+
+def run_worker(index: int, updates, metrics):
+    """
+    The entry point of a worker process: handles the updates the supervisor sends to it.
+    """
+    # Ctrl+C reaches the whole process group; the supervisor stops the workers once they're done
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    create_services()
+    dp['worker_index'] = index
+    worker = UpdateWorker(
+        index, updates, metrics,
+        metrics_interval=WORKER_METRICS_INTERVAL, stats=service_stats,
+    )
+    executor.start(dp, worker.run(dp), on_startup=on_startup, on_shutdown=on_shutdown)
+
+
+def run(dispatcher: Dispatcher, on_startup_callbacks: list, on_shutdown_callbacks: list):
+    if webhook_server is not None:
+        webhook_server.setup(dispatcher)
+        webhook_executor = executor.set_webhook(
+            dispatcher, WEBHOOK_PATH,
+            on_startup=[*on_startup_callbacks, set_webhook, handle_shutdown_signals],
+            on_shutdown=[drain_webhook, *on_shutdown_callbacks],
+            web_app=webhook_server.create_app(),
+        )
+        # SIGTERM drains the webhook, then aiohttp shuts down gracefully
+        webhook_executor.run_app(
+            host=os.getenv('WEBAPP_HOST', '0.0.0.0'),
+            port=int(os.getenv('WEBAPP_PORT', 8080)),
+            loop=webhook_executor.loop,
+        )
+    else:
+        executor.start_polling(
+            dispatcher,
+            on_startup=[*on_startup_callbacks, handle_shutdown_signals],
+            on_shutdown=on_shutdown_callbacks,
+        )
+
+
 if __name__ == '__main__':
-    executor.start_polling(dp)
+    if WORKERS:
+        worker_pool = WorkerPool(WORKERS, target=run_worker)
+
+        async def start_workers(dispatcher: Dispatcher):
+            worker_pool.start()
+            dispatcher['worker_watcher'] = asyncio.create_task(worker_pool.watch())
+
+        async def stop_workers(dispatcher: Dispatcher):
+            await worker_pool.stop()
+            await dispatcher['worker_watcher']
+
+        if webhook_server is not None:
+            webhook_server.stats = worker_pool.stats
+        # the supervisor only receives the updates; the workers handle them
+        run(ShardedDispatcher(bot, worker_pool), [start_workers], [stop_workers])
+    else:
+        create_services()
+        if webhook_server is not None:
+            webhook_server.stats = service_stats
+        run(dp, [on_startup], [on_shutdown])
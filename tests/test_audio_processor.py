@@ -0,0 +1,66 @@
+import numpy as np
+
+from core.audio_processor import AudioProcessor
+from core.file_controller import AudioClip
+
+
+SAMPLE_RATE = 16000
+
+
+def clip(*parts) -> AudioClip:
+    """
+    :param parts: (seconds, level in dBFS) pairs; None for the level is silence.
+    :return: a mono LINEAR16 clip of noise at those levels.
+    """
+    rng = np.random.default_rng(0)
+    samples = []
+    for duration, level in parts:
+        count = int(duration * SAMPLE_RATE)
+        if level is None:
+            samples.append(np.zeros(count))
+        else:
+            samples.append(rng.uniform(-1, 1, count) * 32767 * 10 ** (level / 20) * np.sqrt(3))
+    content = np.concatenate(samples).astype('<i2').tobytes()
+    return AudioClip(content=content, encoding=AudioClip.LINEAR16, sample_rate=SAMPLE_RATE)
+
+
+def test_split_on_silence_cuts_at_pause():
+    audio = clip((40, -10), (1, None), (40, -10))
+    segments = AudioProcessor.split_on_silence(audio, max_duration=50)
+    assert len(segments) == 2
+    assert 40 <= segments[0].duration <= 41
+    assert sum(len(segment) for segment in segments) == len(audio)
+
+
+def test_split_on_silence_continuous_speech_overlaps():
+    audio = clip((130, -10))
+    segments = AudioProcessor.split_on_silence(audio, max_duration=50)
+    assert [round(segment.duration, 2) for segment in segments] == [50, 50, 31]
+    # without a pause the segments are cut at the longest length and overlap a little
+    overlap = AudioProcessor.OVERLAP_DURATION
+    assert round(sum(segment.duration for segment in segments), 2) == 130 + 2 * overlap
+    frame_bytes = AudioProcessor.frame_length(audio) * audio.sample_width
+    overlap_bytes = int(overlap / AudioProcessor.FRAME_DURATION) * frame_bytes
+    assert segments[1].content[:overlap_bytes] == segments[0].content[-overlap_bytes:]
+
+
+def test_split_on_silence_ignores_quiet_dips_above_threshold():
+    # a dip to -30 dBFS is not a pause at the default threshold, so the cut isn't made there
+    audio = clip((30, -10), (1, -30), (70, -10))
+    segments = AudioProcessor.split_on_silence(audio, max_duration=50)
+    assert round(segments[0].duration, 2) == 50
+    # but it is at a higher one
+    segments = AudioProcessor.split_on_silence(audio, max_duration=50, threshold=-20)
+    assert 30 <= segments[0].duration <= 31
+
+
+def test_trim_silence_drops_long_pauses():
+    audio = clip((1, None), (2, -10), (3, None), (2, -10), (1, None))
+    trimmed = AudioProcessor.trim_silence(audio, threshold=-40)
+    # half a pause is kept on either side of the speech
+    assert 4 < trimmed.duration <= 4 + 2 * AudioProcessor.KEPT_PAUSE_DURATION
+
+
+def test_trim_silence_keeps_clip_shorter_than_frame():
+    audio = clip((AudioProcessor.FRAME_DURATION / 2, -10))
+    assert AudioProcessor.trim_silence(audio, threshold=-40) is audio
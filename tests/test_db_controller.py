@@ -0,0 +1,75 @@
+import asyncio
+from collections import Counter
+
+from core.db_controller import DatabaseController
+from core.entry_cache import EntryCache
+from core.storage import SQLiteStorage
+from core.user_controller import Entry
+from utils import DateFormatter
+
+
+USER_ID = 1
+
+
+class CountingStorage(SQLiteStorage):
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.calls = Counter()
+
+    async def fetch_all(self, user_id: int) -> list:
+        self.calls['fetch_all'] += 1
+        return await super().fetch_all(user_id)
+
+    async def fetch_last_n(self, user_id: int, number: int) -> list:
+        self.calls['fetch_last_n'] += 1
+        return await super().fetch_last_n(user_id, number)
+
+
+def entry(day: int, text: str = 'Went for a walk', topic: str = 'walks') -> Entry:
+    date = f'2021-03-{day:02} 10:00:00'
+    return Entry(
+        topic=topic, text=text, date=date,
+        timestamp=DateFormatter.date_to_timestamp(date), language='en-US',
+    )
+
+
+async def settle() -> None:
+    # lets the cache warm up in the background
+    for _ in range(10):
+        await asyncio.sleep(0.01)
+
+
+def run_queries(tmp_path, cache_size: int) -> (list, Counter, dict):
+    async def queries():
+        storage = CountingStorage(str(tmp_path / 'diary.sqlite3'))
+        db_controller = DatabaseController(storage, cache=EntryCache(max_size=cache_size))
+        try:
+            for day in range(1, 6):
+                await db_controller.create_entry(USER_ID, entry(day))
+            results = []
+            for _ in range(3):
+                results.append(await db_controller.fetch_last_n(USER_ID, number=2))
+                await settle()
+            return results, storage.calls, db_controller.stats()['cache']
+        finally:
+            db_controller.close()
+
+    return asyncio.run(queries())
+
+
+def test_entries_too_large_to_cache_are_loaded_once(tmp_path):
+    results, calls, cache = run_queries(tmp_path, cache_size=1024)
+    assert calls['fetch_all'] == 1
+    assert calls['fetch_last_n'] == 3
+    assert cache['too_large'] == 1
+    assert all(len(entries) == 2 for entries in results)
+
+
+def test_entries_are_cached_in_the_background(tmp_path):
+    results, calls, cache = run_queries(tmp_path, cache_size=1024 * 1024)
+    assert calls['fetch_all'] == 1
+    # only the first query, the one that missed the cache, went to storage
+    assert calls['fetch_last_n'] == 1
+    assert cache['hits'] == 2
+    # the handlers sort the entries, so the order the storage returns them in doesn't matter
+    assert sorted(results[0], key=lambda e: e['timestamp']) == results[2]
@@ -0,0 +1,66 @@
+import asyncio
+import json
+import threading
+import zipfile
+
+import pytest
+
+from utils import (
+    DateFormatter,
+    EntryExporter,
+)
+
+
+def entries(number: int) -> list:
+    return [
+        dict(
+            timestamp=DateFormatter.date_to_timestamp(f'2021-03-01 10:00:{second:02}'),
+            topic='walks', text=f'walk number {second}', language='en-US',
+        )
+        for second in range(number)
+    ]
+
+
+async def iter_entries(number: int):
+    for entry in entries(number):
+        yield entry
+
+
+class ThreadRecordingFile:
+    def __init__(self, file):
+        self._file = file
+        self.threads = set()
+
+    def write(self, data: bytes) -> int:
+        self.threads.add(threading.current_thread())
+        return self._file.write(data)
+
+
+@pytest.fixture
+def small_writes(monkeypatch):
+    monkeypatch.setattr(EntryExporter, 'WRITE_SIZE', 100)
+
+
+def test_zip_export_holds_every_entry(small_writes):
+    async def export():
+        return await EntryExporter.export(iter_entries(50), EntryExporter.ZIP, spool_size=1024)
+
+    file, count = asyncio.run(export())
+    with file, zipfile.ZipFile(file) as archive:
+        markdown = archive.read(EntryExporter.filename(EntryExporter.MARKDOWN)).decode('utf-8')
+    assert count == 50
+    assert markdown == ''.join(EntryExporter.to_markdown(entry) for entry in entries(50))
+
+
+def test_entries_are_written_away_from_the_event_loop(small_writes, tmp_path):
+    async def write():
+        with open(tmp_path / 'diary.jsonl', 'wb') as file:
+            recording = ThreadRecordingFile(file)
+            count = await EntryExporter._write(iter_entries(20), recording, EntryExporter.to_jsonl)
+        return count, recording.threads, threading.current_thread()
+
+    count, threads, loop_thread = asyncio.run(write())
+    assert count == 20
+    assert threads and loop_thread not in threads
+    with open(tmp_path / 'diary.jsonl', encoding='utf-8') as file:
+        assert [json.loads(line) for line in file] == entries(20)
@@ -0,0 +1,252 @@
+import asyncio
+
+import firebase_admin
+import google.api_core.exceptions as google_api_exc
+import pytest
+from google.cloud import firestore
+
+from core.storage import (
+    FirestoreStorage,
+    PartialWriteError,
+)
+from core.write_queue import WriteQueue
+from utils import DateFormatter
+
+
+USER_ID = 1
+
+
+class FakeSnapshot:
+    def __init__(self, ref: 'FakeDocument', data: dict = None):
+        self.id = ref.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return self._data
+
+
+class FakeQuery:
+    def __init__(self, collection: 'FakeCollection', filters: tuple = ()):
+        self._collection = collection
+        self._filters = filters
+
+    def _filter(self, check) -> 'FakeQuery':
+        return FakeQuery(self._collection, (*self._filters, check))
+
+    def order_by(self, field: str, direction: str = 'ASCENDING') -> 'FakeQuery':
+        return self
+
+    def start_at(self, values: dict) -> 'FakeQuery':
+        return self._filter(lambda ref, data: data['timestamp'] >= values['timestamp'])
+
+    def start_after(self, values: dict) -> 'FakeQuery':
+        return self._filter(lambda ref, data: data['timestamp'] > values['timestamp'])
+
+    def end_at(self, values: dict) -> 'FakeQuery':
+        return self._filter(lambda ref, data: data['timestamp'] <= values['timestamp'])
+
+    def end_before(self, values: dict) -> 'FakeQuery':
+        return self._filter(lambda ref, data: data['timestamp'] < values['timestamp'])
+
+    def where(self, field: str, op: str, value) -> 'FakeQuery':
+        # only the document ID ranges the day queries use
+        if op == '>=':
+            return self._filter(lambda ref, data: ref.id >= value.id)
+        return self._filter(lambda ref, data: ref.id <= value.id)
+
+    async def get(self) -> list:
+        client = self._collection.client
+        client.reads.append(self._collection.path)
+        return [
+            FakeSnapshot(ref, client.docs[ref.path])
+            for ref in self._collection.refs()
+            if all(check(ref, client.docs[ref.path]) for check in self._filters)
+        ]
+
+    async def stream(self):
+        for snapshot in await self.get():
+            yield snapshot
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, client: 'FakeClient', path: tuple):
+        super().__init__(self)
+        self.client = client
+        self.path = path
+
+    def document(self, document_id: str) -> 'FakeDocument':
+        return FakeDocument(self.client, (*self.path, document_id))
+
+    def refs(self) -> list:
+        return [
+            FakeDocument(self.client, path) for path in sorted(self.client.docs)
+            if path[:-1] == self.path
+        ]
+
+    async def list_documents(self):
+        for ref in self.refs():
+            yield ref
+
+
+class FakeDocument:
+    def __init__(self, client: 'FakeClient', path: tuple):
+        self.client = client
+        self.path = path
+        self.id = path[-1]
+
+    def collection(self, name: str) -> FakeCollection:
+        return FakeCollection(self.client, (*self.path, name))
+
+    async def get(self) -> FakeSnapshot:
+        self.client.reads.append(self.path)
+        return FakeSnapshot(self, self.client.docs.get(self.path))
+
+    async def set(self, data: dict, merge: bool = False) -> None:
+        self.client.apply([(self, data, merge)])
+
+
+class FakeBatch:
+    def __init__(self, client: 'FakeClient'):
+        self._client = client
+        self._writes = []
+
+    def set(self, ref: FakeDocument, data: dict, merge: bool = False) -> None:
+        self._writes.append((ref, data, merge))
+
+    def delete(self, ref: FakeDocument) -> None:
+        self._writes.append((ref, None, False))
+
+    async def commit(self) -> None:
+        self._client.commits.append([ref.path for ref, _, _ in self._writes])
+        if len(self._client.commits) in self._client.failing_commits:
+            raise google_api_exc.ServiceUnavailable('commit failed')
+        self._client.apply(self._writes)
+
+
+class FakeClient:
+    def __init__(self):
+        self.docs = {}
+        self.reads = []
+        self.commits = []
+        self.failing_commits = set()
+
+    def collection(self, name: str) -> FakeCollection:
+        return FakeCollection(self, (name,))
+
+    def batch(self) -> FakeBatch:
+        return FakeBatch(self)
+
+    @classmethod
+    def _merge(cls, current: dict, data: dict) -> dict:
+        merged = dict(current)
+        for key, value in data.items():
+            if value is firestore.DELETE_FIELD:
+                merged.pop(key, None)
+            elif isinstance(value, dict) and isinstance(merged.get(key), dict):
+                merged[key] = cls._merge(merged[key], value)
+            else:
+                merged[key] = value
+        return merged
+
+    def apply(self, writes: list) -> None:
+        for ref, data, merge in writes:
+            if data is None:
+                self.docs.pop(ref.path, None)
+            elif merge:
+                self.docs[ref.path] = self._merge(self.docs.get(ref.path, {}), data)
+            else:
+                self.docs[ref.path] = data
+
+
+@pytest.fixture
+def client(monkeypatch) -> FakeClient:
+    client = FakeClient()
+    monkeypatch.setattr(
+        firebase_admin.credentials, 'Certificate', lambda cert: type(
+            'Certificate', (), dict(get_credential=lambda self: None)
+        )()
+    )
+    monkeypatch.setattr(firestore, 'AsyncClient', lambda project, credentials: client)
+    return client
+
+
+def create_storage(day_rollups: bool) -> FirestoreStorage:
+    return FirestoreStorage(
+        project_id='diary', private_key_id='', private_key='', client_email='', client_id='',
+        cert_url='', day_rollups=day_rollups,
+    )
+
+
+def entry(date: str) -> tuple:
+    timestamp = DateFormatter.date_to_timestamp(date)
+    data = dict(timestamp=timestamp, topic='None', text=date, language='en-US')
+    return FirestoreStorage.CREATE, USER_ID, date, data
+
+
+def test_split_day_is_built_again_after_a_failed_part(client, monkeypatch):
+    monkeypatch.setattr(FirestoreStorage, 'MAX_BATCH_WRITES', 4)
+    storage = create_storage(day_rollups=True)
+    march_1 = [entry(f'2021-03-01 10:00:0{second}') for second in range(5)]
+    march_2 = [entry('2021-03-02 10:00:00')]
+    client.docs[('Users', f'{USER_ID}')] = {FirestoreStorage.ROLLUPS_BUILT_FIELD: True}
+
+    async def write():
+        # the second part of March 1st fails after the first one is in
+        client.failing_commits.add(2)
+        with pytest.raises(PartialWriteError) as e:
+            await storage.apply_writes(march_1 + march_2)
+        return e.value
+
+    error = asyncio.run(write())
+    assert isinstance(error.error, google_api_exc.ServiceUnavailable)
+    assert error.committed == {0, 1, 2, 3}
+    # 5 entries and their day take two batches, and March 2nd is never sent after the failure
+    assert [len(commit) for commit in client.commits] == [4, 2]
+    # so the next date query builds the days again
+    assert client.docs[('Users', f'{USER_ID}')] == {}
+
+
+def test_day_queries_read_entries_until_rollups_are_built(client):
+    dates = ['2021-03-01 10:00:00', '2021-03-01 12:00:00', '2021-03-03 09:00:00']
+    # the entries were written before the rollups were turned on
+    asyncio.run(create_storage(day_rollups=False).apply_writes([entry(date) for date in dates]))
+    storage = create_storage(day_rollups=True)
+    start = DateFormatter.date_to_timestamp('2021-03-01 00:00:00')
+    end = DateFormatter.date_to_timestamp('2021-03-02 00:00:00')
+
+    async def query():
+        cold = await storage.fetch_between(USER_ID, start, end, include_end=False)
+        # the build runs in the background
+        for _ in range(10):
+            await asyncio.sleep(0)
+        client.reads.clear()
+        warm = await storage.fetch_between(USER_ID, start, end, include_end=False)
+        return cold, warm
+
+    cold, warm = asyncio.run(query())
+    assert [e['text'] for e in cold] == [e['text'] for e in warm] == dates[:2]
+    assert client.docs[('Users', f'{USER_ID}')] == {FirestoreStorage.ROLLUPS_BUILT_FIELD: True}
+    # the warm query read the day documents only
+    assert client.reads == [('Users', f'{USER_ID}', 'Days')]
+    assert set(client.docs[('Users', f'{USER_ID}', 'Days', '2021-03-01')]['entries']) == {
+        f'{DateFormatter.date_to_timestamp(date)}' for date in dates[:2]
+    }
+
+
+def test_only_writes_in_failed_batch_see_error(client, monkeypatch):
+    monkeypatch.setattr(FirestoreStorage, 'MAX_BATCH_WRITES', 2)
+    write_queue = WriteQueue(create_storage(day_rollups=False), window=0.01)
+    dates = [f'2021-03-0{day} 10:00:00' for day in range(1, 5)]
+
+    async def submit():
+        client.failing_commits.add(2)
+        return await asyncio.gather(
+            *(write_queue.submit(*entry(date)) for date in dates), return_exceptions=True
+        )
+
+    results = asyncio.run(submit())
+    # the first batch is in, so its writers go on to update the caches and indexes
+    assert results[:2] == [None, None]
+    assert all(isinstance(result, google_api_exc.ServiceUnavailable) for result in results[2:])
+    assert sorted(path[-1] for path in client.docs) == dates[:2]
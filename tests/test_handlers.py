@@ -0,0 +1,63 @@
+import asyncio
+import importlib
+
+import pytest
+from aiogram import types
+
+from core.file_controller import AudioClip
+from core.recognize_controller import Transcription
+
+
+USER_ID = 1
+
+
+def message(**content) -> types.Message:
+    return types.Message(**{
+        'message_id': 1,
+        'from': dict(id=USER_ID, is_bot=False, first_name='User'),
+        'chat': dict(id=USER_ID, type='private'),
+        'date': 0,
+        **content,
+    })
+
+
+@pytest.fixture
+def main(tmp_path, monkeypatch):
+    monkeypatch.setenv('TOKEN', '123:abc')
+    monkeypatch.setenv('STORAGE_BACKEND', 'sqlite')
+    monkeypatch.setenv('SQLITE_PATH', str(tmp_path / 'diary.sqlite3'))
+    monkeypatch.setenv('SEARCH_INDEX_PATH', str(tmp_path / 'search.sqlite3'))
+    monkeypatch.setenv('TOPIC_INDEX_PATH', str(tmp_path / 'topics.sqlite3'))
+    main = importlib.import_module('main')
+    main.create_services()
+    responses = []
+
+    async def respond(msg: types.Message, content: dict):
+        responses.append(content)
+
+    async def download_voice_message(file_id: str, file_unique_id: str, duration: float):
+        return AudioClip(
+            content=b'\0\0', encoding=AudioClip.OGG_OPUS, sample_rate=48000,
+            duration=duration, file_id=file_unique_id,
+        )
+
+    async def recognize_voice_message(audio: AudioClip) -> Transcription:
+        return Transcription(text='went for a walk', languages={'en-US': 1}, confidence=0.9)
+
+    monkeypatch.setattr(main.Responder, 'respond', respond)
+    monkeypatch.setattr(main, 'download_voice_message', download_voice_message)
+    monkeypatch.setattr(main, 'recognize_voice_message', recognize_voice_message)
+    yield main
+    main.db_controller.close()
+    main.recognition_service.shutdown()
+
+
+def test_entry_is_saved_with_the_chosen_topic(main):
+    async def save_entry():
+        voice = dict(file_id='voice', file_unique_id='unique', duration=3)
+        await main.process_voice_message(message(voice=voice))
+        await main.process_get_text_input(message(text='walks'))
+        return await main.db_controller.frequent_topics(USER_ID)
+
+    assert asyncio.run(save_entry()) == ['walks']
+    assert main.user_controller.user(USER_ID).is_state(main.UserState.IDLE)
@@ -0,0 +1,63 @@
+import asyncio
+import threading
+
+import pytest
+
+from core.file_controller import AudioClip
+from core.recognition_service import (
+    RecognitionBusyError,
+    RecognitionService,
+)
+from core.recognize_controller import (
+    AbstractSpeechRecognizer,
+    Transcription,
+)
+
+
+class BlockingRecognizer(AbstractSpeechRecognizer):
+    NAME = 'blocking'
+
+    def __init__(self):
+        self.release = threading.Event()
+
+    def recognize(self, audio: AudioClip, language: str = None) -> Transcription:
+        self.release.wait(5)
+        return Transcription(text=audio.file_id, languages={'en-US': 1}, confidence=1.0)
+
+
+def segment(name: str) -> AudioClip:
+    return AudioClip(
+        content=b'\0\0', encoding=AudioClip.LINEAR16, sample_rate=16000, file_id=name
+    )
+
+
+def test_message_takes_one_place_for_all_its_segments():
+    async def recognize():
+        service = RecognitionService(max_workers=1, max_queue=1, timeout=5)
+        recognizer = BlockingRecognizer()
+        try:
+            with service.admit() as admission:
+                # a long message's segments all wait for the only worker
+                segments = [
+                    asyncio.ensure_future(
+                        service.recognize(recognizer, segment(f'{i}'), admission=admission)
+                    )
+                    for i in range(4)
+                ]
+                await asyncio.sleep(0.1)
+                # another user's message still gets in, the third one doesn't
+                other = asyncio.ensure_future(service.recognize(recognizer, segment('other')))
+                await asyncio.sleep(0.1)
+                with pytest.raises(RecognitionBusyError):
+                    await service.recognize(recognizer, segment('rejected'))
+                recognizer.release.set()
+                texts = [transcription.text for transcription in await asyncio.gather(*segments)]
+            return texts, (await other).text, service.stats()
+        finally:
+            service.shutdown()
+
+    texts, other, stats = asyncio.run(recognize())
+    assert texts == ['0', '1', '2', '3']
+    assert other == 'other'
+    assert stats['admitted'] == 0
+    assert stats['rejected'] == 1
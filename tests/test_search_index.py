@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+
+from core.search_index import (
+    SearchIndex,
+    Tokenizer,
+)
+
+
+@pytest.mark.parametrize('word, plural', [
+    ('note', 'notes'),
+    ('meeting', 'meetings'),
+    ('story', 'stories'),
+    ('tie', 'ties'),
+    ('зустріч', 'зустрічі'),
+])
+def test_singular_and_plural_share_stem(word, plural):
+    assert Tokenizer.stem(word) == Tokenizer.stem(plural)
+
+
+@pytest.mark.parametrize('word', [
+    'bus', 'class', 'goes', 'is', 'news', 'series', 'yes', 'гра', 'між',
+])
+def test_stem_keeps_short_words_and_exceptions_whole(word):
+    assert Tokenizer.stem(word) == word
+
+
+@pytest.mark.parametrize('word, stem', [
+    ('notes', 'note'),
+    ('stories', 'story'),
+    ('ties', 'tie'),
+    ('agrees', 'agree'),
+    ('boxes', 'boxe'),
+    ('зустрічами', 'зустріч'),
+    ('роботою', 'робот'),
+])
+def test_stem(word, stem):
+    assert Tokenizer.stem(word) == stem
+
+
+def test_query_and_document_stems_agree():
+    document = 'Wrote some notes about the stories of my meetings'
+    for query in ('note', 'notes', 'story', 'stories', 'meeting'):
+        assert set(Tokenizer.tokens(query)) <= set(Tokenizer.tokens(document))
+
+
+def test_search_finds_entries_by_any_form_of_word(tmp_path):
+    async def search():
+        index = SearchIndex(str(tmp_path / 'search.sqlite3'))
+        try:
+            await index.build(1, {
+                'first': 'Took notes at the meeting',
+                'second': 'A note to self',
+                'third': 'Nothing to see here',
+            })
+            await index.add(1, 'fourth', 'More stories tomorrow')
+            return (
+                set(await index.search(1, 'note')),
+                set(await index.search(1, 'notes')),
+                await index.search(1, 'story'),
+            )
+        finally:
+            index.close()
+
+    by_singular, by_plural, stories = asyncio.run(search())
+    assert by_singular == by_plural == {'first', 'second'}
+    assert stories == ['fourth']
@@ -0,0 +1,217 @@
+import asyncio
+
+import pytest
+from aiogram import types
+
+from core.file_controller import AudioClip
+from core.session_store import (
+    RedisSessionStore,
+    SessionStoreError,
+    SQLiteSessionStore,
+)
+from core.user_controller import (
+    SessionMiddleware,
+    UserController,
+    UserState,
+)
+from utils import DateFormatter
+
+
+USER_ID = 1
+
+
+class FakeRedis:
+    def __init__(self, password: str = None):
+        """
+        Just enough of a Redis server for the session store: AUTH, SELECT, MGET, SET and DEL.
+        """
+        self.password = password
+        self.data = {}
+        self.ttls = {}
+        self.commands = []
+        self.connections = 0
+        self._writers = []
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        self._writers.append(writer)
+        try:
+            while True:
+                command = await self._read_command(reader)
+                self.commands.append(command)
+                writer.write(self._reply(*command))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def drop_connections(self) -> None:
+        for writer in self._writers:
+            writer.close()
+        self._writers.clear()
+
+    @staticmethod
+    async def _read_command(reader: asyncio.StreamReader) -> list:
+        count = int((await reader.readuntil(b'\r\n'))[1:-2])
+        args = []
+        for _ in range(count):
+            length = int((await reader.readuntil(b'\r\n'))[1:-2])
+            args.append((await reader.readexactly(length + 2))[:-2])
+        return args
+
+    def _reply(self, name: bytes, *args) -> bytes:
+        name = name.decode().upper()
+        if name == 'AUTH':
+            if args[0].decode() != self.password:
+                return b'-WRONGPASS invalid password\r\n'
+            return b'+OK\r\n'
+        if name == 'SELECT':
+            return b'+OK\r\n'
+        if name == 'MGET':
+            values = [self.data.get(key) for key in args]
+            return b'*%d\r\n' % len(values) + b''.join(
+                b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value)
+                for value in values
+            )
+        if name == 'SET':
+            key, value, *options = args
+            self.data[key] = value
+            if options:
+                self.ttls[key] = int(options[1])
+            return b'+OK\r\n'
+        if name == 'DEL':
+            return b':%d\r\n' % sum(self.data.pop(key, None) is not None for key in args)
+        return b'-ERR unknown command\r\n'
+
+
+def with_redis(test, **server_options):
+    async def run():
+        server = FakeRedis(**server_options)
+        listener = await asyncio.start_server(server.handle, '127.0.0.1', 0)
+        try:
+            return await test(server, listener.sockets[0].getsockname()[1])
+        finally:
+            listener.close()
+            server.drop_connections()
+
+    return asyncio.run(run())
+
+
+def test_redis_sessions_round_trip():
+    async def test(server: FakeRedis, port: int):
+        store = RedisSessionStore(host='127.0.0.1', port=port, db=2, password='secret', ttl=60)
+        try:
+            await store.save({1: b'first', 2: b'second'})
+            loaded = await store.load([1, 2, 3])
+            await store.save({1: None})
+            return server, loaded, await store.load([1, 2])
+        finally:
+            store.close()
+
+    server, loaded, after_delete = with_redis(test, password='secret')
+    assert loaded == {1: b'first', 2: b'second'}
+    assert after_delete == {2: b'second'}
+    # logged in and on the right database once, for all the commands
+    assert server.connections == 1
+    assert server.commands[:2] == [[b'AUTH', b'secret'], [b'SELECT', b'2']]
+    assert server.ttls == {b'voice-diary:session:1': 60, b'voice-diary:session:2': 60}
+
+
+def test_redis_store_reconnects_after_losing_the_connection():
+    async def test(server: FakeRedis, port: int):
+        store = RedisSessionStore(host='127.0.0.1', port=port)
+        try:
+            await store.save({USER_ID: b'session'})
+            server.drop_connections()
+            await asyncio.sleep(0.01)
+            return server, await store.load([USER_ID])
+        finally:
+            store.close()
+
+    server, loaded = with_redis(test)
+    assert loaded == {USER_ID: b'session'}
+    assert server.connections == 2
+
+
+def test_redis_store_refuses_wrong_password():
+    async def test(server: FakeRedis, port: int):
+        store = RedisSessionStore(host='127.0.0.1', port=port, password='wrong')
+        try:
+            with pytest.raises(SessionStoreError):
+                await store.load([USER_ID])
+            # the user controller carries on without the session instead of failing the update
+            controller = UserController(store)
+            await controller.begin_update(USER_ID)
+            return controller.user(USER_ID)
+        finally:
+            store.close()
+
+    assert with_redis(test, password='secret') is None
+
+
+def update(update_id: int) -> types.Update:
+    return types.Update(**{
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'from': dict(id=USER_ID, is_bot=False, first_name='User'),
+            'chat': dict(id=USER_ID, type='private'),
+            'date': 0,
+            'text': 'walks',
+        },
+    })
+
+
+def test_user_is_restored_mid_flow_from_sqlite(tmp_path):
+    path = str(tmp_path / 'sessions.sqlite3')
+    date = '2021-03-01 10:00:00'
+
+    async def first_process() -> bytes:
+        controller = UserController(SQLiteSessionStore(path))
+        middleware = SessionMiddleware(controller)
+        try:
+            await middleware.on_pre_process_update(update(1), {})
+            controller.register(USER_ID)
+            user = controller.user(USER_ID)
+            user.cache_entry_data(
+                date=date, timestamp=DateFormatter.date_to_timestamp(date), topic='None'
+            )
+            audio = AudioClip(
+                content=b'\0\0', encoding=AudioClip.OGG_OPUS, sample_rate=48000, duration=3,
+                file_id='unique',
+            )
+            user.cache_voice_message(audio, file_id='voice')
+            user.start_recognition(asyncio.ensure_future(asyncio.sleep(10)), ttl=600)
+            user.set_state(UserState.AUDIO_INPUT_TOPIC)
+            await middleware.on_post_process_update(update(1), [], {})
+            session = user.dump()
+            # the process goes away with the recognition still running
+            user.clear_cache()
+            return session
+        finally:
+            controller.close()
+
+    async def second_process() -> (bytes, UserController):
+        store = SQLiteSessionStore(path)
+        controller = UserController(store)
+        middleware = SessionMiddleware(controller)
+        try:
+            await middleware.on_pre_process_update(update(2), {})
+            restored = controller.user(USER_ID).dump()
+            controller.user(USER_ID).choose_topic('walks')
+            await middleware.on_post_process_update(update(2), [], {})
+            return restored, controller.user(USER_ID), await store.load([USER_ID])
+        finally:
+            controller.close()
+
+    session = asyncio.run(first_process())
+    restored, user, stored = asyncio.run(second_process())
+    assert restored == session
+    assert user.is_state(UserState.AUDIO_INPUT_TOPIC)
+    assert user.current_entry.date == date
+    assert user.current_entry.topic == 'walks'
+    # the recording is downloaded again, the recognition of the first process is gone
+    assert user.voice == ('voice', 'unique', 3)
+    assert user.voice_message is None and user.recognition_job is None
+    assert stored == {USER_ID: user.dump()}
@@ -1,4 +1,5 @@
 from .bot_kb import Keyboards
 from .date_formatter import DateFormatter
 from .entry_formatter import EntryFormatter
+from .entry_exporter import EntryExporter
 from .bot_msg_type import MessageTypes
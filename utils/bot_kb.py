@@ -1,4 +1,6 @@
 from aiogram.types import (
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
     ReplyKeyboardMarkup,
     KeyboardButton,
 )
@@ -15,12 +17,8 @@ class Keyboards:
         .row(
             KeyboardButton('between two dates'), KeyboardButton('after date')
         )
-    )
-
-    GET_LANGUAGES = (
-        ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
         .row(
-            KeyboardButton('🇺🇸 en-US'), KeyboardButton('🇺🇦 uk-UA')
+            KeyboardButton('search'), KeyboardButton('export')
         )
     )
 
@@ -35,3 +33,15 @@ class Keyboards:
         ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
         .add(KeyboardButton('None'))
     )
+
+    @classmethod
+    def TOPICS(cls, topics: list) -> ReplyKeyboardMarkup:   # NOSONAR
+        keyboard = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True, row_width=2)
+        keyboard.add(*(KeyboardButton(topic) for topic in topics if topic != 'None'))
+        return keyboard.add(KeyboardButton('None'))
+
+    @classmethod
+    def MORE_ENTRIES(cls, callback_data: str) -> InlineKeyboardMarkup:   # NOSONAR
+        return InlineKeyboardMarkup().add(
+            InlineKeyboardButton('Show more', callback_data=callback_data)
+        )
@@ -27,12 +27,20 @@ class MessageTypes:
         GET_ALL_BETWEEN_TWO_DATES = ['between two dates']
         GET_LAST_N_ENTRIES = ['last N entries']
         GET_ALL_ENTRIES_BY_TOPIC = ['by topic']
+        SEARCH_ENTRIES = ['search']
+        EXPORT_ENTRIES = ['export']
+
+    class Callbacks:
+        # followed by the cursor of the next page
+        MORE_ENTRIES = 'more_entries:'
 
     class ContentTypes:
         VOICE = ['voice']
 
     class Commands:
         START = ['start']
+        SEARCH = ['search']
+        EXPORT = ['export']
         DELETE_REGEX = rf'^/d_(\d{len(DateFormatter.get_current_timestamp())})$'
 
     @staticmethod
@@ -5,6 +5,7 @@ from dateutil import parser
 
 class DateFormatter:
     DATE_STRING_DEFAULT_FORMAT = '%Y-%m-%d %H:%M:%S'
+    DAY_STRING_FORMAT = '%Y-%m-%d'
     DAYS_SINCE = {'Today': 0, 'Yesterday': 1, 'Past week': 7}
 
     @classmethod
@@ -15,6 +16,10 @@ class DateFormatter:
     def timestamp_to_date(cls, timestamp: int) -> str:
         return datetime.datetime.fromtimestamp(timestamp).strftime(cls.DATE_STRING_DEFAULT_FORMAT)
 
+    @classmethod
+    def timestamp_to_day(cls, timestamp: int) -> str:
+        return datetime.datetime.fromtimestamp(timestamp).strftime(cls.DAY_STRING_FORMAT)
+
     @classmethod
     def date_to_timestamp(cls, date: str) -> int:
         return int(datetime.datetime.strptime(date, cls.DATE_STRING_DEFAULT_FORMAT).timestamp())
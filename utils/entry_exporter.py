@@ -0,0 +1,95 @@
+import asyncio
+import json
+import tempfile
+import zipfile
+from typing import AsyncIterable
+
+from utils.date_formatter import DateFormatter
+
+
+class EntryExporter:
+    JSONL = 'jsonl'
+    MARKDOWN = 'md'
+    ZIP = 'zip'
+    FORMATS = (JSONL, MARKDOWN, ZIP)
+
+    # bytes kept in memory before the export is spilled to a temporary file
+    SPOOL_SIZE = 1024 * 1024
+    # bytes of text gathered before they're compressed and written, away from the event loop
+    WRITE_SIZE = 64 * 1024
+
+    @classmethod
+    def filename(cls, export_format: str) -> str:
+        return f'diary.{export_format}'
+
+    @classmethod
+    def to_jsonl(cls, entry: dict) -> str:
+        return json.dumps(entry, ensure_ascii=False) + '\n'
+
+    @classmethod
+    def to_markdown(cls, entry: dict) -> str:
+        return (
+            f'## {DateFormatter.timestamp_to_date(entry["timestamp"])} | {entry["topic"]}\n\n'
+            f'{entry["text"]}\n\n'
+        )
+
+    @classmethod
+    async def export(
+        cls, entries: AsyncIterable, export_format: str, spool_size: int = SPOOL_SIZE
+    ) -> (tempfile.SpooledTemporaryFile, int):
+        """
+        Write the entries into a file one at a time, so a diary of any size takes the same memory.
+        :param entries: the entries as dicts, e.g. DatabaseController.iter_entries.
+        :param export_format: one of FORMATS; a zip holds the entries as Markdown.
+        :param spool_size: bytes kept in memory before the file goes to the disk.
+        :return: the file, rewound, and how many entries are in it; the caller closes the file.
+        """
+        if export_format not in cls.FORMATS:
+            raise ValueError(f'unknown export format: {export_format}')
+        file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        try:
+            if export_format == cls.ZIP:
+                archive = zipfile.ZipFile(file, 'w', compression=zipfile.ZIP_DEFLATED)
+                member = archive.open(cls.filename(cls.MARKDOWN), 'w')
+                try:
+                    count = await cls._write(entries, member, cls.to_markdown)
+                finally:
+                    # flushes the rest of the compressed stream and writes the archive's directory
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, cls._close_archive, archive, member
+                    )
+            else:
+                count = await cls._write(
+                    entries, file,
+                    cls.to_jsonl if export_format == cls.JSONL else cls.to_markdown
+                )
+        except BaseException:
+            file.close()
+            raise
+        file.seek(0)
+        return file, count
+
+    @classmethod
+    async def _write(cls, entries: AsyncIterable, file, to_text) -> int:
+        loop = asyncio.get_running_loop()
+        count = 0
+        chunk, chunk_size = [], 0
+        async for entry in entries:
+            data = to_text(entry).encode('utf-8')
+            chunk.append(data)
+            chunk_size += len(data)
+            count += 1
+            if chunk_size >= cls.WRITE_SIZE:
+                # deflating and spilling to the disk take a while, and only one write runs at a time
+                await loop.run_in_executor(None, file.write, b''.join(chunk))
+                chunk, chunk_size = [], 0
+        if chunk:
+            await loop.run_in_executor(None, file.write, b''.join(chunk))
+        return count
+
+    @staticmethod
+    def _close_archive(archive: zipfile.ZipFile, member) -> None:
+        try:
+            member.close()
+        finally:
+            archive.close()
@@ -1,3 +1,4 @@
+import html
 import re
 
 from utils import DateFormatter
@@ -5,16 +6,8 @@ from utils import DateFormatter
 
 class EntryFormatter:
     @classmethod
-    def process_fetched(cls, fetched_data) -> list:
-        if not isinstance(fetched_data, list):
-            fetched_data = [fetched_data]
-        try:
-            return sorted(
-                [entry.to_dict() for entry in fetched_data],
-                key=lambda entry: entry['timestamp']
-            )
-        except TypeError:
-            return []
+    def process_fetched(cls, fetched_data: list) -> list:
+        return sorted(fetched_data, key=lambda entry: entry['timestamp'])
 
     @classmethod
     def process_text(cls, text: str) -> str:
@@ -36,7 +29,7 @@ class EntryFormatter:
         language_flags = {'en-US': '🇺🇸', 'uk-UA': '🇺🇦'}
         entry_header = (
             f'{DateFormatter.timestamp_to_date(entry["timestamp"])} | '
-            f'{language_flags[entry["language"]]} {entry["topic"]}'
+            f'{language_flags[entry["language"]]} {html.escape(entry["topic"])}'
         )
         text_len = len(re.findall(r'\w+', entry['text']))
         line_len = int(len(entry_header) * 1.6)
@@ -45,6 +38,6 @@ class EntryFormatter:
             f'<b>{entry_header}</b>\n'
             f'{"-" * line_len}\n'
             f'<i>{text_len} words</i>\n\n'
-            f'{entry["text"]}\n\n'
+            f'{html.escape(entry["text"])}\n\n'
             f'🗑️ /d_{entry["timestamp"]}'
         )